@@ -1,44 +1,139 @@
 from collections import deque
 
 class ByteBuffer:
+    """
+    FIFO buffer for bytes.
+
+    Bytes are kept in one contiguous bytearray with a read offset, so reads, peeks and
+    length checks don't depend on how data was written. Consumed space is reclaimed
+    lazily, when it's at least half of the buffer.
+
+    Strings are supported as well (when *join_with* is str and str data is written),
+    those are stored as a queue of chunks.
+    """
     def __init__(self, data=None, join_with=""):
-        if data is not None:
-            self.data = deque((data,))
-        else:
-            self.data = deque()
         self.join_with = join_with
-    
-    def read(self, read_size):
+        self._buf = bytearray()
+        self._pos = 0
+        self._chunks = deque()
+        self._len = 0
+        #None until the first write, unless join_with tells what data is going to be
+        self._text = False if isinstance(join_with, (bytes, bytearray)) else None
+        if data is not None:
+            self.write(data)
+
+    def __len__(self):
+        if self._text:
+            return self._len
+        return len(self._buf) - self._pos
+
+    def _compact(self):
+        """Drops consumed bytes, unless someone still holds a view of the buffer"""
         try:
-            len_found = 0
-            collected = []
-            while len_found < read_size:
-                d = self.data.popleft()
-                left = read_size - len_found
-                len_found += len(d)
-                if len(d) > left:
-                    collected.append(d[:left])
-                    self.data.appendleft(d[left:])
-                else:
-                    collected.append(d)
-            
-            return self.join_with.join(collected)
-        except IndexError as e:
-            raise ValueError("Not enought values in buffer") from e
-    
+            del self._buf[:self._pos]
+        except BufferError:
+            self._buf = self._buf[self._pos:]
+        self._pos = 0
+
     def write(self, data):
-        self.data.append(data)
-    
+        if self._text is None:
+            self._text = isinstance(data, str)
+        if self._text:
+            self._chunks.append(data)
+            self._len += len(data)
+            return
+        if self._pos > 0 and self._pos * 2 >= len(self._buf):
+            self._compact()
+        try:
+            self._buf += data
+        except BufferError:
+            #Peeked views are still alive, leave them the old buffer
+            self._buf = self._buf[self._pos:] + data
+            self._pos = 0
+
+    def read(self, read_size):
+        if read_size > len(self):
+            raise ValueError("Not enought values in buffer")
+        if self._text is None:
+            return self.join_with[:0]
+        if self._text:
+            return self._read_text(read_size)
+        pos = self._pos
+        with memoryview(self._buf) as view:
+            res = bytes(view[pos:pos+read_size])
+        self._skip(read_size)
+        return res
+
+    def readinto(self, buffer):
+        """
+        Reads up to len(*buffer*) bytes into *buffer*, returns amount of bytes read
+        """
+        with memoryview(buffer) as target:
+            amount = min(len(target), len(self))
+            pos = self._pos
+            with memoryview(self._buf) as view:
+                target[:amount] = view[pos:pos+amount]
+        self._skip(amount)
+        return amount
+
+    def skip(self, size):
+        """
+        Drops *size* values from the beginning of the buffer, without copying them
+        """
+        if size > len(self):
+            raise ValueError("Not enought values in buffer")
+        if self._text:
+            self._read_text(size)
+        else:
+            self._skip(size)
+
+    def _skip(self, size):
+        self._pos += size
+        if self._pos == len(self._buf):
+            try:
+                self._buf.clear()
+                self._pos = 0
+            except BufferError:
+                pass
+
     def peek(self, size=None):
+        """
+        Returns up to *size* values (everything if *size* is None) without removing them.
+        For bytes this is a memoryview of the internal buffer, valid until the next write;
+        release it (or use it as a context manager) when done.
+        """
+        if self._text is None:
+            return self.join_with[:0]
+        if self._text:
+            return self._peek_text(size)
+        end = len(self._buf) if size is None else min(len(self._buf), self._pos + size)
+        return memoryview(self._buf)[self._pos:end]
+
+    def has_values(self):
+        return len(self) > 0
+
+    def _read_text(self, read_size):
+        len_found = 0
+        collected = []
+        while len_found < read_size:
+            d = self._chunks.popleft()
+            left = read_size - len_found
+            len_found += len(d)
+            if len(d) > left:
+                collected.append(d[:left])
+                self._chunks.appendleft(d[left:])
+            else:
+                collected.append(d)
+        self._len -= read_size
+        return self.join_with.join(collected)
+
+    def _peek_text(self, size):
+        if size is None:
+            size = self._len
         tl = 0
         pointer = 0
-        while tl < size and pointer < len(self.data):
-            tl += len(self.data[pointer])
+        while tl < size and pointer < len(self._chunks):
+            tl += len(self._chunks[pointer])
             pointer += 1
-        res = self.join_with.join((self.data[i] for i in range(pointer)))
+        res = self.join_with.join((self._chunks[i] for i in range(pointer)))
         return res[:size]
-            
-    
-    def has_values(self):
-        return len(self.data) > 0 and any(map(lambda x: len(x)>0, self.data))
-
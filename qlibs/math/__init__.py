@@ -1,4 +1,5 @@
 from .matrix import Matrix4, IDENTITY
-from .vec import IVec, MVec, Vec, Vec2
+from .vec import IVec, MVec, VecBase, Vec, Vec2, Vec2View
+from .vecarray import VecArray, Vec2Array
 
-__all__ = ["VecBase", "Vec", "Vec2", "Matrix4", "IDENTITY"]
\ No newline at end of file
+__all__ = ["VecBase", "Vec", "Vec2", "Vec2View", "VecArray", "Vec2Array", "Matrix4", "IDENTITY"]
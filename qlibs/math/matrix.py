@@ -3,15 +3,53 @@
 """
 
 from array import array
+from enum import IntEnum
 import math
 import sys
 
 from .vec import IVec, MVec as Vec
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 ZEROS_16 = [0] * 16
 IDENTITY = [1, 0, 0, 0, 0, 1, 0, 0, 0, 0, 1, 0, 0, 0, 0, 1]
 
-__all__ = ["Matrix4"]
+#Batches smaller than this are multiplied in pure python even when numpy is available
+NUMPY_BATCH_THRESHOLD = 16
+
+__all__ = ["Matrix4", "Matrix4Array", "MatrixKind"]
+
+
+class MatrixKind(IntEnum):
+    """
+    What is known about matrix structure. Set by matrix constructors, used to pick a faster inverse.
+    Changing any element of matrix resets it to GENERIC.
+    """
+    GENERIC = 0
+    AFFINE = 1       #Last row is (0, 0, 0, 1)
+    RIGID = 2        #Rotation followed by translation
+    ROTATION = 3     #Orthonormal rotation
+    TRANSLATION = 4
+    SCALE = 5        #Uniform scale
+    PERSPECTIVE = 6  #Made by perspective_projection
+
+
+_RIGID_KINDS = (MatrixKind.RIGID, MatrixKind.ROTATION, MatrixKind.TRANSLATION)
+_AFFINE_KINDS = _RIGID_KINDS + (MatrixKind.AFFINE, MatrixKind.SCALE)
+
+def _kind_of_product(a, b):
+    if a == b and a in _AFFINE_KINDS and a != MatrixKind.AFFINE:
+        return a
+    if a in _RIGID_KINDS and b in _RIGID_KINDS:
+        return MatrixKind.RIGID
+    if a in _AFFINE_KINDS and b in _AFFINE_KINDS:
+        return MatrixKind.AFFINE
+    return MatrixKind.GENERIC
+
+_KIND_PRODUCT = {(a, b): _kind_of_product(a, b) for a in MatrixKind for b in MatrixKind}
 
 def _gauss_jordan(m, eps = 1.0/(10**10)):
   """Puts given matrix (2D array) into the Reduced Row Echelon Form.
@@ -52,10 +90,121 @@ def _inv(M):
   # extract the appended matrix (kind of m2[m:,...]
   return [row[len(M[0]):] for row in m2] if _gauss_jordan(m2) else None
 
+
+def _product(a, b):
+    """
+    Returns elements of *a* @ *b*, where *a* and *b* are 16 element sequences
+    """
+    a0, a1, a2, a3, a4, a5, a6, a7, a8, a9, a10, a11, a12, a13, a14, a15 = a
+    b0, b1, b2, b3, b4, b5, b6, b7, b8, b9, b10, b11, b12, b13, b14, b15 = b
+    return (
+        b0*a0 + b1*a4 + b2*a8 + b3*a12,
+        b0*a1 + b1*a5 + b2*a9 + b3*a13,
+        b0*a2 + b1*a6 + b2*a10 + b3*a14,
+        b0*a3 + b1*a7 + b2*a11 + b3*a15,
+        b4*a0 + b5*a4 + b6*a8 + b7*a12,
+        b4*a1 + b5*a5 + b6*a9 + b7*a13,
+        b4*a2 + b5*a6 + b6*a10 + b7*a14,
+        b4*a3 + b5*a7 + b6*a11 + b7*a15,
+        b8*a0 + b9*a4 + b10*a8 + b11*a12,
+        b8*a1 + b9*a5 + b10*a9 + b11*a13,
+        b8*a2 + b9*a6 + b10*a10 + b11*a14,
+        b8*a3 + b9*a7 + b10*a11 + b11*a15,
+        b12*a0 + b13*a4 + b14*a8 + b15*a12,
+        b12*a1 + b13*a5 + b14*a9 + b15*a13,
+        b12*a2 + b13*a6 + b14*a10 + b15*a14,
+        b12*a3 + b13*a7 + b14*a11 + b15*a15,
+    )
+
+
+def _affine_inverse(d, orthonormal, eps=1.0/(10**10)):
+    """
+    Returns elements of inverse of affine matrix with elements *d*, or None if it is singular.
+    If *orthonormal* is True, upper 3x3 part is inverted by transposing it.
+    """
+    if orthonormal:
+        inv = [[d[r*4+c] for c in range(3)] for r in range(3)]
+    else:
+        a, b, c = d[0], d[4], d[8]
+        e, f, g = d[1], d[5], d[9]
+        h, i, j = d[2], d[6], d[10]
+        det = a*(f*j - g*i) - b*(e*j - g*h) + c*(e*i - f*h)
+        if abs(det) <= eps:
+            return None
+        inv = [
+            [(f*j - g*i)/det, -(b*j - c*i)/det, (b*g - c*f)/det],
+            [-(e*j - g*h)/det, (a*j - c*h)/det, -(a*g - c*e)/det],
+            [(e*i - f*h)/det, -(a*i - b*h)/det, (a*f - b*e)/det],
+        ]
+    t = d[12], d[13], d[14]
+    res = [0.0] * 16
+    for r in range(3):
+        for c in range(3):
+            res[c*4+r] = inv[r][c]
+        res[12+r] = -(inv[r][0]*t[0] + inv[r][1]*t[1] + inv[r][2]*t[2])
+    res[15] = 1.0
+    return res
+
+
+def _perspective_inverse(d):
+    """
+    Returns elements of inverse of matrix made by perspective_projection_lrbtnf
+    """
+    E, F, A, B, C, D = d[0], d[5], d[8], d[9], d[10], d[14]
+    return [1/E, 0, 0, 0, 0, 1/F, 0, 0, 0, 0, 0, 1/D, A/E, B/F, -1, C/D]
+
+
+def _matrix_data(matrix):
+    """
+    Returns 16 element array of *matrix*, works for both python and C matrices
+    """
+    data = getattr(matrix, "_data", None)
+    if data is None:
+        data = array('f')
+        data.frombytes(matrix.bytes())
+    return data
+
+
+def _batch_product(single, stack, single_first, out):
+    """
+    Computes *single* @ m (if *single_first*) or m @ *single* for every m in *stack* (Matrix4Array)
+    Result is written to *out* (Matrix4Array of the same length) if it is not None
+    """
+    single = _matrix_data(single)
+    data = stack._data
+    if out is not None and len(out._data) != len(data):
+        raise ValueError("Output array should have the same length as input")
+
+    if numpy is not None and len(data) >= 16 * NUMPY_BATCH_THRESHOLD:
+        #Data layout is row major in numpy terms, with a @ b being b_np @ a_np
+        np_single = numpy.array(single, dtype=numpy.float32).reshape(4, 4)
+        np_stack = numpy.frombuffer(data, dtype=numpy.float32).reshape(-1, 4, 4)
+        if out is None:
+            out = Matrix4Array(bytes(len(data) * 4))
+        np_out = numpy.frombuffer(out._data, dtype=numpy.float32).reshape(-1, 4, 4)
+        if single_first:
+            numpy.matmul(np_stack, np_single, out=np_out)
+        else:
+            numpy.matmul(np_single, np_stack, out=np_out)
+        return out
+
+    res = array('f')
+    if single_first:
+        for i in range(0, len(data), 16):
+            res.extend(_product(single, data[i:i+16]))
+    else:
+        for i in range(0, len(data), 16):
+            res.extend(_product(data[i:i+16], single))
+    if out is None:
+        return Matrix4Array._wrap(res)
+    out._data[:] = res
+    return out
+
+
 class _PyMatrix4Base:
-    __slots__ = ("_data",)
+    __slots__ = ("_data", "kind", "_inverse")
 
-    def __init__(self, data=None):
+    def __init__(self, data=None, kind=MatrixKind.GENERIC):
         """
         Initialize matrix with 16 elements array (*data*) of *dtype* type
         """
@@ -63,6 +212,8 @@ class _PyMatrix4Base:
             self._data = array('f', data)
         else:
             self._data = array('f', ZEROS_16)
+        self.kind = kind
+        self._inverse = None
     
     def __getitem__(self, key):
         x, y = key
@@ -73,15 +224,19 @@ class _PyMatrix4Base:
         x, y = key
         assert 0 <= x < 4 and 0 <= y < 4
         self._data[x * 4 + y] = value
+        self.kind = MatrixKind.GENERIC
+        self._inverse = None
 
     def __eq__(self, other):
         return self._data == other._data
 
     def bytes(self, dtype="f"):
         """
-        Converts internal array to bytes
+        Converts internal array to bytes of *dtype* items
         """
-        return self._data.tobytes()
+        if dtype == self._data.typecode:
+            return self._data.tobytes()
+        return array(dtype, self._data).tobytes()
 
     def __repr__(self):
         if list(self._data) == IDENTITY:
@@ -91,112 +246,15 @@ class _PyMatrix4Base:
         return f"Matrix4({list(self._data)})"
 
     def __matmul__(self, other):
-        res = self.__class__()
-
-        res._data[0] = (
-            other._data[0] * self._data[0]
-            + other._data[1] * self._data[4]
-            + other._data[2] * self._data[8]
-            + other._data[3] * self._data[12]
-        )
-        res._data[1] = (
-            other._data[0] * self._data[1]
-            + other._data[1] * self._data[5]
-            + other._data[2] * self._data[9]
-            + other._data[3] * self._data[13]
-        )
-        res._data[2] = (
-            other._data[0] * self._data[2]
-            + other._data[1] * self._data[6]
-            + other._data[2] * self._data[10]
-            + other._data[3] * self._data[14]
-        )
-        res._data[3] = (
-            other._data[0] * self._data[3]
-            + other._data[1] * self._data[7]
-            + other._data[2] * self._data[11]
-            + other._data[3] * self._data[15]
-        )
-        res._data[4] = (
-            other._data[4] * self._data[0]
-            + other._data[5] * self._data[4]
-            + other._data[6] * self._data[8]
-            + other._data[7] * self._data[12]
-        )
-        res._data[5] = (
-            other._data[4] * self._data[1]
-            + other._data[5] * self._data[5]
-            + other._data[6] * self._data[9]
-            + other._data[7] * self._data[13]
-        )
-        res._data[6] = (
-            other._data[4] * self._data[2]
-            + other._data[5] * self._data[6]
-            + other._data[6] * self._data[10]
-            + other._data[7] * self._data[14]
-        )
-        res._data[7] = (
-            other._data[4] * self._data[3]
-            + other._data[5] * self._data[7]
-            + other._data[6] * self._data[11]
-            + other._data[7] * self._data[15]
-        )
-        res._data[8] = (
-            other._data[8] * self._data[0]
-            + other._data[9] * self._data[4]
-            + other._data[10] * self._data[8]
-            + other._data[11] * self._data[12]
-        )
-        res._data[9] = (
-            other._data[8] * self._data[1]
-            + other._data[9] * self._data[5]
-            + other._data[10] * self._data[9]
-            + other._data[11] * self._data[13]
-        )
-        res._data[10] = (
-            other._data[8] * self._data[2]
-            + other._data[9] * self._data[6]
-            + other._data[10] * self._data[10]
-            + other._data[11] * self._data[14]
-        )
-        res._data[11] = (
-            other._data[8] * self._data[3]
-            + other._data[9] * self._data[7]
-            + other._data[10] * self._data[11]
-            + other._data[11] * self._data[15]
-        )
-        res._data[12] = (
-            other._data[12] * self._data[0]
-            + other._data[13] * self._data[4]
-            + other._data[14] * self._data[8]
-            + other._data[15] * self._data[12]
-        )
-        res._data[13] = (
-            other._data[12] * self._data[1]
-            + other._data[13] * self._data[5]
-            + other._data[14] * self._data[9]
-            + other._data[15] * self._data[13]
-        )
-        res._data[14] = (
-            other._data[12] * self._data[2]
-            + other._data[13] * self._data[6]
-            + other._data[14] * self._data[10]
-            + other._data[15] * self._data[14]
-        )
-        res._data[15] = (
-            other._data[12] * self._data[3]
-            + other._data[13] * self._data[7]
-            + other._data[14] * self._data[11]
-            + other._data[15] * self._data[15]
-        )
-
-        return res
+        return self.__class__(_product(self._data, other._data), _KIND_PRODUCT[self.kind, other.kind])
 
 
 class _Matrix4Methods():
     """
     4 by 4 Matrix class which allows [i, j] indexing
     """
+    kind = MatrixKind.GENERIC
+    _inverse = None
 
     def __str__(self):
         lst = (
@@ -235,11 +293,7 @@ class _Matrix4Methods():
         """
         Creates matrix that translates vectors by *x*, *y*, *z*
         """
-        mat = cls(IDENTITY)
-        mat[3, 0] = x
-        mat[3, 1] = y
-        mat[3, 2] = z
-        return mat
+        return cls([1, 0, 0, 0, 0, 1, 0, 0, 0, 0, 1, 0, x, y, z, 1], MatrixKind.TRANSLATION)
 
     @classmethod
     def look_at(cls, eye: Vec, center: Vec, up: Vec):
@@ -252,7 +306,8 @@ class _Matrix4Methods():
         f = (center - eye).normalized()
         u = up.normalized()
         s = f.cross(u)
-        if s.len_sqr() > 0:
+        orthonormal = s.len_sqr() > 0
+        if orthonormal:
             s = s.normalized()
         u = s.cross(f)
 
@@ -268,6 +323,8 @@ class _Matrix4Methods():
         res[3, 0] = -s.dot(eye)
         res[3, 1] = -u.dot(eye)
         res[3, 2] = f.dot(eye)
+        if orthonormal:
+            res.kind = MatrixKind.RIGID
 
         return res
 
@@ -281,7 +338,7 @@ class _Matrix4Methods():
             0, 2/(t-b), 0, 0,
             0, 0, -2/(f-n), 0,
             -(r+l)/(r-l), -(t+b)/(t-b), -(f+n)/(f-n), 1
-        ])
+        ], MatrixKind.AFFINE)
         return mat
 
     @classmethod
@@ -307,7 +364,7 @@ class _Matrix4Methods():
         E = 2 * near / (right - left)
         F = 2 * near / (top - bottom)
 
-        return cls([E, 0, 0, 0, 0, F, 0, 0, A, B, C, -1, 0, 0, D, 0])  # TODO
+        return cls([E, 0, 0, 0, 0, F, 0, 0, A, B, C, -1, 0, 0, D, 0], MatrixKind.PERSPECTIVE)  # TODO
 
     @classmethod
     def rotation_euler(cls, pitch, roll, yaw):
@@ -340,7 +397,8 @@ class _Matrix4Methods():
                 0,
                 0,
                 1,
-            ]
+            ],
+            MatrixKind.ROTATION,
         )
     
     @classmethod
@@ -348,17 +406,52 @@ class _Matrix4Methods():
         """
         Creates matrix that scales by *by*
         """
-        return Matrix4([by, 0, 0, 0, 0, by, 0, 0, 0, 0, by, 0, 0, 0, 0, 1])
+        return Matrix4([by, 0, 0, 0, 0, by, 0, 0, 0, 0, by, 0, 0, 0, 0, 1], MatrixKind.SCALE)
     
     def transpose(self):
+        kind = MatrixKind.ROTATION if self.kind == MatrixKind.ROTATION else MatrixKind.GENERIC
         return Matrix4([
             self[0,0], self[1,0], self[2,0], self[3,0],
             self[0,1], self[1,1], self[2,1], self[3,1],
             self[0,2], self[1,2], self[2,2], self[3,2],
             self[0,3], self[1,3], self[2,3], self[3,3],
-        ])        
+        ], kind)
+
+    def copy(self):
+        return self.__class__(_matrix_data(self), self.kind)
+
+    def batch_matmul(self, stack, out=None):
+        """
+        Multiplies this matrix by every matrix of *stack* (**Matrix4Array**) in one call,
+        same as `Matrix4Array([self @ m for m in stack])`.
+        Result is written to *out* if it is specified, otherwise new **Matrix4Array** is created.
+        Uses numpy for large batches when it is available.
+        """
+        return _batch_product(self, stack, True, out)
 
     def inverse(self):
+        """
+        Returns inverse matrix, or None if matrix is singular.
+        Matrices with known kind are inverted in closed form. Result is cached until matrix is changed.
+        """
+        cached = self._inverse
+        if cached is None:
+            cached = self._calc_inverse()
+            if cached is None:
+                return None
+            self._inverse = cached
+        return cached.copy()
+
+    def _calc_inverse(self):
+        kind = self.kind
+        if kind == MatrixKind.TRANSLATION:
+            return Matrix4([1, 0, 0, 0, 0, 1, 0, 0, 0, 0, 1, 0, -self[3, 0], -self[3, 1], -self[3, 2], 1], kind)
+        if kind in _AFFINE_KINDS:
+            res = _affine_inverse(_matrix_data(self), orthonormal=kind in _RIGID_KINDS)
+            return None if res is None else Matrix4(res, kind)
+        if kind == MatrixKind.PERSPECTIVE:
+            return Matrix4(_perspective_inverse(_matrix_data(self)))
+
         m = [[self[i,j] for j in range(4)] for i in range(4)]
         r = []
         res = _inv(m)
@@ -372,6 +465,94 @@ class _Matrix4Methods():
         return self.bytes()
 
 
+class Matrix4Array:
+    """
+    Packed array of 4 by 4 matrices, each stored the same way as in **Matrix4**.
+    Can be written directly to uniform or instance buffers using bytes().
+    """
+    __slots__ = ("_data",)
+
+    def __init__(self, data=()):
+        """
+        Initialize array from flat iterable (or bytes) *data*, 16 elements per matrix
+        """
+        self._data = array('f', data)
+        if len(self._data) % 16 != 0:
+            raise ValueError("Data length should be a multiple of 16")
+
+    @classmethod
+    def _wrap(cls, data):
+        res = cls.__new__(cls)
+        res._data = data
+        return res
+
+    @classmethod
+    def from_matrices(cls, matrices):
+        """
+        Packs iterable of matrices into an array
+        """
+        data = array('f')
+        for matrix in matrices:
+            data.extend(_matrix_data(matrix))
+        return cls._wrap(data)
+
+    def __len__(self):
+        return len(self._data) // 16
+
+    def _offset(self, key):
+        n = len(self)
+        if key < 0:
+            key += n
+        if not 0 <= key < n:
+            raise IndexError("Matrix4Array index out of range")
+        return key * 16
+
+    def __getitem__(self, key):
+        """
+        Returns copy of *key*-th matrix
+        """
+        offset = self._offset(key)
+        return Matrix4(self._data[offset:offset+16])
+
+    def __setitem__(self, key, matrix):
+        offset = self._offset(key)
+        self._data[offset:offset+16] = _matrix_data(matrix)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __eq__(self, other):
+        if not isinstance(other, Matrix4Array):
+            return NotImplemented
+        return self._data == other._data
+
+    def __repr__(self):
+        return f"Matrix4Array({self._data.tolist()})"
+
+    def append(self, matrix):
+        self._data.extend(_matrix_data(matrix))
+
+    def __matmul__(self, other):
+        """
+        Multiplies every matrix of this array by *other* matrix
+        """
+        if isinstance(other, Matrix4Array):
+            return NotImplemented
+        return _batch_product(other, self, False, None)
+
+    def bytes(self, dtype="f"):
+        """
+        Converts internal array to bytes of *dtype* items
+        """
+        if dtype == self._data.typecode:
+            return self._data.tobytes()
+        return array(dtype, self._data).tobytes()
+
+    def __bytes__(self):
+        return self.bytes()
+
+
 class PyMatrix4(_PyMatrix4Base, _Matrix4Methods):
     pass
 
@@ -384,10 +565,17 @@ except ImportError:
     print("It appears that Qlibs Cyan is not installed, performace will be worse without it", file=sys.stderr) #TODO think of something better
 else:
     class Matrix4(_CMatrix4Base, _Matrix4Methods):
-        def __init__(self, data=None):
+        def __init__(self, data=None, kind=MatrixKind.GENERIC):
             if data is not None:
                 ind = 0
                 for i in range(4):
                     for j in range(4):
                         self[i,j] = data[ind]
                         ind += 1
+            self.kind = kind
+            self._inverse = None
+
+        def __setitem__(self, key, value):
+            super().__setitem__(key, value)
+            self.kind = MatrixKind.GENERIC
+            self._inverse = None
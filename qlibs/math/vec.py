@@ -60,17 +60,27 @@ print(v0.dot(v1))
 #Normalize divides vector by it's length, so it will have length of 1
 v0.normalize()
 assert v0.len() == 1
+
+#In-place operators change vector itself instead of creating a new one
+v0 += v1
+v0 *= 2
+#Methods with explicit output vector don't allocate either
+out = Vec(0, 0)
+v0.add_into(v1, out)     #out = v0 + v1
+v0.lerp_into(v1, 0.5, out) #out = v0 + (v1 - v0) * 0.5
+v0.axpy(0.5, v1)         #v0 += 0.5 * v1
 ```
 """
 
 import math
+import operator
 from numbers import Number
 from array import array
 from typing import Iterable
 
 import warnings
 #from ..net.qpacket import conv_lookup, convert, make_qlibs_obj_id
-__all__ = ["VecBase", "Vec", "Vec2"]
+__all__ = ["VecBase", "Vec", "Vec2", "Vec2View"]
 
 VERTNAMES = {"x": 0, "y": 1, "z": 2, "w": 3}
 NUMERICAL = Number
@@ -123,7 +133,7 @@ class VecBase:
             raise ValueError(f"Could not add {repr(self)} to {repr(other)}") from e
 
     def __iadd__(self, other):
-        return self.__add__(other)
+        return self._inplace(other, operator.add, "add")
 
     def __sub__(self, other):
         try:
@@ -132,7 +142,7 @@ class VecBase:
             raise ValueError(f"Could not substract {other} from {self}") from e
 
     def __isub__(self, other):
-        return self.__sub__(other)
+        return self._inplace(other, operator.sub, "substract")
 
     def __mul__(self, other):
         if isinstance(other, VecBase):
@@ -143,7 +153,7 @@ class VecBase:
             return NotImplemented
 
     def __imul__(self, other):
-        return self.__mul__(other)
+        return self._inplace(other, operator.mul, "multiply", scalar=True)
 
     def __truediv__(self, other):
         if isinstance(other, VecBase):
@@ -154,18 +164,79 @@ class VecBase:
             raise TypeError("Cannot true divide vector by " + str(type(other)))
 
     def __itruediv__(self, other):
-        return self.__truediv__(other)
+        return self._inplace(other, operator.truediv, "true divide", scalar=True)
 
     def __floordiv__(self, other):
         if isinstance(other, VecBase):
-            return self.map_by_verticle(other, lambda x, y: x / y)
+            return self.map_by_verticle(other, lambda x, y: x // y)
         elif isinstance(other, NUMERICAL):
             return self.__class__(*map(lambda x: x // other, self))
         else:
             raise TypeError("Cannot floor divide vector by " + str(type(other)))
 
     def __ifloordiv__(self, other):
-        return self.__floordiv__(other)
+        return self._inplace(other, operator.floordiv, "floor divide", scalar=True)
+
+    def _inplace(self, other, op, name, scalar=False):
+        """
+        Applies *op* to every element of vector in-place, with other being either vector or number (if *scalar*)
+        """
+        if scalar and isinstance(other, NUMERICAL):
+            for i, v in enumerate(self):
+                self[i] = op(v, other)
+            return self
+        try:
+            if len(self) != len(other):
+                raise ValueError("wrong dimensions")
+            for i, v in enumerate(other):
+                self[i] = op(self[i], v)
+        except Exception as e:
+            raise ValueError(f"Could not {name} {repr(self)} and {repr(other)} in-place") from e
+        return self
+
+    def add_into(self, other, out):
+        """
+        Writes *self* + *other* into *out* vector and returns it, without allocating new vector
+        """
+        for i, (v1, v2) in enumerate(zip(self, other)):
+            out[i] = v1 + v2
+        return out
+
+    def sub_into(self, other, out):
+        """
+        Writes *self* - *other* into *out* vector and returns it, without allocating new vector
+        """
+        for i, (v1, v2) in enumerate(zip(self, other)):
+            out[i] = v1 - v2
+        return out
+
+    def mul_into(self, other, out):
+        """
+        Writes *self* * *other* (number or vector) into *out* vector and returns it, without allocating new vector
+        """
+        if isinstance(other, NUMERICAL):
+            for i, v in enumerate(self):
+                out[i] = v * other
+        else:
+            for i, (v1, v2) in enumerate(zip(self, other)):
+                out[i] = v1 * v2
+        return out
+
+    def axpy(self, k, other):
+        """
+        Adds *other* multiplied by *k* to vector in-place (self += k*other) and returns it
+        """
+        for i, v in enumerate(other):
+            self[i] += k * v
+        return self
+
+    def lerp_into(self, other, t, out):
+        """
+        Writes linear interpolation from *self* (*t* = 0) to *other* (*t* = 1) into *out* vector and returns it
+        """
+        for i, (v1, v2) in enumerate(zip(self, other)):
+            out[i] = v1 + (v2 - v1) * t
+        return out
 
     def __pos__(self):
         return self.__class__(*self)
@@ -211,9 +282,9 @@ class VecBase:
 
     def as_n_d(self, n):
         if n <= len(self):
-            return self.__class__(self._v[:n])
+            return self.__class__(list(self._v[:n]))
         else:
-            return self.__class__(self._v + ([0] * (n - len(self))))
+            return self.__class__(list(self._v) + ([0] * (n - len(self))))
 
     def in_box(self, a, b):
         return all(av <= v <= bv for v, av, bv in zip(self, a, b))
@@ -235,6 +306,22 @@ class Vec(VecBase):  # Making those immutable is a good idea, right? (No)
         #for v in self.v:
         #    assert isinstance(v, Number)
 
+    @classmethod
+    def view(cls, buffer, offset=0, size=None):
+        """
+        Creates vector which uses *size* elements of *buffer*, starting at *offset*, as it's components.
+        Changes to vector are visible in *buffer* and vice versa; no data is copied.
+        *buffer* should support buffer protocol, for example `array` or **VecArray** storage.
+        """
+        mv = memoryview(buffer)
+        if size is None:
+            size = len(mv) - offset
+        if offset < 0 or size < 0 or offset + size > len(mv):
+            raise IndexError("View is out of buffer bounds")
+        vec = cls.__new__(cls)
+        vec._v = mv[offset:offset+size]
+        return vec
+
     def normalize(self):
         ln = self.len()
         for i, e in enumerate(self):
@@ -267,7 +354,7 @@ class Vec(VecBase):  # Making those immutable is a good idea, right? (No)
         else:
             super().__setattr__(name, value)
 
-    def __getstate__(self): return self._v
+    def __getstate__(self): return list(self._v)
     def __setstate__(self, d): self._v = d
 
 
@@ -307,6 +394,68 @@ class Vec2(VecBase):
 
     def __add__(self, oth):
         return Vec2(self.x+oth.x, self.y+oth.y)
+
+    def __iadd__(self, oth):
+        self.x += oth.x
+        self.y += oth.y
+        return self
+
+    def __isub__(self, oth):
+        self.x -= oth.x
+        self.y -= oth.y
+        return self
+
+    def __imul__(self, oth):
+        if isinstance(oth, NUMERICAL):
+            self.x *= oth
+            self.y *= oth
+        elif isinstance(oth, VecBase):
+            self.x *= oth.x
+            self.y *= oth.y
+        else:
+            return NotImplemented
+        return self
+
+    def __itruediv__(self, oth):
+        if isinstance(oth, NUMERICAL):
+            self.x /= oth
+            self.y /= oth
+        elif isinstance(oth, VecBase):
+            self.x /= oth.x
+            self.y /= oth.y
+        else:
+            raise TypeError("Cannot true divide vector by " + str(type(oth)))
+        return self
+
+    def add_into(self, oth, out):
+        out.x = self.x + oth.x
+        out.y = self.y + oth.y
+        return out
+
+    def sub_into(self, oth, out):
+        out.x = self.x - oth.x
+        out.y = self.y - oth.y
+        return out
+
+    def mul_into(self, oth, out):
+        if isinstance(oth, NUMERICAL):
+            out.x = self.x * oth
+            out.y = self.y * oth
+        else:
+            out.x = self.x * oth.x
+            out.y = self.y * oth.y
+        return out
+
+    def axpy(self, k, oth):
+        self.x += k * oth.x
+        self.y += k * oth.y
+        return self
+
+    def lerp_into(self, oth, t, out):
+        x, y = self.x, self.y
+        out.x = x + (oth.x - x) * t
+        out.y = y + (oth.y - y) * t
+        return out
     
     def __neg__(self):
         return self.__class__(-self.x, -self.y)
@@ -337,6 +486,47 @@ class Vec2(VecBase):
         return Vec2(self.x, self.y)
 
 
+class Vec2View(Vec2):
+    """
+    **Vec2** which keeps it's components in external buffer, for example in a row of **Vec2Array**.
+    Changes to vector are visible in buffer and vice versa. Inherits **Vec2**.
+    """
+    __slots__ = ("_v",)
+    def __init__(self, x, y):
+        self._v = [x, y]
+
+    @classmethod
+    def view(cls, buffer, offset=0):
+        """
+        Creates vector which uses two elements of *buffer*, starting at *offset*, as it's components.
+        """
+        mv = memoryview(buffer)
+        if offset < 0 or offset + 2 > len(mv):
+            raise IndexError("View is out of buffer bounds")
+        vec = cls.__new__(cls)
+        vec._v = mv[offset:offset+2]
+        return vec
+
+    @property
+    def x(self):
+        return self._v[0]
+
+    @x.setter
+    def x(self, value):
+        self._v[0] = value
+
+    @property
+    def y(self):
+        return self._v[1]
+
+    @y.setter
+    def y(self, value):
+        self._v[1] = value
+
+    def __reduce__(self):
+        return (Vec2, (self.x, self.y))
+
+
 MVec = Vec
 IVec = Vec
 #conv_lookup.register(IVec, make_qlibs_obj_id(1))
@@ -0,0 +1,341 @@
+"""
+## Overview
+
+Vector arrays store many vectors of the same dimension in one contiguous `array`,
+so that bulk operations don't create a Python object per vector.
+
+```python
+from qlibs.math import Vec2, Vec2Array
+
+positions = Vec2Array.zeros(10000)
+velocities = Vec2Array.zeros(10000)
+velocities += Vec2(1, 0)        #Applied to every row
+positions += velocities * 0.5   #Elementwise
+buffer.write(positions.bytes()) #Can be uploaded directly to moderngl buffer
+
+#Rows are views, changing them changes the array
+positions[0].x = 10
+```
+"""
+
+import math
+import operator
+from array import array
+from functools import reduce
+from itertools import cycle, repeat
+from numbers import Number
+
+from .vec import VecBase, Vec, Vec2View
+
+__all__ = ["VecArray", "Vec2Array"]
+
+NUMERICAL = Number
+
+
+class VecArray:
+    """
+    Array of *dim*-dimensional vectors, stored in one flat `array` of *dtype* type.
+
+    Elementwise operations accept another array of the same shape, a single vector
+    (which is applied to every row) or a number.
+    """
+    __slots__ = ("_data", "dim")
+
+    def __init__(self, dim, data=(), dtype="f"):
+        """
+        Initialize array of *dim*-dimensional vectors from flat iterable *data*
+        """
+        if dim <= 0:
+            raise ValueError("Dimension should be positive")
+        self.dim = dim
+        self._data = array(dtype, data)
+        if len(self._data) % dim != 0:
+            raise ValueError(f"Data length {len(self._data)} is not a multiple of {dim}")
+
+    @classmethod
+    def _wrap(cls, dim, data):
+        res = cls.__new__(cls)
+        res.dim = dim
+        res._data = data
+        return res
+
+    def _same(self, data):
+        return self._wrap(self.dim, data)
+
+    @classmethod
+    def zeros(cls, count, dim, dtype="f"):
+        """
+        Creates array of *count* zero vectors
+        """
+        return cls._wrap(dim, array(dtype, bytes(array(dtype).itemsize * count * dim)))
+
+    @classmethod
+    def from_vectors(cls, vectors, dtype="f"):
+        """
+        Creates array from iterable of vectors of the same dimension
+        """
+        vectors = list(vectors)
+        if len(vectors) == 0:
+            raise ValueError("Can't guess dimension of empty array")
+        dim = len(vectors[0])
+        data = array(dtype)
+        for vec in vectors:
+            if len(vec) != dim:
+                raise ValueError(f"Expected {dim}-dimensional vector, got {vec!r}")
+            data.extend(vec)
+        return cls._wrap(dim, data)
+
+    @property
+    def dtype(self):
+        return self._data.typecode
+
+    @property
+    def data(self):
+        """Underlying flat array"""
+        return self._data
+
+    def __len__(self):
+        return len(self._data) // self.dim
+
+    def _offset(self, key):
+        n = len(self)
+        if key < 0:
+            key += n
+        if not 0 <= key < n:
+            raise IndexError("VecArray index out of range")
+        return key * self.dim
+
+    def __getitem__(self, key):
+        """Returns **Vec** which views *key*-th row, without copying"""
+        return Vec.view(self._data, self._offset(key), self.dim)
+
+    def __setitem__(self, key, value):
+        if len(value) != self.dim:
+            raise ValueError(f"Expected {self.dim}-dimensional vector, got {value!r}")
+        offset = self._offset(key)
+        self._data[offset:offset+self.dim] = array(self._data.typecode, value)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __eq__(self, other):
+        if not isinstance(other, VecArray):
+            return NotImplemented
+        return self.dim == other.dim and self._data == other._data
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.dim}, {self._data.tolist()})"
+
+    def copy(self):
+        return self._same(array(self._data.typecode, self._data))
+
+    def column(self, index):
+        """
+        Returns copy of *index*-th component of every vector
+        """
+        return self._data[index::self.dim]
+
+    def _columns(self):
+        data, dim = self._data, self.dim
+        return [data[i::dim] for i in range(dim)]
+
+    def bytes(self, dtype="f"):
+        """
+        Converts internal array to bytes, suitable for writing to moderngl buffers
+        """
+        if dtype == self._data.typecode:
+            return self._data.tobytes()
+        return array(dtype, self._data).tobytes()
+
+    def _operand(self, other):
+        """
+        Returns iterable which is aligned with internal array, or None if *other* is not supported
+        """
+        if isinstance(other, VecArray):
+            if other.dim != self.dim or len(other._data) != len(self._data):
+                raise ValueError(f"Shape mismatch: {len(self)}x{self.dim} and {len(other)}x{other.dim}")
+            return other._data
+        if isinstance(other, VecBase):
+            if len(other) != self.dim:
+                raise ValueError(f"Expected {self.dim}-dimensional vector, got {other!r}")
+            return cycle(other)
+        if isinstance(other, NUMERICAL):
+            return repeat(other)
+        return None
+
+    def _binary(self, other, op):
+        operand = self._operand(other)
+        if operand is None:
+            return NotImplemented
+        return self._same(array(self._data.typecode, map(op, self._data, operand)))
+
+    def _inplace(self, other, op):
+        operand = self._operand(other)
+        if operand is None:
+            return NotImplemented
+        self._data[:] = array(self._data.typecode, map(op, self._data, operand))
+        return self
+
+    def __add__(self, other):
+        return self._binary(other, operator.add)
+
+    def __radd__(self, other):
+        return self._binary(other, operator.add)
+
+    def __iadd__(self, other):
+        return self._inplace(other, operator.add)
+
+    def __sub__(self, other):
+        return self._binary(other, operator.sub)
+
+    def __rsub__(self, other):
+        operand = self._operand(other)
+        if operand is None:
+            return NotImplemented
+        return self._same(array(self._data.typecode, map(operator.sub, operand, self._data)))
+
+    def __isub__(self, other):
+        return self._inplace(other, operator.sub)
+
+    def __mul__(self, other):
+        return self._binary(other, operator.mul)
+
+    def __rmul__(self, other):
+        return self._binary(other, operator.mul)
+
+    def __imul__(self, other):
+        return self._inplace(other, operator.mul)
+
+    def __truediv__(self, other):
+        return self._binary(other, operator.truediv)
+
+    def __itruediv__(self, other):
+        return self._inplace(other, operator.truediv)
+
+    def __neg__(self):
+        return self._same(array(self._data.typecode, map(operator.neg, self._data)))
+
+    def dot(self, other):
+        """
+        Returns array of dot products of every row with *other* (array or single vector)
+        """
+        if isinstance(other, VecArray):
+            self._operand(other)
+            other_columns = other._columns()
+        elif isinstance(other, VecBase):
+            self._operand(other)
+            other_columns = [repeat(v) for v in other]
+        else:
+            raise TypeError("Can only compute dot product with vector or VecArray")
+        products = [map(operator.mul, a, b) for a, b in zip(self._columns(), other_columns)]
+        return array(self._data.typecode, reduce(lambda acc, it: map(operator.add, acc, it), products))
+
+    def len_sqr(self):
+        """
+        Returns array of squared lengths of every row
+        """
+        squares = [map(operator.mul, col, col) for col in self._columns()]
+        return array(self._data.typecode, reduce(lambda acc, it: map(operator.add, acc, it), squares))
+
+    def len(self):
+        """
+        Returns array of lengths of every row
+        """
+        return array(self._data.typecode, map(math.hypot, *self._columns()))
+
+    def normalize(self):
+        """
+        Normalizes every row in-place. Rows with zero length are left as they are.
+        """
+        inv = [1 / ln if ln else 1.0 for ln in self.len()]
+        data, dim, tc = self._data, self.dim, self._data.typecode
+        for i in range(dim):
+            data[i::dim] = array(tc, map(operator.mul, data[i::dim], inv))
+
+    def normalized(self):
+        """
+        Returns a normalized copy of array
+        """
+        res = self.copy()
+        res.normalize()
+        return res
+
+    def in_box(self, a, b):
+        """
+        Returns list of bools, which are True for rows inside of box with corners *a* and *b*
+        """
+        cols = self._columns()
+        res = [True] * len(self)
+        for col, av, bv in zip(cols, a, b):
+            res = list(map(lambda r, v: r and av <= v <= bv, res, col))
+        return res
+
+
+class Vec2Array(VecArray):
+    """
+    Array of 2-dimensional vectors. Rows are **Vec2View** instances. Inherits **VecArray**.
+    """
+    __slots__ = tuple()
+
+    def __init__(self, data=(), dtype="f"):
+        """
+        Initialize array from flat iterable *data* (x0, y0, x1, y1...)
+        """
+        super().__init__(2, data, dtype)
+
+    @classmethod
+    def zeros(cls, count, dtype="f"):
+        return super().zeros(count, 2, dtype)
+
+    @classmethod
+    def from_vectors(cls, vectors, dtype="f"):
+        res = super().from_vectors(vectors, dtype)
+        if res.dim != 2:
+            raise ValueError("Vec2Array can only contain 2-dimensional vectors")
+        return res
+
+    def __getitem__(self, key):
+        """Returns **Vec2View** of *key*-th row, without copying"""
+        return Vec2View.view(self._data, self._offset(key))
+
+    def __repr__(self):
+        return f"Vec2Array({self._data.tolist()})"
+
+    def dot(self, other):
+        if isinstance(other, VecBase) and not isinstance(other, VecArray):
+            if len(other) != 2:
+                raise ValueError(f"Expected 2-dimensional vector, got {other!r}")
+            ox, oy = other
+            return array(self._data.typecode, map(lambda x, y: x*ox + y*oy, self._data[0::2], self._data[1::2]))
+        return super().dot(other)
+
+    def len(self):
+        return array(self._data.typecode, map(math.hypot, self._data[0::2], self._data[1::2]))
+
+    def rotate(self, angle):
+        """
+        Returns copy of array with every row rotated by *angle* radians
+        """
+        c = math.cos(angle)
+        s = math.sin(angle)
+        xs = self._data[0::2]
+        ys = self._data[1::2]
+        res = array(self._data.typecode, self._data)
+        res[0::2] = array(res.typecode, map(lambda x, y: x*c - y*s, xs, ys))
+        res[1::2] = array(res.typecode, map(lambda x, y: x*s + y*c, xs, ys))
+        return self._same(res)
+
+    def perpendicular(self):
+        """
+        Returns copy of array with every row rotated by 90 degrees, same as **Vec2.perpendicular**
+        """
+        res = array(self._data.typecode, self._data)
+        res[0::2] = array(res.typecode, map(operator.neg, self._data[1::2]))
+        res[1::2] = self._data[0::2]
+        return self._same(res)
+
+    def in_box(self, a, b):
+        ax, ay = a[0], a[1]
+        bx, by = b[0], b[1]
+        return list(map(lambda x, y: ax <= x <= bx and ay <= y <= by, self._data[0::2], self._data[1::2]))
@@ -0,0 +1,380 @@
+"""
+  Level of detail generation for **OBJ** models
+
+  **simplify** repeatedly collapses the edge with the smallest quadric error (Garland and Heckbert),
+  **make_lods** makes several simplified levels, which **RenderableModel** switches between
+  by projected size of the model. Levels can be cached on disk next to the source file.
+
+```python
+model = resource_manager.load_model("models/tree.obj")
+lods = make_lods(model, path=get_res_path("models/tree.obj"))
+renderable = RenderableModel(model, scene, ctx, lods=lods)
+```
+"""
+
+import hashlib
+import heapq
+import json
+import logging
+import math
+import os
+import re
+import struct
+import sys
+from array import array
+
+from .modelloader import OBJ, _file_signature, _group
+from ..math.vec import IVec
+
+__all__ = ["simplify", "make_lod", "make_lods", "lod_cache_path", "bounding_sphere", "projected_size", "select_lod"]
+
+logger = logging.getLogger(__name__)
+
+#Fractions of faces of original model that are left in each level
+DEFAULT_LOD_RATIOS = (0.5, 0.25, 0.125)
+#Level n is drawn when model is smaller than DEFAULT_LOD_SCREEN_SIZES[n - 1] of viewport height
+DEFAULT_LOD_SCREEN_SIZES = (0.5, 0.25, 0.1)
+#Weight of planes that keep open borders of mesh in place
+BORDER_WEIGHT = 1000.0
+
+LOD_MAGIC = b"QLOD"
+LOD_VERSION = 1
+lod_header_struct = struct.Struct("!4sBBI") #magic, version, is little endian, json size
+#Object names that are used in cache file names as they are, others are hashed
+SAFE_NAME = re.compile(r"[A-Za-z0-9_\-]{1,64}")
+
+
+def _normal(p0, p1, p2):
+    """Not normalized normal of triangle, its length is twice the area"""
+    ax, ay, az = p1[0] - p0[0], p1[1] - p0[1], p1[2] - p0[2]
+    bx, by, bz = p2[0] - p0[0], p2[1] - p0[1], p2[2] - p0[2]
+    return (ay * bz - az * by, az * bx - ax * bz, ax * by - ay * bx)
+
+
+def _plane_quadric(normal, point, weight):
+    """Quadric of squared distance to plane through *point* with unit *normal*, as 10 unique values of 4x4 matrix"""
+    a, b, c = normal
+    d = -(a * point[0] + b * point[1] + c * point[2])
+    return [weight * x for x in (a*a, a*b, a*c, a*d, b*b, b*c, b*d, c*c, c*d, d*d)]
+
+
+def _add_quadric(q, other):
+    for i in range(10):
+        q[i] += other[i]
+
+
+def _quadric_error(q, p):
+    x, y, z = p
+    return (
+        q[0]*x*x + 2*q[1]*x*y + 2*q[2]*x*z + 2*q[3]*x
+        + q[4]*y*y + 2*q[5]*y*z + 2*q[6]*y
+        + q[7]*z*z + 2*q[8]*z
+        + q[9]
+    )
+
+
+def simplify(obj, ratio=0.5, target=None, max_error=None):
+    """
+      Simplifies triangulated *obj*, returns (faces, error), where faces is dict of material -> faces in **SubOBJ.f** format
+      and error is the largest quadric error (area weighted squared distance) of performed collapses.
+      Stops when *target* faces (by default *ratio* of current count) are left, or when the cheapest collapse
+      costs more than *max_error*. Vertices are moved onto one end of collapsed edge, so vertex data of *obj* is reused.
+    """
+    positions = obj.v
+    tris = []
+    tri_materials = []
+    for material, sub in obj.sub_obj.items():
+        for face in sub.f:
+            if len(face) != 9:
+                raise ValueError("Only triangulated faces can be simplified")
+            tris.append(list(face))
+            tri_materials.append(material)
+    if target is None:
+        target = int(len(tris) * ratio)
+
+    faces_of = dict() #Position index -> set of triangles
+    quadrics = dict()
+    edges = dict() #(lower, higher) position index -> triangles
+    for t, face in enumerate(tris):
+        corners = (face[0], face[3], face[6])
+        for i in corners:
+            if i not in faces_of:
+                faces_of[i] = set()
+                quadrics[i] = [0.0] * 10
+            faces_of[i].add(t)
+        for k in range(3):
+            a, b = corners[k], corners[k - 1]
+            edges.setdefault((a, b) if a < b else (b, a), []).append(t)
+        n = _normal(positions[corners[0]], positions[corners[1]], positions[corners[2]])
+        ln = math.sqrt(n[0]*n[0] + n[1]*n[1] + n[2]*n[2])
+        if ln == 0:
+            continue
+        q = _plane_quadric((n[0] / ln, n[1] / ln, n[2] / ln), positions[corners[0]], ln / 2)
+        for i in corners:
+            _add_quadric(quadrics[i], q)
+
+    for (a, b), adjacent in edges.items():
+        if len(adjacent) != 1:
+            continue
+        #Border edge, keep it with plane that contains the edge and is perpendicular to the face
+        face = tris[adjacent[0]]
+        pa, pb = positions[a], positions[b]
+        n = _normal(positions[face[0]], positions[face[3]], positions[face[6]])
+        dx, dy, dz = pb[0] - pa[0], pb[1] - pa[1], pb[2] - pa[2]
+        bx, by, bz = dy * n[2] - dz * n[1], dz * n[0] - dx * n[2], dx * n[1] - dy * n[0]
+        ln = math.sqrt(bx*bx + by*by + bz*bz)
+        if ln == 0:
+            continue
+        q = _plane_quadric((bx / ln, by / ln, bz / ln), pa, BORDER_WEIGHT * (dx*dx + dy*dy + dz*dz))
+        _add_quadric(quadrics[a], q)
+        _add_quadric(quadrics[b], q)
+
+    version = dict.fromkeys(faces_of, 0)
+    heap = []
+    def push(a, b):
+        q = [x + y for x, y in zip(quadrics[a], quadrics[b])]
+        to_a, to_b = _quadric_error(q, positions[a]), _quadric_error(q, positions[b])
+        if to_b <= to_a:
+            heapq.heappush(heap, (to_b, a, b, version[a], version[b]))
+        else:
+            heapq.heappush(heap, (to_a, b, a, version[b], version[a]))
+
+    def neighbours(i):
+        res = set()
+        for t in faces_of[i]:
+            face = tris[t]
+            res.update((face[0], face[3], face[6]))
+        res.discard(i)
+        return res
+
+    for a, b in edges:
+        push(a, b)
+
+    alive = [True] * len(tris)
+    count = len(tris)
+    error = 0.0
+    while count > target and heap:
+        cost, src, dst, src_version, dst_version = heapq.heappop(heap)
+        if version[src] != src_version or version[dst] != dst_version:
+            continue #Outdated
+        if max_error is not None and cost > max_error:
+            break
+        shared = faces_of[src] & faces_of[dst]
+        if not shared:
+            continue
+        #Collapse should not glue separate parts of surface together
+        if len(neighbours(src) & neighbours(dst)) != len(shared):
+            continue
+        moved = faces_of[src] - shared
+        if _flips(tris, moved, src, positions[dst], positions):
+            continue
+
+        error = max(error, cost)
+        #Corners that move to dst take its texture coordinates and normals where they used the same ones as src
+        vt_map = dict()
+        vn_map = dict()
+        for t in shared:
+            face = tris[t]
+            s = (0, 3, 6)[(face[0], face[3], face[6]).index(src)]
+            d = (0, 3, 6)[(face[0], face[3], face[6]).index(dst)]
+            vt_map[face[s + 1]] = face[d + 1]
+            vn_map[face[s + 2]] = face[d + 2]
+            alive[t] = False
+            count -= 1
+            for k in (0, 3, 6):
+                faces_of[face[k]].discard(t)
+        for t in moved:
+            face = tris[t]
+            for k in (0, 3, 6):
+                if face[k] == src:
+                    face[k] = dst
+                    face[k + 1] = vt_map.get(face[k + 1], face[k + 1])
+                    face[k + 2] = vn_map.get(face[k + 2], face[k + 2])
+            faces_of[dst].add(t)
+        faces_of[src] = set()
+        _add_quadric(quadrics[dst], quadrics[src])
+        version[src] += 1
+        version[dst] += 1
+        for n in neighbours(dst):
+            push(dst, n)
+
+    faces = {material: [] for material in obj.sub_obj}
+    for t, face in enumerate(tris):
+        if alive[t]:
+            faces[tri_materials[t]].append(face)
+    return faces, error
+
+
+def _flips(tris, moved, src, new_position, positions):
+    """Checks if moving *src* to *new_position* turns any of *moved* triangles over"""
+    for t in moved:
+        face = tris[t]
+        old = [positions[face[k]] for k in (0, 3, 6)]
+        new = [new_position if face[k] == src else old[i] for i, k in enumerate((0, 3, 6))]
+        n0, n1 = _normal(*old), _normal(*new)
+        if n0 == (0, 0, 0):
+            continue
+        if n0[0]*n1[0] + n0[1]*n1[1] + n0[2]*n1[2] <= 0:
+            return True
+    return False
+
+
+def _with_faces(obj, faces):
+    """New **OBJ** which shares vertex data and materials with *obj*"""
+    lod = OBJ(obj.name, materials=obj.materials)
+    lod.v, lod.vt, lod.vn = obj.v, obj.vt, obj.vn
+    for material, f in faces.items():
+        lod.get_sub_obj(material).f = f
+    return lod
+
+
+def make_lod(obj, ratio=0.5, max_error=None):
+    """Returns simplified copy of *obj* with *ratio* of its faces"""
+    faces, _ = simplify(obj, ratio, max_error=max_error)
+    return _with_faces(obj, faces)
+
+
+def _face_count(obj):
+    return sum(len(sub.f) for sub in obj.sub_obj.values())
+
+
+def make_lods(obj, ratios=DEFAULT_LOD_RATIOS, path=None):
+    """
+      Returns list of simplified copies of *obj*, with *ratios* of its faces.
+      Each level is made from the previous one. If *path* of source file is given,
+      levels are cached next to it and reused while the file has the same mtime and size.
+    """
+    ratios = list(ratios)
+    if path is not None:
+        faces = _load_lods(obj, ratios, path)
+        if faces is not None:
+            logger.info("Loaded levels of detail of %s from cache", path)
+            return [_with_faces(obj, f) for f in faces]
+    total = _face_count(obj)
+    levels = []
+    current = obj
+    for ratio in ratios:
+        faces, _ = simplify(current, target=int(total * ratio))
+        current = _with_faces(obj, faces)
+        levels.append(current)
+    if path is not None:
+        try:
+            _save_lods(obj, ratios, path, [{m: sub.f for m, sub in lod.sub_obj.items()} for lod in levels])
+        except OSError as e:
+            logger.warning("Could not write levels of detail of %s: %s", path, e)
+    return levels
+
+
+def lod_cache_path(path, name):
+    """Path of file with cached levels of object *name* from *path*"""
+    if name is None:
+        return "%s.lod" % path
+    name = str(name)
+    if not SAFE_NAME.fullmatch(name):
+        name = hashlib.sha1(name.encode()).hexdigest()[:16]
+    return "%s.%s.lod" % (path, name)
+
+
+def _save_lods(obj, ratios, path, levels):
+    blobs = []
+    size = 0
+    meta_levels = []
+    for faces in levels:
+        entries = []
+        for material, f in faces.items():
+            data = array("i", (-1 if i is None else i for face in f for i in face)).tobytes()
+            entries.append([material, [size, len(f) * 9]])
+            blobs.append(data)
+            size += len(data)
+        meta_levels.append(entries)
+    meta = json.dumps({
+        "source": _file_signature(path),
+        "object": obj.name,
+        "ratios": ratios,
+        "levels": meta_levels,
+    }).encode()
+    cache_path = lod_cache_path(path, obj.name)
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(lod_header_struct.pack(LOD_MAGIC, LOD_VERSION, sys.byteorder == "little", len(meta)))
+        f.write(meta)
+        for data in blobs:
+            f.write(data)
+    os.replace(tmp_path, cache_path)
+
+
+def _load_lods(obj, ratios, path):
+    """Returns list of dicts of material -> faces from cache, or None if there is no valid cache"""
+    try:
+        with open(lod_cache_path(path, obj.name), "rb") as f:
+            data = f.read()
+        signature = _file_signature(path)
+    except OSError:
+        return None
+    try:
+        return _parse_lods(data, obj, ratios, signature)
+    except (struct.error, ValueError, KeyError, TypeError) as e:
+        logger.warning("Levels of detail cache of %s is corrupt: %s", path, e)
+        return None
+
+
+def _parse_lods(data, obj, ratios, signature):
+    magic, version, little, meta_size = lod_header_struct.unpack_from(data)
+    if magic != LOD_MAGIC or version != LOD_VERSION or little != (sys.byteorder == "little"):
+        return None
+    start = lod_header_struct.size
+    meta = json.loads(data[start:start + meta_size])
+    if meta["source"] != signature or meta["object"] != obj.name or meta["ratios"] != ratios:
+        return None
+    blob = memoryview(data)[start + meta_size:]
+    levels = []
+    for entries in meta["levels"]:
+        faces = dict()
+        for material, (offset, count) in entries:
+            if offset < 0 or count < 0 or offset + count * 4 > len(blob):
+                raise ValueError("Cache is shorter than its faces")
+            packed = blob[offset:offset + count * 4].cast("i")
+            faces[material] = [[None if i < 0 else i for i in face] for face in _group(packed, 9)]
+        levels.append(faces)
+    return levels
+
+
+def bounding_sphere(obj):
+    """Returns (center, radius) of sphere around vertices used by faces of *obj*"""
+    positions = obj.v
+    used = {face[k] for sub in obj.sub_obj.values() for face in sub.f for k in (0, 3, 6)}
+    if not used:
+        return (0, 0, 0), 0
+    points = [positions[i] for i in used]
+    low = [min(p[k] for p in points) for k in range(3)]
+    high = [max(p[k] for p in points) for k in range(3)]
+    center = tuple((l + h) / 2 for l, h in zip(low, high))
+    radius = max(math.dist(center, p) for p in points)
+    return center, radius
+
+
+def projected_size(center, radius, m, v, p, mvp=None):
+    """
+      Approximate height of sphere with *center* and *radius* in model space on screen,
+      as fraction of viewport height, inf if its center is behind the camera
+    """
+    if mvp is None:
+        mvp = p * v * m
+    w = (mvp * IVec(*center, 1))[3]
+    if w <= 0:
+        return math.inf
+    scale = max(
+        math.sqrt(sum(x * x for x in list(m * IVec(*axis, 0))[:3]))
+        for axis in ((1, 0, 0), (0, 1, 0), (0, 0, 1))
+    )
+    return radius * scale * (p * IVec(0, 1, 0, 0))[1] / w
+
+
+def select_lod(screen_size, screen_sizes=DEFAULT_LOD_SCREEN_SIZES):
+    """Level to draw for model that takes *screen_size* of viewport height"""
+    level = 0
+    for size in screen_sizes:
+        if screen_size >= size:
+            break
+        level += 1
+    return level
@@ -5,11 +5,20 @@
 import sys
 import pathlib
 import os.path
+import hashlib
+import json
+import math
+import mmap
+import struct
 from enum import Enum
 from array import array
+from itertools import chain, count
 import logging
 
-from ..math.vec import Vec
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 logger = logging.getLogger(__name__)
 
@@ -98,6 +107,43 @@ def check_has_no_textures(face):
     return not check_has_textures(face)
 
 
+def accept_all(face):
+    """
+      Default filter, accepts every face
+    """
+    return True
+
+
+#Submodels with fewer faces are resolved in pure python even when numpy is available
+NUMPY_RESOLVE_THRESHOLD = 256
+
+#Only results for these filters are memoized, other filters are usually lambdas made per call
+MEMOIZED_FILTERS = (accept_all, check_has_textures, check_has_no_textures)
+
+_plans = dict()
+
+
+def compile_form(form):
+    """
+      Compiles *form* to tuple of (source, index in face) pairs,
+      where source is 0 for vertices, 1 for texture coordinates and 2 for normals
+    """
+    plan = _plans.get(form)
+    if plan is None:
+        plan = []
+        for f in form:
+            if f in OBJ_VERTEX:
+                plan.append((0, f.value))
+            elif f in OBJ_TEXTURE:
+                plan.append((1, f.value))
+            elif f in OBJ_NORMAL:
+                plan.append((2, f.value))
+            else:
+                raise ValueError("Wrong format")
+        plan = _plans[form] = tuple(plan)
+    return plan
+
+
 class Material:
     """Object that describes material properties"""
 
@@ -171,28 +217,175 @@ class MTLLoader:
             return self.load_file(f)
 
 
+_versions = count(1)
+
+
+class _TrackedList(list):
+    """
+    List that gets new *version* when its items are replaced or removed.
+    Growth isn't tracked, as it changes length, which is checked too
+    """
+    __slots__ = ("version",)
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.version = 0
+
+    def touch(self):
+        self.version = next(_versions)
+
+
+def _tracking(name):
+    method = getattr(list, name)
+    def wrapper(self, *args, **kwargs):
+        self.version = next(_versions)
+        return method(self, *args, **kwargs)
+    wrapper.__name__ = name
+    return wrapper
+
+for _name in ("__setitem__", "__delitem__", "__imul__", "pop", "remove", "clear", "sort", "reverse"):
+    setattr(_TrackedList, _name, _tracking(_name))
+del _name
+
+
+def _tracked(value):
+    """Returns *value* as **_TrackedList** with new version"""
+    if not isinstance(value, _TrackedList):
+        value = _TrackedList(value)
+    value.touch()
+    return value
+
+
+def _group(data, n):
+    """Splits flat sequence into list of *n*-tuples"""
+    it = iter(data)
+    return _TrackedList(zip(*[it] * n))
+
+
 class SubOBJ:
     """Part of object with one material"""
 
     def __init__(self, name):
-        self.f = []
+        self._f = _TrackedList()
+        self._packed_f = None
         self.mat_name = name
 
+    @property
+    def f(self):
+        """Faces, lists of 9 indices (or None) in **OBJIndex** order"""
+        if self._packed_f is not None:
+            packed, self._packed_f = self._packed_f, None
+            self._f = _TrackedList([None if i < 0 else i for i in face] for face in _group(packed, 9))
+        return self._f
+
+    @f.setter
+    def f(self, value):
+        self._packed_f = None
+        self._f = _tracked(value)
+
 
 class OBJ:
     """Loaded object class"""
     def __init__(self, name, materials):
         """Initialize new 3d object with given *name* and *materials* dict"""
-        self.v = []
+        self._v = _TrackedList()
 
-        self.vt = []
-        self.vn = []
+        self._vt = _TrackedList()
+        self._vn = _TrackedList()
+        self._packed = None #Flat arrays from cache, unpacked on first access
 
         self.sub_obj = dict()
         self.materials = materials
+        self.resolved = dict() #(material, form, filter_by[, "indexed"]) -> (signature, result)
+        self._numpy_sources = None #(state, arrays) of v, vt, vn
+        self._mapping = None #Mapped cache file that packed arrays are views of
 
         self.name = name
 
+    def _state(self):
+        """Lengths and versions of v, vt, vn; data that wasn't unpacked yet has version 0"""
+        if self._packed is not None:
+            packed = self._packed
+            return len(packed["v"]) // 3, 0, len(packed["vt"]) // 2, 0, len(packed["vn"]) // 3, 0
+        return len(self._v), self._v.version, len(self._vt), self._vt.version, len(self._vn), self._vn.version
+
+    def _signature(self, material):
+        """Changes when data used to resolve *material* is changed"""
+        sub = self.get_sub_obj(material)
+        if sub._packed_f is not None:
+            faces = (len(sub._packed_f) // 9, 0)
+        else:
+            faces = (len(sub._f), sub._f.version)
+        return self._state() + faces
+
+    def invalidate(self):
+        """Forget resolved arrays. Changes through v, vt, vn and f are noticed without it,
+        but items of them (tuples and face lists) aren't tracked"""
+        self.resolved.clear()
+        self._numpy_sources = None
+        self.release()
+
+    def release(self):
+        """
+        Copies data out of mapped cache file and forgets resolved arrays from it, so the file can be closed.
+        It is closed when the last object loaded from it is released
+        """
+        mapping, self._mapping = self._mapping, None
+        if mapping is None:
+            return
+        self.resolved.clear()
+        self._numpy_sources = None
+        if self._packed is not None:
+            self._unpack()
+        for sub in self.sub_obj.values():
+            sub.f #Unpacks faces
+        try:
+            mapping.close()
+        except BufferError:
+            pass #Still used by other objects or by arrays returned earlier
+
+    def _unpack(self):
+        packed, self._packed = self._packed, None
+        self._v = _group(packed["v"], 3)
+        self._vt = _group(packed["vt"], 2)
+        self._vn = _group(packed["vn"], 3)
+
+    @property
+    def v(self):
+        if self._packed is not None:
+            self._unpack()
+        return self._v
+
+    @v.setter
+    def v(self, value):
+        if self._packed is not None:
+            self._unpack()
+        self._v = _tracked(value)
+
+    @property
+    def vt(self):
+        if self._packed is not None:
+            self._unpack()
+        return self._vt
+
+    @vt.setter
+    def vt(self, value):
+        if self._packed is not None:
+            self._unpack()
+        self._vt = _tracked(value)
+
+    @property
+    def vn(self):
+        if self._packed is not None:
+            self._unpack()
+        return self._vn
+
+    @vn.setter
+    def vn(self, value):
+        if self._packed is not None:
+            self._unpack()
+        self._vn = _tracked(value)
+
     def get_sub_obj(self, material):
         """Get SubOBJ for *material*"""
         v = self.sub_obj.get(material)
@@ -203,13 +396,15 @@ class OBJ:
             self.sub_obj[material] = v
             return v
 
-    def iter_materials_textured(self, *form):
-        """Iterate over textured material faces"""
+    def iter_materials_textured(self, *form, indexed=False):
+        """Iterate over textured material faces
+        If *indexed* is True, yields (vertices, indices) pairs from **resolve_indexed** instead of arrays"""
 
+        resolve = self.resolve_indexed if indexed else self.resolve
         for sub_obj_key in self.sub_obj:
             yield (
                 self.sub_obj[sub_obj_key],
-                self.resolve(*form, material=sub_obj_key, filter_by=check_has_textures),
+                resolve(*form, material=sub_obj_key, filter_by=check_has_textures),
             )
 
     def iter_materials_non_textured(self, *form):
@@ -226,33 +421,149 @@ class OBJ:
                 ),
             )
 
-    def resolve(self, *form, filter_by=lambda x: True, material=None):
-        """Resolves faces to parameter array defined by *form* format"""
+    def resolve(self, *form, filter_by=accept_all, material=None):
+        """Resolves faces to parameter array defined by *form* format
+        Results for filters from **MEMOIZED_FILTERS** are memoized until vertices or faces change
+        (or **invalidate** is called), so they shouldn't be modified"""
+        if material is None:
+            material = list(self.sub_obj.keys())[0]
+        if len(form) == 0:
+            form = FORMAT_TEXTURES
+        key = (material, form, filter_by)
+        signature = self._signature(material)
+        memoize = filter_by in MEMOIZED_FILTERS
+        if memoize:
+            cached = self.resolved.get(key)
+            if cached is not None and cached[0] == signature:
+                return cached[1]
+        plan = compile_form(form)
+        sub = self.get_sub_obj(material)
+        res = None
+        if numpy is not None and signature[6] >= NUMPY_RESOLVE_THRESHOLD:
+            res = self._resolve_numpy(plan, sub, filter_by)
+        if res is None:
+            res = self._resolve_python(plan, sub.f, filter_by)
+        if memoize:
+            self.resolved[key] = (signature, res)
+        return res
+
+    def _resolve_python(self, plan, faces, filter_by):
+        sources = (self.v, self.vt, self.vn)
+        plan = [(sources[source], i) for source, i in plan]
+        if filter_by is not accept_all:
+            faces = [face for face in faces if filter_by(face)]
+        return array("f", chain.from_iterable(source[face[i]] for face in faces for source, i in plan))
+
+    def _sources_numpy(self):
+        state = self._state()
+        if self._numpy_sources is None or self._numpy_sources[0] != state:
+            if self._packed is not None:
+                packed = self._packed
+                arrays = tuple(numpy.frombuffer(packed[key], dtype=numpy.float32).reshape(-1, n) for key, n in (("v", 3), ("vt", 2), ("vn", 3)))
+            else:
+                arrays = tuple(numpy.array(data, dtype=numpy.float32).reshape(-1, n) for data, n in ((self._v, 3), (self._vt, 2), (self._vn, 3)))
+            self._numpy_sources = (state, arrays)
+        return self._numpy_sources[1]
+
+    def _resolve_numpy(self, plan, sub, filter_by):
+        """Gathers every column of *plan* at once, returns None if faces can't be handled here"""
+        if sub._packed_f is not None:
+            faces = numpy.frombuffer(sub._packed_f, dtype=numpy.int32).reshape(-1, 9)
+        else:
+            try:
+                faces = numpy.array(sub._f, dtype=numpy.float64) #None becomes nan
+            except ValueError:
+                return None #Faces that aren't triangles
+            if faces.ndim != 2 or faces.shape[1] != 9:
+                return None
+            faces = numpy.where(numpy.isnan(faces), -1, faces).astype(numpy.int64)
+        if filter_by is check_has_textures:
+            faces = faces[(faces[:, [1, 4, 7]] >= 0).all(axis=1)]
+        elif filter_by is check_has_no_textures:
+            faces = faces[(faces[:, [1, 4, 7]] < 0).any(axis=1)]
+        elif filter_by is not accept_all:
+            return None
+        sources = self._sources_numpy()
+        columns = []
+        for source, i in plan:
+            indices = faces[:, i]
+            if len(indices) and indices.min() < 0:
+                raise TypeError("Face is missing index needed by format")
+            columns.append(sources[source][indices])
+        if not columns:
+            return array("f")
         res = array("f")
+        res.frombytes(numpy.concatenate(columns, axis=1).tobytes())
+        return res
+
+    def resolve_indexed(self, *form, filter_by=accept_all, material=None):
+        """Resolves faces to unique vertices and indices of them, as (array("f"), array("I")) pair.
+        *form* should list the same parameters for every corner, in the same order.
+        Results are memoized like in **resolve**"""
         if material is None:
             material = list(self.sub_obj.keys())[0]
         if len(form) == 0:
             form = FORMAT_TEXTURES
+        key = (material, form, filter_by, "indexed")
+        signature = self._signature(material)
+        memoize = filter_by in MEMOIZED_FILTERS
+        if memoize:
+            cached = self.resolved.get(key)
+            if cached is not None and cached[0] == signature:
+                return cached[1]
+        per_corner = len(form) // 3
+        offsets = [f.value for f in form[:per_corner]]
+        if len(form) != per_corner * 3 or any(f.value not in (0, 1, 2) for f in form[:per_corner]):
+            raise ValueError("Wrong format")
+        for corner in (1, 2):
+            if [f.value - corner * 3 for f in form[corner * per_corner:(corner + 1) * per_corner]] != offsets:
+                raise ValueError("Format should be the same for every corner")
+        sources = [(self.v, self.vt, self.vn)[offset] for offset in offsets]
+
+        vertices = array("f")
+        indices = array("I")
+        unique = dict() #(v, vt, vn) indices -> vertex index
         for face in self.get_sub_obj(material).f:
             if not filter_by(face):
                 continue
-            for f in form:
-                if f in OBJ_VERTEX:
-                    res.extend(self.v[face[f.value]])
-                elif f in OBJ_TEXTURE:
-                    res.extend(self.vt[face[f.value]])
-                elif f in OBJ_NORMAL:
-                    res.extend(self.vn[face[f.value]])
-                else:
-                    raise ValueError("Wrong format")
-        return res
+            for base in (0, 3, 6):
+                corner = tuple(face[base + offset] for offset in offsets)
+                index = unique.get(corner)
+                if index is None:
+                    index = unique[corner] = len(unique)
+                    for source, i in zip(sources, corner):
+                        vertices.extend(source[i])
+                indices.append(index)
+        if memoize:
+            self.resolved[key] = (signature, (vertices, indices))
+        return vertices, indices
+
+
+CACHE_MAGIC = b"QOBJC"
+CACHE_VERSION = 2
+cache_header_struct = struct.Struct("!5sBBI") #magic, version, is little endian, json size
+#Smaller caches are read to memory, bigger ones are mapped until objects are released
+CACHE_MMAP_THRESHOLD = 1 << 20
+#Resolved arrays that are stored in packed images: key, form, filter, indexed
+CACHED_FORMS = (
+    ("textured", FORMAT_TEXTURES, check_has_textures, False),
+    ("plain", FORMAT_NO_TEXTURES, check_has_no_textures, False),
+    ("textured_indexed", FORMAT_TEXTURES, check_has_textures, True),
+)
+
+
+def _file_signature(path):
+    st = os.stat(path)
+    return [os.path.abspath(path), st.st_mtime_ns, st.st_size]
 
 
 class OBJLoader:
     """Loads object files"""
 
-    def __init__(self):
-        """Create new object loader"""
+    def __init__(self, cache_dir=None):
+        """Create new object loader
+        If *cache_dir* is given, **load_path** keeps binary caches of parsed files there,
+        they are used while the file and its mtllibs have the same mtime and size"""
         self.objects = dict()
         self.current_object = None
 
@@ -260,6 +571,7 @@ class OBJLoader:
         self.current_material = None
 
         self.loads_from = ""
+        self.cache_dir = cache_dir
 
     def get_obj(self, name=None):
         """Get object by *name* or latest object if *name* is None"""
@@ -287,48 +599,66 @@ class OBJLoader:
         Triangulates faces if *triangulate* specified"""
 
         mtl_loader = MTLLoader()
+        self.loaded_objects = set()
+        self.loaded_mtl_paths = []
+        corners = dict() #Corner text -> parsed indices, corners are shared by several faces
+        obj = None
+        faces = None
 
-        for i, line in enumerate(f):
+        for line in f:
             if line.startswith("#"):
                 continue
-            try:
-                op, *params = line.split()
-            except ValueError:
+            parts = line.split()
+            if not parts:
                 continue
+            op = parts[0]
 
             if op == "v":
-                t = tuple(map(float, params))
-                assert len(t) == 3
-                self.get_obj().v.append(t)
+                if obj is None:
+                    obj = self.get_obj()
+                    self.loaded_objects.add(self.current_object)
+                obj.v.append((float(parts[1]), float(parts[2]), float(parts[3])))
             elif op == "vt":
-                t = tuple(map(float, params))
-                assert len(t) == 2
-                self.get_obj().vt.append(t)
+                if obj is None:
+                    obj = self.get_obj()
+                    self.loaded_objects.add(self.current_object)
+                obj.vt.append((float(parts[1]), float(parts[2])))
             elif op == "vn":
-                t = Vec(map(float, params))
-                assert len(t) == 3
-                t.normalize()
-                self.get_obj().vn.append(t)
+                if obj is None:
+                    obj = self.get_obj()
+                    self.loaded_objects.add(self.current_object)
+                x, y, z = float(parts[1]), float(parts[2]), float(parts[3])
+                ln = math.sqrt(x*x + y*y + z*z)
+                if ln > 0:
+                    x, y, z = x / ln, y / ln, z / ln
+                obj.vn.append((x, y, z))
             elif op == "f":
+                if faces is None:
+                    if obj is None:
+                        obj = self.get_obj()
+                        self.loaded_objects.add(self.current_object)
+                    faces = self.get_sub_obj().f
+                params = []
+                for corner in parts[1:]:
+                    indices = corners.get(corner)
+                    if indices is None:
+                        indices = self._parse_corner(corner, obj)
+                        if "-" not in corner: #Relative indices depend on position in file
+                            corners[corner] = indices
+                    params.append(indices)
 
                 if triangulate:
-                    #params = list(
-                    #    map(lambda x: tuple(map(index_or_none, x.split("/"))), params)
-                    #)
-                    params = [[None if not v.isnumeric() else int(v)-1 if int(v)>0 else int(v) for v in x.split("/")] for x in params]
+                    first = params[0]
                     for i in range(len(params) - 2):
-                        t = []
-                        t.extend(params[0])
-                        t.extend(params[i + 1])
-                        t.extend(params[i + 2])
-                        self.get_sub_obj().f.append(t)
+                        faces.append(first + params[i + 1] + params[i + 2])
                 else:
                     t = []
                     for p in params:
-                        t.extend(map(index_or_none, p.split("/")))
-                    self.get_sub_obj().f.append(t)
+                        t.extend(p)
+                    faces.append(t)
             elif op == "usemtl":
-                self.current_material = params[0]
+                self.current_material = parts[1] if len(parts) > 1 else None
+                faces = None
             elif op == "mtllib":
                 path = pathlib.Path(line.split(maxsplit=1)[1].strip())
                 logger.info("Loading mtlib from %s", path)
@@ -337,20 +667,210 @@ class OBJLoader:
                 else:
                     path = pathlib.Path(self.loads_from).parent.joinpath(path)
                 mtl_loader.load_path(path)
+                self.loaded_mtl_paths.append(str(path))
             elif op == "o":
-                if len(params) > 0:
-                    self.current_object = params[0]
+                if len(parts) > 1:
+                    self.current_object = parts[1]
                 else:
                     self.current_object = len(self.objects.keys())
+                obj = None
+                faces = None
 
             else:
                 logger.warning("Unsapported op %s", op)
         self.materials.update(mtl_loader.materials)
+        self.loaded_materials = set(mtl_loader.materials)
+
+    @staticmethod
+    def _parse_corner(corner, obj):
+        """Maps "v/vt/vn" corner of face to 0-based indices, None for missing ones"""
+        res = [None, None, None]
+        for i, value in enumerate(corner.split("/")[:3]):
+            if not value:
+                continue
+            n = int(value)
+            if n > 0:
+                res[i] = n - 1
+            else:
+                #Relative to the end of list
+                res[i] = len((obj.v, obj.vt, obj.vn)[i]) + n
+        return res
 
     def load_path(self, path):
         """
           Loads models from *path*
         """
         self.loads_from = path
+        if self.cache_dir is not None and self._load_cache(path):
+            return
+        existing = set(self.objects)
         with open(path, "r") as f:
-            return self.load_file(f)
+            self.load_file(f)
+        if self.cache_dir is not None and not (self.loaded_objects & existing):
+            try:
+                self._save_cache(path)
+            except (OSError, TypeError) as e:
+                logger.warning("Could not write cache of %s: %s", path, e)
+
+    def cache_path(self, path):
+        """Path of cache file for *path*"""
+        key = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()
+        return os.path.join(self.cache_dir, key + ".qobjcache")
+
+    def _save_cache(self, path):
+        data = self.pack(path)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        cache_path = self.cache_path(path)
+        tmp_path = cache_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, cache_path)
+
+    def pack(self, path, forms=None):
+        """
+          Returns binary image of objects and materials loaded by the last **load_path** of *path*,
+          with raw data and resolved arrays, which can be loaded with **load_packed**.
+          *forms* are keys of **CACHED_FORMS** to resolve, all of them by default
+        """
+        blobs = []
+        size = 0
+        def add(arr):
+            nonlocal size
+            data = arr.tobytes()
+            entry = [size, len(arr)]
+            blobs.append(data)
+            size += len(data)
+            padding = -size % 8
+            if padding:
+                blobs.append(bytes(padding))
+                size += padding
+            return entry
+
+        objects = []
+        for name in self.loaded_objects:
+            obj = self.objects[name]
+            sub_objs = []
+            for material, sub in obj.sub_obj.items():
+                faces = array("i", (-1 if i is None else i for face in sub.f for i in face))
+                if len(faces) != len(sub.f) * 9:
+                    raise TypeError("Only triangulated faces can be cached")
+                resolved = dict()
+                for key, form, filter_by, indexed in CACHED_FORMS:
+                    if forms is not None and key not in forms:
+                        continue
+                    try:
+                        if indexed:
+                            resolved[key] = [add(arr) for arr in obj.resolve_indexed(*form, material=material, filter_by=filter_by)]
+                        else:
+                            resolved[key] = add(obj.resolve(*form, material=material, filter_by=filter_by))
+                    except (TypeError, IndexError):
+                        pass #Some faces miss indices this form needs
+                sub_objs.append([material, add(faces), resolved])
+            objects.append([name, {
+                "v": add(array("f", (x for t in obj.v for x in t))),
+                "vt": add(array("f", (x for t in obj.vt for x in t))),
+                "vn": add(array("f", (x for t in obj.vn for x in t))),
+                "sub_obj": sub_objs,
+            }])
+        materials = []
+        for name in self.loaded_materials:
+            mat = self.materials[name]
+            loaded_from = None if mat.loaded_from is None else str(mat.loaded_from)
+            materials.append([name, mat.raw_params, loaded_from])
+        meta = json.dumps({
+            "sources": [_file_signature(p) for p in [path] + self.loaded_mtl_paths],
+            "objects": objects,
+            "materials": materials,
+            "current_object": self.current_object,
+            "current_material": self.current_material,
+        }).encode()
+        header = cache_header_struct.pack(CACHE_MAGIC, CACHE_VERSION, sys.byteorder == "little", len(meta))
+        padding = bytes(-(len(header) + len(meta)) % 8) #Arrays are aligned
+        return b"".join([header, meta, padding] + blobs)
+
+    def _load_cache(self, path):
+        """Loads *path* from cache, returns False if there is no valid cache"""
+        try:
+            with open(self.cache_path(path), "rb") as f:
+                if os.fstat(f.fileno()).st_size < CACHE_MMAP_THRESHOLD:
+                    data = f.read()
+                else:
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return False
+        loaded = False
+        try:
+            loaded = self.load_packed(data, check_sources=True)
+        except (struct.error, ValueError, KeyError, TypeError) as e:
+            logger.warning("Cache of %s is corrupt: %s", path, e)
+        if isinstance(data, mmap.mmap):
+            if loaded:
+                for name in self.loaded_objects:
+                    self.objects[name]._mapping = data
+            else:
+                try:
+                    data.close()
+                except BufferError:
+                    pass #Views of half loaded image are still alive, it is closed when they are collected
+        if loaded:
+            logger.info("Loaded %s from cache", path)
+        return loaded
+
+    def load_packed(self, data, check_sources=False):
+        """
+          Loads image made by **pack** from *data* (any buffer, arrays are views into it).
+          If *check_sources* is True, image is only used if source files didn't change since it was made.
+          Returns False if image can't be used, raises struct.error, ValueError, KeyError or TypeError if it is corrupt
+        """
+        magic, version, little, meta_size = cache_header_struct.unpack_from(data)
+        if magic != CACHE_MAGIC or version != CACHE_VERSION or little != (sys.byteorder == "little"):
+            return False
+        start = cache_header_struct.size
+        meta = json.loads(bytes(data[start:start + meta_size]))
+        if check_sources:
+            try:
+                if any(_file_signature(p) != [p, mtime, size] for p, mtime, size in meta["sources"]):
+                    return False
+            except OSError:
+                return False
+        if any(name in self.objects for name, _ in meta["objects"]):
+            return False #Packed data can't be appended to existing object
+        start += meta_size
+        blob = memoryview(data)[start + (-start % 8):]
+        def get(entry, typecode):
+            offset, count = entry
+            if offset < 0 or count < 0 or offset + count * 4 > len(blob):
+                raise ValueError("Packed image is shorter than its arrays")
+            return blob[offset:offset + count * 4].cast(typecode)
+
+        objects = dict()
+        for name, packed in meta["objects"]:
+            obj = OBJ(name, materials=self.materials)
+            obj._packed = {key: get(packed[key], "f") for key in ("v", "vt", "vn")}
+            for material, faces, resolved in packed["sub_obj"]:
+                sub = obj.get_sub_obj(material)
+                sub._packed_f = get(faces, "i")
+                signature = obj._signature(material)
+                for key, form, filter_by, indexed in CACHED_FORMS:
+                    if key not in resolved:
+                        continue
+                    if indexed:
+                        vertices, indices = resolved[key]
+                        obj.resolved[(material, form, filter_by, "indexed")] = (signature, (get(vertices, "f"), get(indices, "I")))
+                    else:
+                        obj.resolved[(material, form, filter_by)] = (signature, get(resolved[key], "f"))
+            objects[name] = obj
+        materials = dict()
+        for name, raw_params, loaded_from in meta["materials"]:
+            mat = Material(name)
+            mat.raw_params = raw_params
+            mat.loaded_from = loaded_from
+            materials[name] = mat
+        self.objects.update(objects)
+        self.materials.update(materials)
+        self.current_object = meta["current_object"]
+        self.current_material = meta["current_material"]
+        self.loaded_objects = {name for name, _ in meta["objects"]}
+        self.loaded_mtl_paths = [p for p, _, _ in meta["sources"][1:]]
+        self.loaded_materials = {name for name, _, _ in meta["materials"]}
+        return True
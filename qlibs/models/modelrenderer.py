@@ -1,6 +1,7 @@
 import moderngl
 
 from . import modelloader
+from .lod import bounding_sphere, projected_size, select_lod, DEFAULT_LOD_SCREEN_SIZES
 from ..resources.resource_loader import get_res_texture, get_res_data
 from ..resources.resource_manager import get_storage_of_context
 from ..util import try_write
@@ -16,10 +17,11 @@ def make_texture_program(ctx):
 
 
 class MaterialData:
-    def __init__(self, material, vbo, vao):
+    def __init__(self, material, vbo, vao, ibo=None):
         self.material = material
         self.vbo = vbo
         self.vao = vao
+        self.ibo = ibo
 
 
 class Scene:
@@ -38,12 +40,20 @@ class Scene:
 class RenderableModel:
     """
       Model wrapper which can render models
+
+      If *indexed* is True, vertices shared by faces are stored once and drawn through index buffer
+
+      *lods* are simplified versions of *model* (see **qlibs.models.lod.make_lods**),
+      level n is drawn when model takes less than *lod_screen_sizes*[n - 1] of viewport height
     """
-    def __init__(self, model, scene, ctx, program=None):
+    def __init__(self, model, scene, ctx, program=None, indexed=True, lods=(), lod_screen_sizes=DEFAULT_LOD_SCREEN_SIZES):
         self.model = model
         self.ctx = ctx
         self.scene = scene
         self.texture_program = program
+        self.indexed = indexed
+        self.lods = list(lods)
+        self.lod_screen_sizes = lod_screen_sizes
         self.reset()
         self.prepare()
 
@@ -52,6 +62,8 @@ class RenderableModel:
         self.hooked_textures = dict()
         self.textured_data = dict()
         self.plain_data = dict()
+        self.levels = [self.textured_data]
+        self.bounds = None
 
     def prepare(self):
         program = self.texture_program or make_texture_program(self.ctx)
@@ -60,21 +72,37 @@ class RenderableModel:
             return
         self.ready = True
 
-        for mat, data in self.model.iter_materials_textured(
-            *modelloader.FORMAT_TEXTURES
+        self._prepare_level(self.model, self.textured_data, program)
+        for lod in self.lods:
+            data = dict()
+            self._prepare_level(lod, data, program)
+            self.levels.append(data)
+        if self.lods:
+            self.bounds = bounding_sphere(self.model)
+
+    def _prepare_level(self, model, textured_data, program):
+        for mat, data in model.iter_materials_textured(
+            *modelloader.FORMAT_TEXTURES, indexed=self.indexed
         ):
+            if self.indexed:
+                data, indices = data
             if len(data) == 0:
                 continue
-            if mat.mat_name not in self.model.materials:
+            if mat.mat_name not in model.materials:
                 print(f"Could not find material {mat.mat_name}, skipping")
                 continue
             
-            mat = self.model.materials[mat.mat_name]
+            mat = model.materials[mat.mat_name]
             mat.process()
             vbo = self.ctx.buffer(data)
-            vao = self.ctx.simple_vertex_array(program, vbo, "in_vert", "normal", "uv")
-            md = MaterialData(mat, vbo, vao)
-            self.textured_data[mat.name] = md
+            if self.indexed:
+                ibo = self.ctx.buffer(indices)
+                vao = self.ctx.simple_vertex_array(program, vbo, "in_vert", "normal", "uv", index_buffer=ibo, index_element_size=4)
+            else:
+                ibo = None
+                vao = self.ctx.simple_vertex_array(program, vbo, "in_vert", "normal", "uv")
+            md = MaterialData(mat, vbo, vao, ibo)
+            textured_data[mat.name] = md
 
             storage = get_storage_of_context(self.ctx)
 
@@ -83,6 +111,18 @@ class RenderableModel:
                 if name is not None:
                     self.hooked_textures[name] = storage.get_texture(name)
 
+    def screen_size(self, m, v, p, mvp=None):
+        """Approximate height of model on screen as fraction of viewport height"""
+        center, radius = self.bounds or bounding_sphere(self.model)
+        return projected_size(center, radius, m, v, p, mvp)
+
+    def select_level(self, m, v, p, mvp=None):
+        """Index in *self*.levels of level of detail to draw"""
+        if len(self.levels) == 1:
+            return 0
+        level = select_lod(self.screen_size(m, v, p, mvp), self.lod_screen_sizes)
+        return min(level, len(self.levels) - 1)
+
     def render(self, m, v, p, mvp=None):
         self.ctx.enable(moderngl.DEPTH_TEST)
         self.ctx.enable(moderngl.CULL_FACE)
@@ -99,7 +139,7 @@ class RenderableModel:
         try_write(prog, "light_dir", self.scene.light_direction.bytes())
         try_write(prog, "light_col", self.scene.light_color.bytes())
 
-        for name, matdata in self.textured_data.items():
+        for name, matdata in self.levels[self.select_level(m, v, p, mvp)].items():
             mat, vao = matdata.material, matdata.vao
             self.hooked_textures[mat.prc_params["map_Kd"]].use()
             vao.render(moderngl.TRIANGLES)
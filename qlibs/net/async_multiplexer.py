@@ -0,0 +1,205 @@
+"""
+  asyncio backend for multiplexer.
+
+  Uses the same wire format as **MultiplexServer** and **MultiplexClient**, so sync and async
+  servers and clients can be mixed. Nothing is polled: everything happens in protocol callbacks,
+  which allows to share event loop with other services.
+
+```python
+server = await AsyncMultiplexServer.start(port=55126)
+client = await AsyncMultiplexClient.connect(engine, port=55126)
+client.send_payload(b"hello")
+```
+"""
+
+import asyncio
+import logging
+import socket
+import time
+
+from .asyncsocket import BytesPacketFramer
+from .multiplexer import MultiplexServerBase, MultiplexClientBase
+
+__all__ = ["AsyncMultiplexServer", "AsyncMultiplexClient"]
+
+logger = logging.getLogger("qlibs.net.async_multiplexer")
+
+
+def _set_nodelay(transport):
+    sock = transport.get_extra_info("socket")
+    if sock is not None and sock.family in (socket.AF_INET, socket.AF_INET6):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class _PacketProtocol(asyncio.Protocol):
+    """Splits incoming stream into packets and passes them to *on_packet*"""
+    def __init__(self):
+        self.transport = None
+        self.framer = BytesPacketFramer()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        _set_nodelay(transport)
+
+    def data_received(self, data):
+        for packet in self.framer.feed(data):
+            self.on_packet(packet)
+
+    def on_packet(self, packet):
+        raise NotImplementedError
+
+    def send(self, data):
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.write(data)
+
+    def send_many(self, buffers):
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.writelines(buffers)
+
+    @property
+    def closed(self):
+        return self.transport is None or self.transport.is_closing()
+
+
+class _ServerProtocol(_PacketProtocol):
+    def __init__(self, server):
+        super().__init__()
+        self.server = server
+        self.player_id = None
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        logger.info("Connection from %s", transport.get_extra_info("peername"))
+        self.player_id = self.server._add_player(self)
+        self.server._protocols[self.player_id] = self
+
+    def data_received(self, data):
+        super().data_received(data)
+        self.server._flush()
+
+    def on_packet(self, packet):
+        self.server._on_packet(self.player_id, packet)
+
+    def connection_lost(self, exc):
+        self.transport = None
+        if self.server._protocols.pop(self.player_id, None) is not None:
+            self.server._remove_player(self.player_id)
+
+
+class AsyncMultiplexServer(MultiplexServerBase):
+    """
+    asyncio based multiplexer server. Use **start** to create it.
+    """
+    def __init__(self, engine_packer=None):
+        super().__init__(engine_packer)
+        self._protocols = dict()
+        self._server = None
+
+    def _connections(self):
+        return list(self._protocols.values())
+
+    @classmethod
+    async def start(cls, host="0.0.0.0", port=55126, engine_packer=None):
+        """Creates server that listens on *host*:*port*. Use port 0 to pick a free port."""
+        self = cls(engine_packer)
+        loop = asyncio.get_running_loop()
+        self._server = await loop.create_server(lambda: _ServerProtocol(self), host, port)
+        return self
+
+    @property
+    def port(self):
+        """Port server is listening on"""
+        return self._server.sockets[0].getsockname()[1]
+
+    async def serve_forever(self):
+        await self._server.serve_forever()
+
+    def close(self):
+        """Stops listening and closes all connections"""
+        self._server.close()
+        for proto in self._connections():
+            if proto.transport is not None:
+                proto.transport.close()
+
+    async def wait_closed(self):
+        await self._server.wait_closed()
+
+
+class _ClientProtocol(_PacketProtocol):
+    def __init__(self, client):
+        super().__init__()
+        self.client = client
+
+    def on_packet(self, packet):
+        self.client._on_packet(packet)
+
+    def connection_lost(self, exc):
+        self.transport = None
+        self.client._on_connection_lost(exc)
+
+
+class AsyncMultiplexClient(MultiplexClientBase):
+    """
+    asyncio based multiplexer client. Use **connect** to create it.
+
+    Ready packets are sent as soon as previous step is done and at least *step_interval* has passed,
+    using event loop timers instead of polling.
+    """
+    def __init__(self, engine, engine_constructor=None, resume=None, room=None, record=None):
+        super().__init__(engine, engine_constructor, resume, room, record)
+        self.protocol = None
+        self._ready_handle = None
+        self._hello = None
+        self.closed = None
+
+    @classmethod
+    async def connect(cls, engine, engine_constructor=None, host="localhost", port=55126, resume=None, room=None, record=None):
+        """Connects to server, returns after player id is known"""
+        self = cls(engine, engine_constructor, resume, room, record)
+        loop = asyncio.get_running_loop()
+        self._hello = loop.create_future()
+        self.closed = loop.create_future()
+        _, self.protocol = await loop.create_connection(lambda: _ClientProtocol(self), host, port)
+        initial = self._initial_packets()
+        if initial:
+            self.protocol.send(initial)
+        await asyncio.shield(self._hello) #First ready packet is scheduled when hello arrives
+        return self
+
+    def _on_packet(self, packet):
+        super()._on_packet(packet)
+        if self.player_id is not None and not self._hello.done():
+            self._hello.set_result(self.player_id)
+        if self.ready_to_step and self._ready_handle is None and self._hello.done():
+            self._schedule_ready()
+
+    def _schedule_ready(self):
+        loop = asyncio.get_running_loop()
+        delay = max(0, self.last_step + self.step_interval - time.monotonic())
+        self._ready_handle = loop.call_later(delay, self._send_ready)
+
+    def _send_ready(self):
+        self._ready_handle = None
+        if self.protocol.closed:
+            return
+        self.protocol.send(self._ready_packet())
+
+    def send_payload(self, data):
+        """Sends *data* to everyone, it will be delivered as **PayloadEvent** on some of next steps"""
+        self.protocol.send(self._payload_packet(data))
+
+    def _on_connection_lost(self, exc):
+        logger.info("Connection to server lost")
+        if self._ready_handle is not None:
+            self._ready_handle.cancel()
+            self._ready_handle = None
+        if not self._hello.done():
+            self._hello.set_exception(exc or ConnectionError("Connection closed before hello packet"))
+        if self.recorder is not None:
+            self.recorder.flush()
+        if not self.closed.done():
+            self.closed.set_result(exc)
+
+    def close(self):
+        if self.protocol.transport is not None:
+            self.protocol.transport.close()
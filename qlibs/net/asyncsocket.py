@@ -4,6 +4,8 @@
 from collections import deque
 from socket import SocketType
 import selectors
+import struct
+import time
 from enum import Enum
 
 from ..collections import ByteBuffer
@@ -11,11 +13,12 @@ from typing import Union, Tuple, Any, Callable
 
 import logging
 
-__all__ = ["AsyncSocket", "AsyncUDPSocket", "PacketSocket", "ServerSelector", "SelSockType", "bytes_packet_sender", "bytes_packet_reciever"]
+__all__ = ["AsyncSocket", "AsyncUDPSocket", "ReliableUDPSocket", "PacketSocket", "ServerSelector", "SelSockType", "bytes_packet_sender", "bytes_packet_reciever", "BytesPacketFramer"]
 
 logger = logging.getLogger("qlibs.net.asyncsocket")
 
 RECVSIZE = 1024 * 8
+SENDMSG_MAX_BUFFERS = 512 #Should be below IOV_MAX
 
 class AsyncSocket:
     """
@@ -34,6 +37,8 @@ class AsyncSocket:
         self.buff = ByteBuffer(join_with=b"")
         self.send_size = 1024 * 8 #8kib
         self.closed = False
+        self.recv_buffer = None
+        self.on_pending = None #Called without arguments when data is left in buffer after sending
     
     def recv(self, amount: int) -> bytes:
         """Try to recieve data from socket"""
@@ -45,20 +50,62 @@ class AsyncSocket:
             return res
         except BlockingIOError:
             return b""
+
+    def recv_into(self, amount: int = RECVSIZE) -> memoryview:
+        """
+        Same as **recv**, but reads into buffer owned by this socket instead of allocating new bytes.
+        Returned view is only valid until next call.
+        """
+        if self.recv_buffer is None or len(self.recv_buffer) < amount:
+            self.recv_buffer = bytearray(amount)
+        try:
+            res = self.socket.recv_into(self.recv_buffer, amount)
+        except BlockingIOError:
+            return memoryview(b"")
+        if res == 0:
+            logger.debug("Nothing recieved, assuming connection is closed")
+            self.closed = True
+        return memoryview(self.recv_buffer)[:res]
     
     def send(self, data: bytes = None) -> int:
         """Try to send data to socket; this is buffered"""
         if data is not None:
             self.buff.write(data)
-        data_to_send = self.buff.peek(self.send_size)
+        with self.buff.peek(self.send_size) as data_to_send:
+            try:
+                res = self.socket.send(data_to_send)
+            except BlockingIOError:
+                res = 0
+        self.buff.skip(res)
+        if self.on_pending is not None and self.buff.has_values():
+            self.on_pending()
+        return res
+    
+    def send_many(self, buffers) -> int:
+        """
+        Same as **send**, but takes sequence of buffers. When nothing is buffered, 
+        they are sent with one `sendmsg` call, without joining them first.
+        """
+        buffers = list(buffers)
+        if self.buff.has_values() or not hasattr(self.socket, "sendmsg"):
+            for data in buffers:
+                self.buff.write(data)
+            return self.send()
         try:
-            res = self.socket.send(data_to_send)
+            res = self.socket.sendmsg(buffers[:SENDMSG_MAX_BUFFERS])
         except BlockingIOError:
-            return 0
-        else:
-            self.buff.read(res)
-            return res
-    
+            res = 0
+        skip = res
+        for data in buffers:
+            if skip >= len(data):
+                skip -= len(data)
+                continue
+            self.buff.write(memoryview(data)[skip:])
+            skip = 0
+        if self.on_pending is not None and self.buff.has_values():
+            self.on_pending()
+        return res
+
     def accept(self) -> Union[Tuple[SocketType, Any], Tuple[None, None]]:
         """Accept connection asynchronously. Returns (None, None) is not ready"""
         try:
@@ -81,19 +128,29 @@ class PacketSocket:
       Socket for handling packets, passes recieved bytes to generator
     """
     extra = None
-    def __init__(self, socket, processor, *args):
+    def __init__(self, socket, processor, *args, copy=True):
         """**processor** should be a generator. 
         It will recieve new byte when recieving message.
         Use `data = yield` to recieve one byte as int value
+
+        Alternatively **processor** can return an object with `feed(data, copy)` method
+        (like **BytesPacketFramer**), which recieves whole chunks and returns list of packets.
+
+        If *copy* is False, packets are memoryviews into receive buffer, valid until next **recv**.
         """
         
         self.socket = AsyncSocket(socket)
-        self._gen = processor(self, *args)
-        
-
-        self._gen.send(None)
+        processor = processor(self, *args)
+        if hasattr(processor, "feed"):
+            self._framer = processor
+            self._gen = None
+        else:
+            self._framer = None
+            self._gen = processor
+            self._gen.send(None)
         self.reset = False
         self.storage = []
+        self.copy = copy
     
     def send(self, data:bytes = None):
         """Try to send data to socket; this is buffered"""
@@ -103,16 +160,25 @@ class PacketSocket:
             logger.debug(e)
             self.reset = True
     
-    def recv(self, size=RECVSIZE):
-        """Recieve data from socket and feed it to generator"""
-        result = self.storage
-        result.clear()
+    def send_many(self, buffers):
+        """Try to send sequence of buffers to socket with one call; this is buffered"""
         try:
-            data = self.socket.recv(size)
-            for b in data:
-                res = self._gen.send(b)
-                if res is not None:
-                    result.append(res)
+            self.socket.send_many(buffers)
+        except (ConnectionResetError, OSError) as e:
+            logger.debug(e)
+            self.reset = True
+
+    def recv(self, size=RECVSIZE, copy=None):
+        """
+        Recieve data from socket and feed it to generator. Returns new list of packets.
+        *copy* overrides value given to constructor.
+        """
+        if copy is None:
+            copy = self.copy
+        result = self.storage = []
+        try:
+            data = self.socket.recv_into(size)
+            self._process(data, copy, result)
             return result
         except (ConnectionResetError, OSError) as e:
             if self.closed:
@@ -121,6 +187,26 @@ class PacketSocket:
             #print(e) #Probably need to remove this, hovewer useful when sockets are broken
             return result
     
+    def feed(self, data, copy=None):
+        """
+        Process *data* as if it was recieved from socket. Returns new list of packets.
+        Used for bytes that were read before the socket got to this **PacketSocket**.
+        """
+        if copy is None:
+            copy = self.copy
+        result = self.storage = []
+        self._process(data, copy, result)
+        return result
+
+    def _process(self, data, copy, result):
+        if self._framer is not None:
+            result.extend(self._framer.feed(data, copy))
+            return
+        for b in data:
+            res = self._gen.send(b)
+            if res is not None:
+                result.append(res)
+
     @property
     def closed(self):
         return self.reset or self.socket.closed
@@ -149,6 +235,8 @@ class AsyncUDPSocket:
         self.socket = socket
         self.socket.settimeout(0)
         self.buff = deque()
+        self.recv_buffer = None
+        self.on_pending = None #Called without arguments when packets are left in buffer after sending
     
     def recv(self, amount=RECVSIZE):
         """Recieve data, (None, None) returned if no data available"""
@@ -156,19 +244,44 @@ class AsyncUDPSocket:
             return self.socket.recvfrom(amount) #data, adress
         except BlockingIOError:
             return None, None
+
+    def recv_many(self, max_packets=64, amount=RECVSIZE):
+        """
+        Recieve up to *max_packets* packets that are already waiting, returns list of (data, adress) pairs.
+        Data is a memoryview into buffer owned by this socket, valid until next call.
+        """
+        size = max_packets * amount
+        if self.recv_buffer is None or len(self.recv_buffer) < size:
+            self.recv_buffer = bytearray(size)
+        result = []
+        with memoryview(self.recv_buffer) as view:
+            pos = 0
+            for _ in range(max_packets):
+                try:
+                    res, adress = self.socket.recvfrom_into(view[pos:pos+amount], amount)
+                except BlockingIOError:
+                    break
+                result.append((view[pos:pos+res], adress))
+                pos += amount
+        return result
     
     def sendto_buff(self, data, adress):
-        """Try to send packet to adress; with buffer"""
+        """Try to send packet to adress; with buffer. Returns amount of packets sent"""
         self.buff.append((data, adress))
+        return self.send()
+
+    def send(self):
+        """Try to send buffered packets, returns amount of packets sent"""
         counter = 0
         while self.buff:
             try:
-                res = self.socket.sendto(*self.data[0]) #TODO: add hostname resolution
-                counter += 1
-                self.data.popleft()
+                self.socket.sendto(*self.buff[0]) #TODO: add hostname resolution
             except BlockingIOError:
                 break
-            
+            counter += 1
+            self.buff.popleft()
+        if self.on_pending is not None and self.buff:
+            self.on_pending()
         return counter
         
     def sendto(self, data, adress):
@@ -178,6 +291,233 @@ class AsyncUDPSocket:
             return True
         except BlockingIOError:
             return False
+
+    def empty(self) -> bool:
+        """True if no packets to send left"""
+        return not self.buff
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def close(self):
+        self.socket.close()
+
+
+class _Peer:
+    """State of **ReliableUDPSocket** for one adress"""
+    def __init__(self):
+        self.local_seq = 0
+        self.remote_seq = None
+        self.received_bits = 0 #Bit i is set if packet remote_seq-1-i was recieved
+        self.ack_needed = False
+        self.unacked = dict() #(kind, message id) -> [data, first sent, last sent, packet seqs]
+        self.in_flight = dict() #packet seq -> (kind, message id)
+        self.next_id = [0, 0] #Next message id for ordered and unordered messages
+        self.expected = 0 #Next ordered message id to deliver
+        self.waiting = dict() #ordered messages that came too early, id -> data
+        self.seen = set() #Recent unordered message ids
+        self.seen_order = deque()
+        self.rtt = None
+
+
+def _seq_greater(a, b):
+    """True if 16-bit sequence number *a* is newer than *b*"""
+    return (a > b and a - b <= 32768) or (a < b and b - a > 32768)
+
+
+class ReliableUDPSocket:
+    """
+      Reliability layer over **AsyncUDPSocket**.
+
+      Every packet has a sequence number and acknowledges last 33 packets of the other side, 
+      so acks don't need packets of their own while there is traffic both ways.
+      Reliable messages are resent (with new sequence number) until one of packets carrying them is acked.
+      Ordered messages are delivered in the same order they were sent, unordered ones as soon as they come.
+      Unreliable messages are just sent once.
+
+      Can be registered in **ServerSelector**, which calls **update** in time. Otherwise **update** should be
+      called at least every **next_timeout** seconds.
+      Messages should fit in one datagram, keep them under MTU to avoid fragmentation.
+    """
+    UNRELIABLE = 0
+    ORDERED = 1
+    UNORDERED = 2
+    ACK = 3
+    HAS_ACK = 0x80 #Set in kind when ack field is valid
+    ACK_WINDOW = 33 #Packets that can still be acked: latest one and 32 before it
+    header_struct = struct.Struct("!BHHIH") #kind, seq, ack, ack bits, message id
+    extra = None
+
+    def __init__(self, socket):
+        """*socket* is either **AsyncUDPSocket** or UDP socket"""
+        if not isinstance(socket, AsyncUDPSocket):
+            socket = AsyncUDPSocket(socket)
+        self.socket = socket
+        self.peers = dict()
+        self.min_resend_delay = 0.05
+        self.max_resend_delay = 1.0
+        self.seen_window = 1024
+
+    def _peer(self, adress):
+        peer = self.peers.get(adress)
+        if peer is None:
+            peer = self.peers[adress] = _Peer()
+        return peer
+
+    def _send_packet(self, peer, adress, kind, message_id, data=b""):
+        seq = peer.local_seq
+        peer.local_seq = (seq + 1) & 0xFFFF
+        if peer.remote_seq is not None:
+            header = self.header_struct.pack(kind | self.HAS_ACK, seq, peer.remote_seq, peer.received_bits, message_id)
+        else:
+            header = self.header_struct.pack(kind, seq, 0, 0, message_id)
+        peer.ack_needed = False
+        self.socket.sendto_buff(header + data, adress)
+        return seq
+
+    def send_unreliable(self, data, adress):
+        """Send *data* once, it can be lost, duplicated or reordered"""
+        self._send_packet(self._peer(adress), adress, self.UNRELIABLE, 0, data)
+
+    def send_reliable(self, data, adress, ordered=True):
+        """Send *data* until it is acknowledged"""
+        peer = self._peer(adress)
+        kind = self.ORDERED if ordered else self.UNORDERED
+        message_id = peer.next_id[kind - 1]
+        peer.next_id[kind - 1] = (message_id + 1) & 0xFFFF
+        now = time.monotonic()
+        seq = self._send_packet(peer, adress, kind, message_id, data)
+        key = (kind, message_id)
+        peer.unacked[key] = [data, now, now, [seq]]
+        peer.in_flight[seq] = key
+
+    def resend_delay(self, peer):
+        if peer.rtt is None:
+            return self.max_resend_delay / 4
+        return min(self.max_resend_delay, max(self.min_resend_delay, peer.rtt * 2))
+
+    def update(self):
+        """Resends messages that weren't acknowledged in time, sends acks that weren't piggybacked"""
+        now = time.monotonic()
+        for adress, peer in self.peers.items():
+            delay = self.resend_delay(peer)
+            for key, message in peer.unacked.items():
+                if now - message[2] >= delay:
+                    seq = self._send_packet(peer, adress, key[0], key[1], message[0])
+                    message[2] = now
+                    #Packets that fell out of ack window will never be acked
+                    seqs = []
+                    for old in message[3]:
+                        if (seq - old) & 0xFFFF < self.ACK_WINDOW:
+                            seqs.append(old)
+                        else:
+                            peer.in_flight.pop(old, None)
+                    seqs.append(seq)
+                    message[3] = seqs
+                    peer.in_flight[seq] = key
+            if peer.ack_needed:
+                self._send_packet(peer, adress, self.ACK, 0)
+
+    def next_timeout(self):
+        """Seconds until next resend is due, None if nothing waits for ack"""
+        now = time.monotonic()
+        timeout = None
+        for peer in self.peers.values():
+            delay = self.resend_delay(peer)
+            for message in peer.unacked.values():
+                left = max(0, message[2] + delay - now)
+                if timeout is None or left < timeout:
+                    timeout = left
+        return timeout
+
+    def _on_ack(self, peer, seq, now):
+        key = peer.in_flight.pop(seq, None)
+        if key is None:
+            return
+        message = peer.unacked.pop(key)
+        for other in message[3]:
+            peer.in_flight.pop(other, None)
+        if message[1] == message[2]: #Resent messages don't tell which packet was acked
+            latency = now - message[1]
+            peer.rtt = latency if peer.rtt is None else peer.rtt + (latency - peer.rtt) / 8
+
+    def _on_packet(self, adress, packet, result):
+        size = self.header_struct.size
+        if len(packet) < size:
+            logger.debug("Packet from %s is too short", adress)
+            return
+        kind, seq, ack, ack_bits, message_id = self.header_struct.unpack_from(packet)
+        data = bytes(packet[size:])
+        peer = self._peer(adress)
+        if kind & self.HAS_ACK:
+            kind &= ~self.HAS_ACK
+            now = time.monotonic()
+            self._on_ack(peer, ack, now)
+            i = 0
+            while ack_bits:
+                if ack_bits & 1:
+                    self._on_ack(peer, (ack - 1 - i) & 0xFFFF, now)
+                ack_bits >>= 1
+                i += 1
+        if peer.remote_seq is None:
+            peer.remote_seq = seq
+        elif _seq_greater(seq, peer.remote_seq):
+            shift = (seq - peer.remote_seq) & 0xFFFF
+            peer.received_bits = ((peer.received_bits << shift) | (1 << (shift - 1))) & 0xFFFFFFFF
+            peer.remote_seq = seq
+        else:
+            shift = (peer.remote_seq - seq) & 0xFFFF
+            if 0 < shift <= 32:
+                peer.received_bits |= 1 << (shift - 1)
+        if kind == self.UNRELIABLE:
+            result.append((data, adress))
+        elif kind == self.ORDERED:
+            peer.ack_needed = True
+            if message_id == peer.expected:
+                result.append((data, adress))
+                peer.expected = (peer.expected + 1) & 0xFFFF
+                while peer.expected in peer.waiting:
+                    result.append((peer.waiting.pop(peer.expected), adress))
+                    peer.expected = (peer.expected + 1) & 0xFFFF
+            elif _seq_greater(message_id, peer.expected):
+                peer.waiting[message_id] = data
+        elif kind == self.UNORDERED:
+            peer.ack_needed = True
+            if message_id not in peer.seen:
+                peer.seen.add(message_id)
+                peer.seen_order.append(message_id)
+                if len(peer.seen_order) > self.seen_window:
+                    peer.seen.discard(peer.seen_order.popleft())
+                result.append((data, adress))
+
+    def recv(self, max_packets=64):
+        """
+        Recieve waiting packets, returns list of (data, adress) pairs of delivered messages.
+        Acks for recieved reliable messages are sent right away.
+        """
+        result = []
+        for packet, adress in self.socket.recv_many(max_packets):
+            self._on_packet(adress, packet, result)
+        for adress, peer in self.peers.items():
+            if peer.ack_needed:
+                self._send_packet(peer, adress, self.ACK, 0)
+        return result
+
+    def forget(self, adress):
+        """Drop state (including unacknowledged messages) of *adress*"""
+        self.peers.pop(adress, None)
+
+    def send(self):
+        return self.socket.send()
+
+    def empty(self) -> bool:
+        return self.socket.empty()
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def close(self):
+        self.socket.close()
     
     
 class SelSockType(Enum):
@@ -186,37 +526,104 @@ class SelSockType(Enum):
 
 
 class ServerSelector:
+    """
+    Calls *on_read* when registered sockets are readable. Sockets are only watched for 
+    writability while they have buffered data, so **select** with timeout doesn't return early.
+    Timers (objects with `next_timeout()` and `update()`, like **ReliableUDPSocket**) are updated
+    after every **select**, which waits at most until the nearest of them is due.
+    """
     def __init__(self, listener: SocketType, on_connect: Callable, on_read: Callable):
+        """
+        *listener* can be None, then sockets are only added with **register**.
+        """
         self.selector = selectors.DefaultSelector()
         self.on_connect = on_connect
         self.on_read = on_read
-        self.sock = AsyncSocket(listener)
         self.sockets = dict()
-        self.selector.register(self.sock.socket, selectors.EVENT_READ, SelSockType.ACCEPTER)
+        self.readers = dict() #fd -> callback for sockets registered with their own one
+        self.writing = set() #fds that are watched for writability
+        self.timers = set()
+        if listener is not None:
+            self.sock = AsyncSocket(listener)
+            self.selector.register(self.sock.socket, selectors.EVENT_READ, SelSockType.ACCEPTER)
+        else:
+            self.sock = None
     
     def select(self, timeout=None):
+        for timer in self.timers:
+            left = timer.next_timeout()
+            if left is not None and (timeout is None or left < timeout):
+                timeout = left
         events = self.selector.select(timeout)
         for key, mask in events:
             if mask & selectors.EVENT_READ:
                 if key.data is SelSockType.ACCEPTER:
                     self._on_connect()
-                if key.data is SelSockType.NORMAL:
-                    self.on_read(self.sockets[key.fd])
+                elif key.data is SelSockType.NORMAL:
+                    asock = self.sockets.get(key.fd)
+                    if asock is None:
+                        continue #Unregistered by previous callback
+                    self.readers.get(key.fd, self.on_read)(asock)
+                elif callable(key.data):
+                    key.data()
             if mask & selectors.EVENT_WRITE:
-                try:
-                    self.sockets[key.fd].send()
-                except KeyError as e:
-                    pass #Socket is already unregistered, but selector still selected it
+                asock = self.sockets.get(key.fd)
+                if asock is None:
+                    continue #Socket is already unregistered, but selector still selected it
+                asock.send()
+                if asock.empty() and key.fd in self.writing:
+                    self.writing.discard(key.fd)
+                    self.selector.modify(asock.socket, selectors.EVENT_READ, SelSockType.NORMAL)
+        for timer in list(self.timers):
+            timer.update()
 
-    def register(self, asock: Union[AsyncSocket, PacketSocket]):
+    def register(self, asock: Union[AsyncSocket, PacketSocket, AsyncUDPSocket, ReliableUDPSocket], on_read: Callable = None):
+        """
+        Watches *asock*, *on_read* is called instead of selector's one when it is readable, if given.
+        **ReliableUDPSocket** is added to timers as well
+        """
         key = asock.socket.fileno()
         self.sockets[key] = asock
-        self.selector.register(asock.socket, selectors.EVENT_READ | selectors.EVENT_WRITE, SelSockType.NORMAL)
+        if on_read is not None:
+            self.readers[key] = on_read
+        self.selector.register(asock.socket, selectors.EVENT_READ, SelSockType.NORMAL)
+        inner = asock.socket if isinstance(asock, (PacketSocket, ReliableUDPSocket)) else asock
+        inner.on_pending = lambda: self._want_write(key)
+        if isinstance(asock, ReliableUDPSocket):
+            self.add_timer(asock)
+        if not asock.empty():
+            self._want_write(key)
+
+    def add_timer(self, timer):
+        """*timer* gets `update()` calls after every **select**, at least every `timer.next_timeout()` seconds"""
+        self.timers.add(timer)
+
+    def remove_timer(self, timer):
+        self.timers.discard(timer)
+
+    def _want_write(self, key):
+        if key in self.writing or key not in self.sockets:
+            return
+        self.writing.add(key)
+        asock = self.sockets[key]
+        self.selector.modify(asock.socket, selectors.EVENT_READ | selectors.EVENT_WRITE, SelSockType.NORMAL)
+
+    def add_reader(self, sock, callback: Callable):
+        """Calls *callback* without arguments when *sock* (anything with fileno) is readable"""
+        self.selector.register(sock, selectors.EVENT_READ, callback)
+
+    def remove_reader(self, sock):
+        self.selector.unregister(sock)
 
     def unregister(self, asock: Union[AsyncSocket, PacketSocket]):
         key = asock.socket.fileno()
         self.selector.unregister(asock.socket)
         del self.sockets[key]
+        self.readers.pop(key, None)
+        self.writing.discard(key)
+        self.timers.discard(asock)
+        inner = asock.socket if isinstance(asock, (PacketSocket, ReliableUDPSocket)) else asock
+        inner.on_pending = None
     
     @property
     def socket_iterator(self):
@@ -253,9 +660,63 @@ def bytes_packet_reciever(sock):
         for _ in range(l):
             res.append((yield))
         sock.storage.append(bytes(res))
-            
-                
-            
 
 
-    
\ No newline at end of file
+class BytesPacketFramer:
+    """
+      Splits stream into packets made by **bytes_packet_sender**.
+      Does the same as **bytes_packet_reciever**, but works with whole chunks instead of single bytes.
+      Can be used as **PacketSocket** processor: `PacketSocket(sock, BytesPacketFramer)`
+    """
+    def __init__(self, sock=None):
+        self.sock = sock
+        self.buff = bytearray()
+
+    def feed(self, data, copy=True) -> list:
+        """
+        Consume *data*, return list of packets (bytes) that were completed by it.
+        If *copy* is False, packets are memoryviews into *data* or internal buffer,
+        so they are only valid while *data* isn't changed.
+        """
+        packets = []
+        if self.buff:
+            buff = self.buff
+            buff += data
+            consumed = self._split(buff, packets, copy)
+            if copy:
+                del buff[:consumed]
+            else:
+                #Views keep old buffer alive, it can't be resized
+                self.buff = bytearray(memoryview(buff)[consumed:])
+        else:
+            #Fast path: nothing is pending, so packets can be sliced from data directly
+            consumed = self._split(data, packets, copy)
+            if consumed < len(data):
+                self.buff += memoryview(data)[consumed:]
+        return packets
+
+    @staticmethod
+    def _split(data, packets, copy=True):
+        """Appends complete packets from *data* to *packets*, returns amount of bytes used"""
+        end = len(data)
+        pos = 0
+        with memoryview(data) as view:
+            while pos < end:
+                length = 0
+                shift = 0
+                cur = pos
+                while cur < end:
+                    n = data[cur]
+                    cur += 1
+                    length |= (n & 0b1111111) << shift
+                    if n < 0b10000000:
+                        break
+                    shift += 7
+                else:
+                    break #Length prefix is incomplete
+                if cur + length > end:
+                    break
+                packet = view[cur:cur+length]
+                packets.append(bytes(packet) if copy else packet)
+                pos = cur + length
+        return pos
@@ -1,8 +1,11 @@
+import asyncio
+import socket as socket_module
 from collections import deque
 from . import qpacket #TODO - remove this
 
 BYTE_ORDER = "big"
 INT_SIZE = 4
+SENDMSG_MAX_BUFFERS = 512 #Should be below IOV_MAX
 
 
 def num_to_b(inp, size=INT_SIZE):
@@ -13,6 +16,35 @@ def b_to_num(inp):
     return int.from_bytes(inp, BYTE_ORDER)
 
 
+def recv_exact(socket, size):
+    """Blocking read of exactly *size* bytes, raises ConnectionError if socket is closed earlier"""
+    res = bytearray(size)
+    view = memoryview(res)
+    got = 0
+    while got < size:
+        n = socket.recv_into(view[got:])
+        if n == 0:
+            raise ConnectionError("Connection closed")
+        got += n
+    return bytes(res)
+
+
+def sendmsg_all(socket, buffers):
+    """Sends all *buffers*, coalescing them with `sendmsg` where possible"""
+    buffers = deque(memoryview(b).cast("B") for b in buffers)
+    while buffers:
+        if hasattr(socket, "sendmsg"):
+            sent = socket.sendmsg(list(buffers)[:SENDMSG_MAX_BUFFERS])
+        else:
+            sent = socket.send(buffers[0])
+        while sent:
+            if sent >= len(buffers[0]):
+                sent -= len(buffers.popleft())
+            else:
+                buffers[0] = buffers[0][sent:]
+                sent = 0
+
+
 class AsyncAdvWriter:
     def __init__(self, writer):
         self.writer = writer
@@ -36,8 +68,8 @@ class AsyncAdvReader:
         self.reader = reader
 
     async def read(self):
-        size = b_to_num(await self.reader.read(INT_SIZE))
-        return await self.reader.read(size)
+        size = b_to_num(await self.reader.readexactly(INT_SIZE))
+        return await self.reader.readexactly(size)
 
     async def read_num(self):
         return await b_to_num(self.read())
@@ -63,12 +95,27 @@ class AdvRW:
         self.write(num_to_b(data))
 
     def send(self):
+        """Sends as much of queued packets as possible with one call"""
         if len(self.current) == 0:
             if len(self.packets) > 0:
                 self.current = self.packets.popleft()
             else:
                 return None
 
+        if self.packets and hasattr(self.socket, "sendmsg"):
+            buffers = [self.current]
+            buffers.extend(self.packets)
+            sent = self.socket.sendmsg(buffers[:SENDMSG_MAX_BUFFERS])
+            left = sent
+            while left >= len(self.current):
+                left -= len(self.current)
+                if not self.packets:
+                    self.current = b""
+                    return sent
+                self.current = self.packets.popleft()
+            self.current = self.current[left:]
+            return sent
+
         sent = self.socket.send(self.current)
         self.current = self.current[sent:]
         return sent
@@ -84,8 +131,8 @@ class AdvRW:
                     return
 
     def read(self):
-        size = b_to_num(self.socket.recv(INT_SIZE))
-        return self.socket.recv(size)
+        size = b_to_num(recv_exact(self.socket, INT_SIZE))
+        return recv_exact(self.socket, size)
 
     def read_num(self):
         return b_to_num(self.read())
@@ -98,9 +145,9 @@ class RWConvertable:
     def __init__(self, socket):
         self.socket = socket
         self.current = b""
-        self.recv = qpacket.ByteBuffer()
+        self.recv = qpacket.ByteBuffer(join_with=b"")
         self.packets = deque()
-        self.decoder = qpacket.Decoder()
+        self.decoder = qpacket.StreamDecoder()
         self.r_size = None
 
     def write(self, data):
@@ -133,18 +180,16 @@ class RWConvertable:
         return (self.send(), self.recv_data())
 
     def recv_data(self):
-        # print("Starting recv")
         self.recv.write(self.socket.recv(2048))
-        # print("Write ended")
-        while True:
-            if sum(map(len, self.recv.data)) > INT_SIZE and self.r_size is None:
-                self.r_size = b_to_num(self.recv.read(4))
-
-            if self.r_size is not None:
-                self.decoder.feed(self.recv.read(self.r_size))
-                self.r_size = None
-            else:
-                break
+        while self.recv.has_values():
+            if self.r_size is None:
+                if len(self.recv) < INT_SIZE:
+                    break
+                self.r_size = b_to_num(self.recv.read(INT_SIZE))
+            if len(self.recv) < self.r_size:
+                break #Payload is fed to decoder in one piece once it is complete
+            self.decoder.feed(self.recv.read(self.r_size))
+            self.r_size = None
 
     def read(self):
         if self.decoder.has_values():
@@ -156,4 +201,196 @@ class RWConvertable:
         self.socket.close()
 
     def debug_data(self):
-        return (*self.recv.data, *self.decoder.io.data)
+        return (bytes(self.recv.peek()), self.decoder.pending)
+
+
+class PipelinedConnection:
+    """
+    Blocking connection that can have many requests in flight.
+    Every packet is prefixed with request id, so server should answer with the same id
+    (echoing whole packet works), answers can come in any order.
+    If *convert* is True, requests are converted with qpacket and answers are decoded.
+    """
+    def __init__(self, socket, convert=False):
+        self.socket = socket
+        self.convert = convert
+        self.queued = []
+        self.next_id = 0
+        self.outstanding = set()
+        self.responses = dict() #request id -> answer, for answers that came before they were asked for
+
+    def request(self, data):
+        """Queues request, returns its id. Requests are sent by **flush** or **get**"""
+        request_id = self.next_id
+        self.next_id = (self.next_id + 1) & 0xFFFFFFFF
+        if self.convert:
+            data = qpacket.convert(data)
+        self.queued.append(num_to_b(len(data) + INT_SIZE) + num_to_b(request_id))
+        self.queued.append(data)
+        self.outstanding.add(request_id)
+        return request_id
+
+    def flush(self):
+        """Sends every queued request at once"""
+        if self.queued:
+            queued, self.queued = self.queued, []
+            sendmsg_all(self.socket, queued)
+
+    def _read_response(self):
+        size = b_to_num(recv_exact(self.socket, INT_SIZE))
+        data = recv_exact(self.socket, size)
+        request_id = b_to_num(data[:INT_SIZE])
+        data = data[INT_SIZE:]
+        if self.convert:
+            data = next(qpacket.decode(data))
+        return request_id, data
+
+    def get(self, request_id):
+        """Blocks until answer to *request_id* arrives"""
+        if request_id not in self.outstanding:
+            raise ValueError("No request with id %s" % request_id)
+        self.flush()
+        while request_id not in self.responses:
+            other_id, data = self._read_response()
+            self.responses[other_id] = data
+        self.outstanding.discard(request_id)
+        return self.responses.pop(request_id)
+
+    def close(self):
+        self.socket.close()
+
+
+class PendingRequest:
+    def __init__(self, connection, request_id):
+        self.connection = connection
+        self.request_id = request_id
+
+    def result(self):
+        return self.connection.get(self.request_id)
+
+
+class ConnectionPool:
+    """
+    Keeps *size* persistent **PipelinedConnection** per (host, port) endpoint.
+    Requests go to connection with least requests in flight. Not thread safe.
+    """
+    def __init__(self, size=4, convert=False):
+        self.size = size
+        self.convert = convert
+        self.connections = dict() #endpoint -> list of connections
+
+    def _connection(self, endpoint):
+        conns = self.connections.setdefault(endpoint, [])
+        if len(conns) < self.size:
+            sock = socket_module.create_connection(endpoint)
+            sock.setsockopt(socket_module.IPPROTO_TCP, socket_module.TCP_NODELAY, 1)
+            conns.append(PipelinedConnection(sock, self.convert))
+            return conns[-1]
+        return min(conns, key=lambda conn: len(conn.outstanding))
+
+    def request(self, endpoint, data) -> PendingRequest:
+        """Queues request to *endpoint*, use `result()` of returned object to get answer"""
+        conn = self._connection(endpoint)
+        return PendingRequest(conn, conn.request(data))
+
+    def request_many(self, endpoint, requests):
+        """Sends all *requests* pipelined over pool connections, returns list of answers"""
+        pending = [self.request(endpoint, data) for data in requests]
+        for conn in self.connections[endpoint]:
+            conn.flush()
+        return [req.result() for req in pending]
+
+    def close(self):
+        for conns in self.connections.values():
+            for conn in conns:
+                conn.close()
+        self.connections.clear()
+
+
+class AsyncPipelinedConnection:
+    """
+    asyncio version of **PipelinedConnection**: answers are read by a background task
+    and resolve futures returned by **request**.
+    """
+    def __init__(self, reader, writer, convert=False):
+        self.reader = AsyncAdvReader(reader)
+        self.writer = writer
+        self.convert = convert
+        self.next_id = 0
+        self.outstanding = dict() #request id -> future
+        self.task = asyncio.get_running_loop().create_task(self._read_loop())
+
+    @classmethod
+    async def connect(cls, host, port, convert=False):
+        reader, writer = await asyncio.open_connection(host, port)
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket_module.IPPROTO_TCP, socket_module.TCP_NODELAY, 1)
+        return cls(reader, writer, convert)
+
+    def request(self, data) -> asyncio.Future:
+        """Sends request, returns future with answer"""
+        request_id = self.next_id
+        self.next_id = (self.next_id + 1) & 0xFFFFFFFF
+        if self.convert:
+            data = qpacket.convert(data)
+        future = asyncio.get_running_loop().create_future()
+        self.outstanding[request_id] = future
+        #Writes in one loop iteration are coalesced by transport
+        self.writer.writelines((num_to_b(len(data) + INT_SIZE), num_to_b(request_id), data))
+        return future
+
+    async def _read_loop(self):
+        try:
+            while True:
+                data = await self.reader.read()
+                future = self.outstanding.pop(b_to_num(data[:INT_SIZE]), None)
+                if future is None or future.done():
+                    continue
+                data = data[INT_SIZE:]
+                future.set_result(next(qpacket.decode(data)) if self.convert else data)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            for future in self.outstanding.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Connection closed"))
+            self.outstanding.clear()
+
+    async def close(self):
+        self.writer.close()
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+
+class AsyncConnectionPool:
+    """asyncio version of **ConnectionPool**"""
+    def __init__(self, size=4, convert=False):
+        self.size = size
+        self.convert = convert
+        self.connections = dict()
+        self.locks = dict()
+
+    async def _connection(self, endpoint):
+        conns = self.connections.setdefault(endpoint, [])
+        if len(conns) < self.size:
+            async with self.locks.setdefault(endpoint, asyncio.Lock()):
+                if len(conns) < self.size:
+                    conns.append(await AsyncPipelinedConnection.connect(*endpoint, convert=self.convert))
+                    return conns[-1]
+        return min(conns, key=lambda conn: len(conn.outstanding))
+
+    async def request(self, endpoint, data):
+        """Sends request to *endpoint*, returns answer"""
+        conn = await self._connection(endpoint)
+        return await conn.request(data)
+
+    async def request_many(self, endpoint, requests):
+        return await asyncio.gather(*(self.request(endpoint, data) for data in requests))
+
+    async def close(self):
+        for conns in self.connections.values():
+            for conn in conns:
+                await conn.close()
+        self.connections.clear()
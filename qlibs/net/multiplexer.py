@@ -1,12 +1,27 @@
 from .asyncsocket import *
+import select
 import socket
 import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from threading import Lock, Thread
 import time
 import logging
+import zlib
+from .qpacket import pack_varint
+from .recording import MultiplexRecorder, read_recording
 logger = logging.getLogger("qlibs.net.multiplexer")
 
 base_struct = struct.Struct("!iiid")
+diff_header_struct = struct.Struct("!II")
+compact_timedelta = struct.Struct("!d") #Same precision as legacy frames, so all clients step alike
+
+#Flags of options packet (type 8), sent by client and confirmed by server
+FLAG_COMPACT = 1 #Server sends one batch of compact events per step
+FLAG_ZLIB = 2 #Batches over compress_threshold can be compressed
+#First byte of compact batch
+COMPACT_BATCH = 16
+COMPACT_BATCH_ZLIB = 17
 
 class PlayerJoinedEvent:
     name = "playerjoined"
@@ -43,10 +58,22 @@ class ReadyEvent:
 
 class ReconstructEvent:
     name = "reconstruct"
-    def __init__(self, data):
+    def __init__(self, data, step=0):
         if type(data) != bytes:
             raise ValueError("Data is not bytes")
         self.data = data
+        self.step = step
+
+
+class ReconstructDiffEvent:
+    """State at *step*, as a diff (made by **snapshot_diff**) against state at *base_step*"""
+    name = "reconstructdiff"
+    def __init__(self, diff, step, base_step):
+        if type(diff) != bytes:
+            raise ValueError("Data is not bytes")
+        self.diff = diff
+        self.step = step
+        self.base_step = base_step
 
 
 class MultiplexerException(Exception): pass
@@ -62,81 +89,340 @@ def convert_event(event):
     elif event.name == "playerleft":
         return base_struct.pack(4, event.player_id, 0, 0)
     elif event.name == "reconstruct":
-        return base_struct.pack(5, 0, 0, 0) + event.data
+        return base_struct.pack(5, 0, event.step, 0) + event.data
+    elif event.name == "reconstructdiff":
+        return base_struct.pack(6, event.base_step, event.step, 0) + event.diff
+    else:
+        raise ValueError("Unknown event %s" % event)
+
+
+def convert_event_compact(event):
+    """Encodes event as type byte followed by varint fields, without padding"""
+    if event.name == "ready":
+        return b"\x01" + compact_timedelta.pack(event.timedelta)
+    elif event.name == "payload":
+        return b"\x02" + pack_varint(event.player_id) + pack_varint(len(event.data)) + event.data
+    elif event.name == "playerjoined":
+        return b"\x03" + pack_varint(event.player_id)
+    elif event.name == "playerleft":
+        return b"\x04" + pack_varint(event.player_id)
+    elif event.name == "reconstruct":
+        return b"\x05" + pack_varint(event.step) + pack_varint(len(event.data)) + event.data
+    elif event.name == "reconstructdiff":
+        return b"\x06" + pack_varint(event.step) + pack_varint(event.base_step) + pack_varint(len(event.diff)) + event.diff
     else:
         raise ValueError("Unknown event %s" % event)
 
 
-class MultiplexServer:
+def _read_varint(data, pos):
+    value = 0
+    shift = 0
+    while True:
+        n = data[pos]
+        pos += 1
+        value |= (n & 0b1111111) << shift
+        if n < 0b10000000:
+            return value, pos
+        shift += 7
+
+
+def iter_compact_events(data):
     """
-    Server for multiplexer
+    Yields events of compact batch body *data* as (type, int, int, float, payload) tuples,
+    with the same meaning as fields of **base_struct** packets.
     """
-    def __init__(self, host="0.0.0.0", port=55126, engine_packer=None):
-        sock = socket.socket()
-        sock.bind((host, port))
-        sock.listen()
-        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-        self.socket_selector = ServerSelector(sock, self._on_connect, self._on_read)
-        self.events = []
-        self.passed_events = []
+    pos = 0
+    end = len(data)
+    while pos < end:
+        kind = data[pos]
+        pos += 1
+        if kind == 1:
+            yield 1, 0, 0, compact_timedelta.unpack_from(data, pos)[0], b""
+            pos += compact_timedelta.size
+        elif kind == 2:
+            player_id, pos = _read_varint(data, pos)
+            size, pos = _read_varint(data, pos)
+            yield 2, player_id, 0, 0, bytes(data[pos:pos+size])
+            pos += size
+        elif kind == 3 or kind == 4:
+            player_id, pos = _read_varint(data, pos)
+            yield kind, player_id, 0, 0, b""
+        elif kind == 5:
+            step, pos = _read_varint(data, pos)
+            size, pos = _read_varint(data, pos)
+            yield 5, 0, step, 0, bytes(data[pos:pos+size])
+            pos += size
+        elif kind == 6:
+            step, pos = _read_varint(data, pos)
+            base_step, pos = _read_varint(data, pos)
+            size, pos = _read_varint(data, pos)
+            yield 6, base_step, step, 0, bytes(data[pos:pos+size])
+            pos += size
+        else:
+            raise MultiplexerException("Unknown compact event type %s" % kind)
+
+
+def compact_batch(records, compress_threshold=None):
+    """
+    Frames compact *records* as one packet. Body is compressed with zlib if it is at least 
+    *compress_threshold* bytes long and compression helps.
+    """
+    body = b"".join(records)
+    if compress_threshold is not None and len(body) >= compress_threshold:
+        compressed = zlib.compress(body, 1)
+        if len(compressed) < len(body):
+            return bytes_packet_sender(bytes((COMPACT_BATCH_ZLIB,)) + compressed)
+    return bytes_packet_sender(bytes((COMPACT_BATCH,)) + body)
+
+
+def snapshot_diff(old, new, block=64):
+    """
+    Makes binary diff which turns *old* into *new*: blocks of *block* bytes that changed are stored as they are
+    """
+    parts = [diff_header_struct.pack(len(new), 0)]
+    count = 0
+    start = None
+    common = min(len(old), len(new))
+    with memoryview(old) as old_view, memoryview(new) as new_view:
+        for offset in range(0, len(new), block):
+            changed = offset + block > common or old_view[offset:offset+block] != new_view[offset:offset+block]
+            if changed and start is None:
+                start = offset
+            elif not changed and start is not None:
+                parts.append(diff_header_struct.pack(start, offset - start) + new_view[start:offset].tobytes())
+                count += 1
+                start = None
+        if start is not None:
+            parts.append(diff_header_struct.pack(start, len(new) - start) + new_view[start:].tobytes())
+            count += 1
+    parts[0] = diff_header_struct.pack(len(new), count)
+    return b"".join(parts)
+
+
+def apply_snapshot_diff(old, diff):
+    """Applies diff made by **snapshot_diff** to *old*, returns new bytes"""
+    length, count = diff_header_struct.unpack_from(diff)
+    res = bytearray(old[:length])
+    res.extend(bytes(length - len(res)))
+    pos = diff_header_struct.size
+    for _ in range(count):
+        start, size = diff_header_struct.unpack_from(diff, pos)
+        pos += diff_header_struct.size
+        res[start:start+size] = diff[pos:pos+size]
+        pos += size
+    return bytes(res)
+
+
+class MultiplexServerBase:
+    """
+    Transport independent part of multiplexer server.
+    Connections only need to have `send(data)` and `send_many(buffers)` methods, subclasses provide `_connections()`.
+
+    Every event is encoded once, when it happens. Encoded frames are queued and sent to every 
+    connection by **_flush**, and kept in *passed_frames* for players that join later.
+    Clients that asked for compact events (and *compact_events* is True) instead get
+    one batch per step, compressed when it is at least *compress_threshold* bytes (if *compression* is True).
+
+    Steps are numbered. If there is *engine_packer*, keyframes (packed state at the beginning of a step)
+    are made at step boundaries, at most every *pack_delay* seconds, or earlier when *passed_frames* 
+    grows past half of *max_passed_frames*. Joining player gets the latest keyframe and frames after it,
+    so these frames are kept even past *max_passed_frames* until next keyframe. Without *engine_packer*
+    oldest frames are dropped instead.
+    With *pack_in_thread*, *engine_packer* is called in a worker thread, so it should be thread safe.
+
+    Catch-up is sent after the first packet of a player (other than options packet), so that 
+    options can be negotiated. If it is a resume packet with step of a keyframe that server 
+    still has (last *max_keyframes* are kept), only diff is sent.
+
+    Event stream can be recorded with **start_recording**.
+    """
+    def __init__(self, engine_packer=None):
+        self.passed_frames = deque() #(step, frame, compact record) tuples
+        self.max_passed_frames = 4096
+        self._outgoing = []
+        self._step_records = []
         self.current_player_id = -1
-        self.fd_to_id = dict()
         self.step = 0
         self.ready_players = set()
         self.players = 0
-        self.run_thread = True
         self.last_ready = time.monotonic()
         self.engine_packer = engine_packer
         self.state = None
-        #if self.engine_packer is not None:
-        #    self.state = self.engine_packer()
-        self.time_between_selection = 0.001
+        self.state_step = None
+        self.keyframes = deque() #(step, state) pairs, newest last
+        self.max_keyframes = 4
         self.last_pack = time.monotonic()
         self.pack_delay = 2
+        self.pack_in_thread = False
+        self._executor = None
+        self._pack_future = None
+        self._pack_step = None
+        self.compact_events = True
+        self.compression = True
+        self.compress_threshold = 256
+        self._waiting = dict() #player id -> [connection, flags], for players that didn't get catch-up yet
+        self._compact_conns = dict() #player id -> (connection, flags)
+        self.recorder = None
 
-    def _on_connect(self, sock, addr):
-        logger.info("Connection from %s", addr)
-        self.current_player_id += 1
-        self.fd_to_id[sock.fileno()] = self.current_player_id
-        sock = PacketSocket(sock, bytes_packet_reciever)
-        data = base_struct.pack(0, self.current_player_id, self.step, 0) #Hello packet
-        sock.send(bytes_packet_sender(data))
-        if self.engine_packer is not None:
-            if time.monotonic() - self.last_pack > self.pack_delay:
-                self.state = self.engine_packer() or self.state
-                self.passed_events.clear()
+    def start_recording(self, file):
+        """Records events to *file* (path or binary file), starting with latest keyframe and events after it"""
+        self.stop_recording()
+        self.recorder = MultiplexRecorder(file)
+        if self.state is not None:
+            self.recorder.record(bytes_packet_sender(convert_event(ReconstructEvent(self.state, self.state_step))))
+        for _, frame, _ in self.passed_frames:
+            self.recorder.record(frame)
+
+    def stop_recording(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+    def _connections(self):
+        raise NotImplementedError
+
+    def _push_event(self, event):
+        frame = bytes_packet_sender(convert_event(event))
+        record = convert_event_compact(event)
+        self._outgoing.append(frame)
+        self._step_records.append(record)
+        if self.recorder is not None:
+            self.recorder.record(frame)
+        if len(self.passed_frames) >= self.max_passed_frames and self.engine_packer is None:
+            logger.warning("Too many passed events, dropping event of step %s, players that join later will miss it", self.passed_frames[0][0])
+            self.passed_frames.popleft()
+        #With engine_packer every frame is newer than the latest keyframe (older are removed when it is made),
+        #so none are dropped, _all_ready makes new keyframe at the end of the step
+        self.passed_frames.append((self.step, frame, record))
+
+    def _flush(self):
+        """Sends queued frames to every connection that uses full events"""
+        if self._pack_future is not None and self._pack_future.done():
+            self._finish_keyframe()
+        if not self._outgoing:
+            return
+        frames = self._outgoing
+        self._outgoing = []
+        skip = {id(conn) for conn, _ in self._waiting.values()}
+        skip.update(id(conn) for conn, _ in self._compact_conns.values())
+        for conn in self._connections():
+            if id(conn) not in skip:
+                conn.send_many(frames)
+
+    def _send_batch(self, records):
+        """Sends *records* to connections that use compact events, encoding them at most twice"""
+        batches = dict()
+        for conn, flags in self._compact_conns.values():
+            compress = bool(flags & FLAG_ZLIB)
+            if compress not in batches:
+                batches[compress] = compact_batch(records, self.compress_threshold if compress else None)
+            conn.send(batches[compress])
+
+    def _take_keyframe(self):
+        """Packs state at the beginning of current step"""
+        if self.pack_in_thread:
+            if self._pack_future is not None:
+                return
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(1, thread_name_prefix="multiplexer-packer")
+            self._pack_step = self.step
+            self._pack_future = self._executor.submit(self.engine_packer)
+        else:
+            self._install_keyframe(self.step, self.engine_packer())
+
+    def _finish_keyframe(self):
+        future, self._pack_future = self._pack_future, None
+        try:
+            state = future.result()
+        except Exception:
+            logger.exception("engine_packer failed")
+            return
+        self._install_keyframe(self._pack_step, state)
+
+    def _install_keyframe(self, step, state):
+        self.last_pack = time.monotonic()
+        if state is None:
+            return
+        self.state = state
+        self.state_step = step
+        self.keyframes.append((step, state))
+        while len(self.keyframes) > self.max_keyframes:
+            self.keyframes.popleft()
+        passed_frames = self.passed_frames
+        while passed_frames and passed_frames[0][0] < step:
+            passed_frames.popleft()
+
+    def _catch_up(self, player_id, conn, flags, base_step=None):
+        """Sends latest keyframe (or diff against keyframe at *base_step*) and events after it to *conn*"""
+        event = None
         if self.state is not None:
-            self.last_pack = time.monotonic()
-            pl = convert_event(ReconstructEvent(self.state))
-            logger.debug("Sending reconstruct packet len %s", len(pl))
-            sock.send(bytes_packet_sender(pl))
-        self.events.append(PlayerJoinedEvent(self.current_player_id))
-        for event in self.passed_events:
-            sock.send(bytes_packet_sender(convert_event(event)))
+            base = None
+            for step, state in self.keyframes:
+                if step == base_step:
+                    base = state
+            if base is not None:
+                event = ReconstructDiffEvent(snapshot_diff(base, self.state), self.state_step, base_step)
+            else:
+                event = ReconstructEvent(self.state, self.state_step)
+        flags &= (FLAG_COMPACT | FLAG_ZLIB) if self.compact_events else 0
+        if not self.compression:
+            flags &= ~FLAG_ZLIB
+        if flags & FLAG_COMPACT:
+            #Events of current step will come with the next batch
+            records = [convert_event_compact(event)] if event is not None else []
+            records.extend(record for step, _, record in self.passed_frames if step < self.step)
+            frames = [
+                bytes_packet_sender(base_struct.pack(8, flags, 0, 0)), #Following packets are compact
+                compact_batch(records, self.compress_threshold if flags & FLAG_ZLIB else None),
+            ]
+            self._compact_conns[player_id] = (conn, flags)
+        else:
+            frames = [bytes_packet_sender(convert_event(event))] if event is not None else []
+            frames.extend(frame for _, frame, _ in self.passed_frames)
+        logger.debug("Sending catch-up of %s bytes", sum(map(len, frames)))
+        conn.send_many(frames)
+
+    def _add_player(self, conn):
+        """Sends hello packet to *conn*, returns id of new player"""
+        self.current_player_id += 1
+        player_id = self.current_player_id
+        self._push_event(PlayerJoinedEvent(player_id))
+        self._flush() #Everyone else gets new frames, new player gets them with the rest
+        conn.send(bytes_packet_sender(base_struct.pack(0, player_id, self.step, 0))) #Hello packet
+        self._waiting[player_id] = [conn, 0]
         self.players += 1
         logger.info("Done, currently %s online", self.players)
-        return sock
-    
-    def _on_read(self, sock):
-        player_id = self.fd_to_id[sock.fileno()]
-        packets = sock.recv()
-        for packet in packets:
-            aux_data, payload = packet[:base_struct.size], packet[base_struct.size:]
-            aux_data = base_struct.unpack(aux_data)
-            if aux_data[0] == 1: #Ready
-                self.ready_players.add(player_id)
-                self._check_all_ready()
-            elif aux_data[0] == 2: #Data
-                self.events.append(PayloadEvent(player_id, payload))
-        if sock.closed:
-            self.socket_selector.unregister(sock)
-            self.events.append(PlayerLeftEvent(player_id))
-            self.players -= 1
-            logger.info("Player left")
-            self.ready_players.discard(player_id)
+        return player_id
+
+    def _on_packet(self, player_id, packet):
+        aux_data = base_struct.unpack_from(packet)
+        if player_id in self._waiting:
+            if aux_data[0] == 8: #Options
+                self._waiting[player_id][1] = aux_data[1]
+                return
+            if aux_data[0] == 7: #Room, it was handled already
+                return
+            conn, flags = self._waiting.pop(player_id)
+            if aux_data[0] == 6: #Resume
+                self._catch_up(player_id, conn, flags, aux_data[2])
+                return
+            self._catch_up(player_id, conn, flags)
+        if aux_data[0] == 1: #Ready
+            self.ready_players.add(player_id)
             self._check_all_ready()
-            return
-    
+        elif aux_data[0] == 2: #Data
+            self._push_event(PayloadEvent(player_id, bytes(packet[base_struct.size:]))) #Packet may be a view
+
+    def _remove_player(self, player_id):
+        self._waiting.pop(player_id, None)
+        self._compact_conns.pop(player_id, None)
+        self._push_event(PlayerLeftEvent(player_id))
+        self.players -= 1
+        logger.info("Player left")
+        self.ready_players.discard(player_id)
+        self._check_all_ready()
+        self._flush()
+
     def _check_all_ready(self):
         if len(self.ready_players) == self.players:
             self._all_ready()
@@ -145,20 +431,63 @@ class MultiplexServer:
     def _all_ready(self):
         curr = time.monotonic()
         #logger.debug("All ready in %.2f ms", (curr-self.last_ready)*1000)
-        self.events.append(ReadyEvent(curr-self.last_ready))
+        self._push_event(ReadyEvent(curr-self.last_ready))
         self.last_ready = curr
-        eventdata = b"".join(map(bytes_packet_sender, map(convert_event, self.events)))
-        for event in self.events:
-            self.passed_events.append(event) #TODO: Send events when they are recieved
-        #    packet = bytes_packet_sender(convert_event(event))
-        for sock in self.socket_selector.socket_iterator:
-            sock.send(eventdata)
-        self.events.clear()
+        self.step += 1
+        records = self._step_records
+        self._step_records = []
+        if self._compact_conns:
+            self._send_batch(records)
+        if self.engine_packer is not None:
+            if curr - self.last_pack > self.pack_delay or len(self.passed_frames) > self.max_passed_frames // 2:
+                self._take_keyframe()
+        self._flush()
+
+
+class MultiplexServer(MultiplexServerBase):
+    """
+    Server for multiplexer.
+    Other sockets (like **ReliableUDPSocket** for unreliable updates) can be added to *socket_selector*
+    with their own read callback, they aren't treated as players.
+    """
+    def __init__(self, host="0.0.0.0", port=55126, engine_packer=None):
+        super().__init__(engine_packer)
+        sock = socket.socket()
+        sock.bind((host, port))
+        sock.listen()
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.socket_selector = ServerSelector(sock, self._on_connect, self._on_read)
+        self.fd_to_id = dict()
+        self.run_thread = True
+        self.select_timeout = 0.1 #How often run_thread is checked
+
+    def _connections(self):
+        sockets = self.socket_selector.sockets
+        return [sockets[fileno] for fileno in self.fd_to_id]
+
+    def _on_connect(self, sock, addr):
+        logger.info("Connection from %s", addr)
+        fileno = sock.fileno()
+        sock = PacketSocket(sock, BytesPacketFramer, copy=False) #Packets are encoded again right away
+        self.fd_to_id[fileno] = self._add_player(sock)
+        return sock
+    
+    def _on_read(self, sock):
+        fileno = sock.fileno()
+        player_id = self.fd_to_id[fileno]
+        packets = sock.recv()
+        for packet in packets:
+            self._on_packet(player_id, packet)
+        self._flush()
+        if sock.closed:
+            self.socket_selector.unregister(sock)
+            del self.fd_to_id[fileno]
+            self._remove_player(player_id)
+            return
 
     def serve_forever(self):
         while self.run_thread:
-            self.socket_selector.select()
-            time.sleep(self.time_between_selection)
+            self.socket_selector.select(self.select_timeout)
     
     def serve_in_thread(self):
         self._thread = Thread(target=self.serve_forever, daemon=True, name="multiplexer server")
@@ -167,82 +496,266 @@ class MultiplexServer:
     def stop_thread(self):
         self.run_thread = False
 
-class MultiplexClient:
+
+class MultiplexMetrics:
     """
-    Client for multiplexer
+    Rolling statistics of multiplexer client, over last *window* steps.
+    Updated by client, can be read from any thread with **snapshot**.
     """
-    def __init__(self, engine, engine_constructor=None, host="localhost", port=55126):
+    def __init__(self, window=256):
+        self._lock = Lock()
+        self.latencies = deque(maxlen=window)
+        self.stalls = deque(maxlen=window)
+        self.steps = 0
+        self.stalled_time = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.started = time.monotonic()
+
+    def record_step(self, latency, stall):
+        """Records ready-to-confirm *latency* and *stall* - time spent waiting after step was due"""
+        with self._lock:
+            self.latencies.append(latency)
+            self.stalls.append(stall)
+            self.steps += 1
+            self.stalled_time += stall
+
+    def add_bytes_in(self, amount):
+        with self._lock:
+            self.bytes_in += amount
+
+    def add_bytes_out(self, amount):
+        with self._lock:
+            self.bytes_out += amount
+
+    @staticmethod
+    def _percentile(values, fraction):
+        if not values:
+            return None
+        values = sorted(values)
+        return values[min(len(values) - 1, int(fraction * len(values)))]
+
+    def percentile(self, fraction):
+        """Step latency percentile, *fraction* is in [0, 1]. None if there are no steps yet"""
+        with self._lock:
+            return self._percentile(list(self.latencies), fraction)
+
+    def snapshot(self) -> dict:
+        """Returns dict with current statistics"""
+        with self._lock:
+            latencies = list(self.latencies)
+            stalls = list(self.stalls)
+            elapsed = time.monotonic() - self.started
+            return {
+                "steps": self.steps,
+                "steps_per_second": self.steps / elapsed if elapsed > 0 else 0,
+                "latency_p50": self._percentile(latencies, 0.5),
+                "latency_p95": self._percentile(latencies, 0.95),
+                "stall_p50": self._percentile(stalls, 0.5),
+                "stall_p95": self._percentile(stalls, 0.95),
+                "stalled_time": self.stalled_time,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+            }
+
+
+class MultiplexClientBase:
+    """
+    Transport independent part of multiplexer client
+    """
+    def __init__(self, engine, engine_constructor=None, resume=None, room=None, record=None):
+        """
+        *resume* is (step, snapshot) pair, from *snapshot_step* and *snapshot* of previous client.
+        If server still has that keyframe, it sends only difference.
+        *room* is name of a room to join, for servers from **qlibs.net.rooms**.
+        *record* is a path or binary file, where all recieved packets are recorded (see **MultiplexReplayer**).
+        """
         #Engine should be a class with step method, accepting float(deltatime) and list of events
-        sock = socket.socket()
-        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-        sock.connect((host, port))
-        self.pending_packets = []
-        self.socket = PacketSocket(sock, bytes_packet_reciever)
         self.engine = engine
         self.engine_constructor = engine_constructor
         self.packets = list()
         self.player_id = None
-        self.socket_lock = Lock()
+        self.step_number = None
+        self.joined_step = -1 #Server step from hello packet, steps up to it are replayed catch-up
+        self.snapshot_step, self.snapshot = resume if resume is not None else (None, None)
+        self.room = room
         self.ready_to_step = True
         self.last_step = 0
         self.last_confirmed_step = 0
-        self.min_step_time = 0.5
+        #Step interval follows smoothed ready-to-confirm time, multiplied by pacing_factor,
+        #plus 95th percentile of recent confirmations' delay past it, so that client backs off
+        #when confirmations are held back by slower players. It stays between min_step_time and max_step_time
+        self.min_step_time = 0.01
+        self.max_step_time = 2.0
+        self.pacing_factor = 1.0
+        self._smoothed_rtt = None
+        self._recent_delays = deque(maxlen=32)
+        self._backoff = 0
+        self.metrics = MultiplexMetrics()
+        self.recorder = MultiplexRecorder(record) if record is not None else None
+        #Ask server for compact (and maybe compressed) batches, one per step
+        self.compact_events = True
+        self.compression = True
+        self.compact = False
+
+    @property
+    def step_interval(self):
+        """Current time between ready packets"""
+        if self._smoothed_rtt is None:
+            return self.min_step_time
+        return min(self.max_step_time, max(self.min_step_time, self._smoothed_rtt * self.pacing_factor + self._backoff))
+
+    def _ready_packet(self):
+        """Marks step as started, returns ready packet"""
+        self.last_step = time.monotonic()
+        self.ready_to_step = False
+        packet = bytes_packet_sender(base_struct.pack(1, 0, 0, 0))
+        self.metrics.add_bytes_out(len(packet))
+        return packet
+
+    def _payload_packet(self, data):
+        packet = bytes_packet_sender(base_struct.pack(2, 0, 0, 0)+data)
+        self.metrics.add_bytes_out(len(packet))
+        return packet
+
+    def _on_confirm(self):
+        now = time.monotonic()
+        self.last_confirmed_step = now
+        if self.ready_to_step:
+            return #Confirmation of a step that was replayed or started by someone else
+        latency = now - self.last_step
+        if self._smoothed_rtt is None:
+            self._smoothed_rtt = latency
+        else:
+            self._smoothed_rtt += (latency - self._smoothed_rtt) / 8
+        self.metrics.record_step(latency, max(0, latency - self.step_interval))
+        #Delay is measured against smoothed time, not current interval, so backing off doesn't hide it
+        self._recent_delays.append(max(0, latency - self._smoothed_rtt * self.pacing_factor))
+        self._backoff = MultiplexMetrics._percentile(self._recent_delays, 0.95)
+
+    def _on_packet(self, packet):
+        self.metrics.add_bytes_in(len(packet))
+        if self.recorder is not None:
+            self.recorder.record(bytes_packet_sender(packet))
+        if self.compact:
+            if packet[0] == COMPACT_BATCH_ZLIB:
+                body = zlib.decompress(packet[1:])
+            elif packet[0] == COMPACT_BATCH:
+                body = memoryview(packet)[1:]
+            else:
+                raise MultiplexerException("Expected compact batch, got packet starting with %s" % packet[0])
+            for event in iter_compact_events(body):
+                self._on_event(*event)
+        else:
+            aux_data = base_struct.unpack(packet[:base_struct.size])
+            self._on_event(*aux_data, packet[base_struct.size:])
+
+    def _on_event(self, kind, int1, int2, value, payload):
+        if kind == 0:
+            self.player_id = int1
+            self.step_number = self.joined_step = int2
+        elif kind == 1: #Next step
+            self.step_number += 1
+            #Server can't step between hello and first ready of this client,
+            #so only later steps answer ready packets of this client
+            live = self.step_number > self.joined_step
+            if live:
+                self._on_confirm()
+            self.engine.step(value, self.packets)
+            self.packets.clear()
+            if live:
+                self.ready_to_step = True
+        elif kind == 2:
+            self.packets.append(PayloadEvent(int1, payload))
+        elif kind == 3:
+            self.packets.append(PlayerJoinedEvent(int1))
+        elif kind == 4:
+            self.packets.append(PlayerLeftEvent(int1))
+        elif kind == 5:
+            logging.debug("Reconstructing engine")
+            self._reconstruct(int2, payload)
+        elif kind == 6:
+            if int1 != self.snapshot_step:
+                raise MultiplexerException("Server sent diff against step %s, but snapshot is from step %s" % (int1, self.snapshot_step))
+            logging.debug("Reconstructing engine from diff")
+            self._reconstruct(int2, apply_snapshot_diff(self.snapshot, payload))
+        elif kind == 8: #Options accepted, following packets are compact batches
+            self.compact = bool(int1 & FLAG_COMPACT)
+
+    def _reconstruct(self, step, snapshot):
+        if self.engine_constructor is None:
+            raise MultiplexerException("Server requested engine reconstruction but engine_constructor is None")
+        self.snapshot = snapshot
+        self.snapshot_step = self.step_number = step
+        self.engine = self.engine_constructor(snapshot)
+
+    def _initial_packets(self):
+        """Packets to send right after connecting: room to join, options and resume request"""
+        packets = []
+        if self.room is not None:
+            packets.append(bytes_packet_sender(base_struct.pack(7, 0, 0, 0) + self.room.encode()))
+        if self.compact_events:
+            flags = FLAG_COMPACT | (FLAG_ZLIB if self.compression else 0)
+            packets.append(bytes_packet_sender(base_struct.pack(8, flags, 0, 0)))
+        if self.snapshot_step is not None:
+            packets.append(bytes_packet_sender(base_struct.pack(6, 0, self.snapshot_step, 0)))
+        return b"".join(packets)
+
+
+class MultiplexClient(MultiplexClientBase):
+    """
+    Client for multiplexer
+    """
+    def __init__(self, engine, engine_constructor=None, host="localhost", port=55126, resume=None, room=None, record=None):
+        super().__init__(engine, engine_constructor, resume, room, record)
+        sock = socket.socket()
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.connect((host, port))
+        self.pending_packets = []
+        self.socket = PacketSocket(sock, BytesPacketFramer)
+        self.socket_lock = Lock()
+        initial = self._initial_packets()
+        if initial:
+            self.socket.send(initial)
         self._recv_packets()
         
     def _recv_packets(self):
-        packets = self.socket.recv()
-        for packet in packets:
-            aux_data, payload = packet[:base_struct.size], packet[base_struct.size:]
-            try:
-                aux_data = base_struct.unpack(aux_data)
-            except struct.error as e:
-                raise
-            if aux_data[0] == 0:
-                self.player_id = aux_data[1]
-            elif aux_data[0] == 1: #Next step
-                self.last_confirmed_step = time.monotonic()
-                self.engine.step(aux_data[3], self.packets)
-                self.packets.clear()
-                self.ready_to_step = True
-            elif aux_data[0] == 2:
-                self.packets.append(PayloadEvent(aux_data[1], payload))
-            elif aux_data[0] == 3:
-                self.packets.append(PlayerJoinedEvent(aux_data[1]))
-            elif aux_data[0] == 4:
-                self.packets.append(PlayerLeftEvent(aux_data[1]))
-            elif aux_data[0] == 5:
-                if self.engine_constructor is None:
-                    raise MultiplexerException("Server requested engine reconstruction but engine_constructor is None")
-                logging.debug("Reconstructing engine")
-                self.engine = self.engine_constructor(payload)
+        for packet in self.socket.recv():
+            self._on_packet(packet)
     
     def step(self):
-        if self.ready_to_step and time.monotonic() - self.last_step > self.min_step_time:
-            #logging.debug("Waiting for lock...")
+        if self.ready_to_step and time.monotonic() - self.last_step >= self.step_interval:
             with self.socket_lock:
-                #logging.debug("Performing step...")
-                self.last_step = time.monotonic()
-                self.pending_packets.append(bytes_packet_sender(base_struct.pack(1, 0, 0, 0)))
+                self.pending_packets.append(self._ready_packet())
                 data = b"".join(self.pending_packets)
                 self.pending_packets.clear()
                 self.socket.send(data)
-                #logging.debug("Done!")
         with self.socket_lock:
             self.socket.send()
         self._recv_packets()
     
     def send_payload(self, data):
         with self.socket_lock:
-            self.pending_packets.append(bytes_packet_sender(base_struct.pack(2, 0, 0, 0)+data))
+            self.pending_packets.append(self._payload_packet(data))
+
+    def _wait(self, max_time=0.1):
+        """Waits until next step is due or something can be done with socket"""
+        if self.ready_to_step:
+            timeout = min(max_time, max(0, self.last_step + self.step_interval - time.monotonic()))
+        else:
+            timeout = max_time
+        sock = self.socket.socket.socket
+        wlist = [] if self.socket.socket.empty() else [sock]
+        select.select([sock], wlist, [], timeout)
 
     def _eternal_runner(self):
         while self._shall_continue:
             self.step()
-            time.sleep(max(0, min(0.01, self.last_step + self.min_step_time - time.monotonic())))
-            #time.sleep(0.1)
             if self.socket.reset:
                 logger.warning("Socket is reset, stopping client")
                 self._shall_continue = False
+                break
+            self._wait()
 
     def thread_runner(self):
         self._thread = Thread(target=self._eternal_runner, name="multiplex-client", daemon=True)
@@ -255,3 +768,36 @@ class MultiplexClient:
     def stop_thread(self):
         self._shall_continue = False
         self._thread.join()
+        if self.recorder is not None:
+            self.recorder.flush()
+
+
+class MultiplexReplayer(MultiplexClientBase):
+    """
+    Feeds recording made by server or client back to *engine*, without network.
+    With trivial engine, measures how fast events are decoded; with real one, how fast it steps.
+    """
+    def __init__(self, engine, engine_constructor=None):
+        super().__init__(engine, engine_constructor)
+        self.step_number = 0 #Server recordings don't have hello packet
+        self.steps = 0
+
+    def _on_event(self, kind, *args):
+        if kind == 1:
+            self.steps += 1
+        super()._on_event(kind, *args)
+
+    def replay(self, file, speed=None):
+        """
+        Replays recording from *file*. If *speed* is given, recorded timing is kept (2 is twice as fast),
+        otherwise it goes as fast as possible. Returns (steps, seconds taken).
+        """
+        start = time.monotonic()
+        first_step = self.steps
+        for at, packet in read_recording(file):
+            if speed is not None:
+                delay = start + at / speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            self._on_packet(packet)
+        return self.steps - first_step, time.monotonic() - start
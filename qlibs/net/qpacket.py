@@ -2,7 +2,10 @@
 
 import functools
 import io
+import struct
+import sys
 
+from array import array
 from enum import Enum, auto
 from collections import deque
 from ..collections import ByteBuffer
@@ -26,6 +29,8 @@ class VALUE_TYPES(BinaryAuto):
     TUPLE       = auto()
     SET         = auto()
     CUSTOM      = auto()
+    SCHEMA      = auto()
+    ARRAY       = auto()
 
 class SECONDARY_INT_PARAMS(BinaryAuto):
     POSITIVE    = auto()
@@ -45,6 +50,209 @@ class ConvertionLookup():
 
 conv_lookup = ConvertionLookup()
 
+#Field type -> struct format character, for fixed size fields
+FIXED_FIELDS = {
+    "bool": "?",
+    "i8": "b",
+    "u8": "B",
+    "i16": "h",
+    "u16": "H",
+    "i32": "i",
+    "u32": "I",
+    "i64": "q",
+    "u64": "Q",
+    "f32": "f",
+    "f64": "d",
+}
+#Array typecodes that have the same size everywhere
+ARRAY_TYPECODES = "bBhHiIqQfd"
+_ARRAY_WIDE = {"l": "q", "L": "Q"}
+
+
+def pack_varint(value):
+    """Packs non-negative int the same way as **bytes_packet_sender** packs lengths"""
+    res = bytearray()
+    while True:
+        part = value & 0b1111111
+        value >>= 7
+        if value:
+            res.append(part | 0b10000000)
+        else:
+            res.append(part)
+            return bytes(res)
+
+
+def read_varint(io):
+    """Reads varint from ByteBuffer *io*"""
+    value = 0
+    shift = 0
+    while True:
+        n = io.read(1)[0]
+        value |= (n & 0b1111111) << shift
+        if n < 0b10000000:
+            return value
+        shift += 7
+
+
+def _zigzag(value):
+    return value << 1 if value >= 0 else ((-value) << 1) - 1
+
+
+def _unzigzag(value):
+    return value >> 1 if not value & 1 else -((value + 1) >> 1)
+
+
+def _array_bytes(arr):
+    """Returns contents of *arr* in network (big-endian) byte order"""
+    if arr.typecode in _ARRAY_WIDE:
+        arr = array(_ARRAY_WIDE[arr.typecode], arr)
+    elif arr.typecode not in ARRAY_TYPECODES:
+        raise ValueError("Unsupported array typecode %s" % arr.typecode)
+    if sys.byteorder == "little" and arr.itemsize > 1:
+        arr = array(arr.typecode, arr)
+        arr.byteswap()
+    return arr.tobytes()
+
+
+def _read_array(io, typecode):
+    arr = array(typecode)
+    count = read_varint(io)
+    arr.frombytes(io.read(count * arr.itemsize))
+    if sys.byteorder == "little" and arr.itemsize > 1:
+        arr.byteswap()
+    return arr
+
+
+class Schema:
+    """
+      Fixed layout of a record, compiled to `struct.Struct` packers.
+      
+      *fields* is a sequence of (name, type) pairs. Types are keys of FIXED_FIELDS,
+      "varint" (signed, variable length), "str", "bytes", or fixed type with "[]" suffix (like "f32[]"),
+      which is packed as an `array` - lists of numbers of the same type are packed in one go.
+      Consecutive fixed fields are packed with one struct.
+
+      Records are tuples (or instances of *cls*, which are made with `cls(*values)` 
+      and converted using attributes named after fields).
+    """
+    def __init__(self, schema_id, fields, cls=None):
+        self.schema_id = schema_id
+        self.fields = tuple(fields)
+        self.names = tuple(name for name, _ in self.fields)
+        self.cls = cls
+        self._header = VALUE_TYPES.SCHEMA.value + pack_varint(schema_id)
+        self._encoders = []
+        self._decoders = []
+        self._compile()
+        if len(self._encoders) == 1 and self._struct is not None:
+            #Only fixed fields - everything is done by one struct
+            self.pack = self._pack_fixed
+            self.unpack_from = self._unpack_fixed
+        
+    def _compile(self):
+        self._struct = None
+        fmt = ""
+        start = 0
+        for i, (name, tp) in enumerate(self.fields):
+            if tp in FIXED_FIELDS:
+                if not fmt:
+                    start = i
+                fmt += FIXED_FIELDS[tp]
+                continue
+            if fmt:
+                self._add_struct(fmt, start, i)
+                fmt = ""
+            if tp == "varint":
+                self._encoders.append(lambda values, i=i: pack_varint(_zigzag(values[i])))
+                self._decoders.append(lambda io: (_unzigzag(read_varint(io)),))
+            elif tp == "str":
+                def encode_str(values, i=i):
+                    b = values[i].encode()
+                    return pack_varint(len(b)) + b
+                self._encoders.append(encode_str)
+                self._decoders.append(lambda io: (io.read(read_varint(io)).decode(),))
+            elif tp == "bytes":
+                self._encoders.append(lambda values, i=i: pack_varint(len(values[i])) + bytes(values[i]))
+                self._decoders.append(lambda io: (io.read(read_varint(io)),))
+            elif tp.endswith("[]") and tp[:-2] in FIXED_FIELDS:
+                typecode = FIXED_FIELDS[tp[:-2]]
+                if typecode == "?":
+                    raise ValueError("bool arrays are not supported")
+                def encode_array(values, i=i, typecode=typecode):
+                    value = values[i]
+                    if not isinstance(value, array) or value.typecode != typecode:
+                        value = array(typecode, value)
+                    return pack_varint(len(value)) + _array_bytes(value)
+                self._encoders.append(encode_array)
+                self._decoders.append(lambda io, typecode=typecode: (_read_array(io, typecode),))
+            else:
+                raise ValueError("Unknown field type %s of field %s" % (tp, name))
+        if fmt:
+            self._add_struct(fmt, start, len(self.fields))
+
+    def _add_struct(self, fmt, start, end):
+        st = struct.Struct("!" + fmt)
+        self._struct = st
+        self._encoders.append(lambda values: st.pack(*values[start:end]))
+        self._decoders.append(lambda io: st.unpack(io.read(st.size)))
+
+    def _values(self, record):
+        if self.cls is not None and isinstance(record, self.cls):
+            return tuple(getattr(record, name) for name in self.names)
+        return record
+
+    def _make(self, values):
+        if self.cls is not None:
+            return self.cls(*values)
+        return tuple(values)
+
+    def pack(self, record) -> bytes:
+        """Packs *record* without type header"""
+        values = self._values(record)
+        if len(values) != len(self.fields):
+            raise ValueError("Expected %d values, got %d" % (len(self.fields), len(values)))
+        return b"".join([encoder(values) for encoder in self._encoders])
+
+    def unpack_from(self, io):
+        """Reads record packed by **pack** from ByteBuffer *io*"""
+        values = []
+        for decoder in self._decoders:
+            values.extend(decoder(io))
+        return self._make(values)
+
+    def _pack_fixed(self, record):
+        try:
+            return self._struct.pack(*self._values(record))
+        except struct.error as e:
+            raise ValueError(str(e)) from e
+
+    def _unpack_fixed(self, io):
+        return self._make(self._struct.unpack(io.read(self._struct.size)))
+
+    def unpack(self, data):
+        """Unpacks record from bytes made by **pack**"""
+        return self.unpack_from(ByteBuffer(data, join_with=b""))
+
+    def convert(self, record) -> bytes:
+        """Same as **convert**, but always uses this schema"""
+        return self._header + self.pack(record)
+
+
+schema_lookup = dict() #schema id -> Schema
+
+def register_schema(schema_id, fields, cls=None) -> Schema:
+    """
+    Registers **Schema** so that **Decoder** can read records packed with it.
+    If *cls* is given, **convert** packs its instances using this schema.
+    """
+    if schema_id in schema_lookup:
+        raise ValueError("Schema with id %d is already registered" % schema_id)
+    schema = Schema(schema_id, fields, cls)
+    schema_lookup[schema_id] = schema
+    if cls is not None:
+        convert.register(cls)(schema.convert)
+    return schema
+
 def make_qlibs_obj_id(shift):
     return 1000 + shift
 
@@ -109,14 +317,21 @@ def _(arg: set):
 def _(arg):
     return VALUE_TYPES.NONE.value
 
+@convert.register
+def _(arg: array):
+    data = _array_bytes(arg)
+    typecode = _ARRAY_WIDE.get(arg.typecode, arg.typecode)
+    return VALUE_TYPES.ARRAY.value + typecode.encode() + pack_varint(len(arg)) + data
+
 
 class Decoder:
     def __init__(self, data=b"", custom_byte_buffer=None):
         if custom_byte_buffer is None:
-            self.io = ByteBuffer(data)
+            self.io = ByteBuffer(data, join_with=b"")
         else:
             self.io = custom_byte_buffer #Some methods may not work
         self.conv_lookup = conv_lookup
+        self.schema_lookup = schema_lookup
     
     def feed(self, data):
         self.io.write(data)
@@ -169,6 +384,14 @@ class Decoder:
             _ = self.get_value(ensure_type=VALUE_TYPES.INT)
             obj_type = self.conv_lookup.id_to_obj[obj_id]
             return obj_type.__reconstruct__(self)
+        elif etp is VALUE_TYPES.SCHEMA:
+            schema = self.schema_lookup[read_varint(self.io)]
+            return schema.unpack_from(self.io)
+        elif etp is VALUE_TYPES.ARRAY:
+            typecode = self.io.read(1).decode()
+            if typecode not in ARRAY_TYPECODES:
+                raise ValueError("Wrong array typecode")
+            return _read_array(self.io, typecode)
         else:
             raise ValueError("Wrong type byte")
                     
@@ -189,3 +412,192 @@ def decode(data):
         
     
     
+
+
+class _Incomplete(Exception):
+    """Raised by **_Cursor** when value continues past the end of data, with amount of bytes needed"""
+
+
+def _scan_int(cursor):
+    if cursor.read(VTYPES_LEN) != VALUE_TYPES.INT.value:
+        raise ValueError("Wrong type byte")
+    sign = SECONDARY_INT_PARAMS(cursor.read(VTYPES_LEN))
+    value = int.from_bytes(cursor.read(cursor.read(1)[0]), BYTE_ORDER)
+    return -value if sign is SECONDARY_INT_PARAMS.NEGATIVE else value
+
+
+def _skip_header(cursor):
+    """
+      Skips start of value at *cursor*, returns amount of values nested in it, which follow.
+      Raises _Incomplete without skipping part of header or of data of atomic value.
+    """
+    etp = VALUE_TYPES(cursor.read(VTYPES_LEN))
+    if etp is VALUE_TYPES.INT:
+        cursor.skip(VTYPES_LEN)
+        cursor.skip(cursor.read(1)[0])
+    elif etp is VALUE_TYPES.FLOAT:
+        return 1 #Tuple
+    elif etp is VALUE_TYPES.BYTES or etp is VALUE_TYPES.STR:
+        cursor.skip(_scan_int(cursor))
+    elif etp is VALUE_TYPES.LIST or etp is VALUE_TYPES.TUPLE or etp is VALUE_TYPES.SET:
+        return _scan_int(cursor)
+    elif etp is VALUE_TYPES.CUSTOM:
+        _scan_int(cursor)
+        cursor.skip(_scan_int(cursor))
+    elif etp is VALUE_TYPES.SCHEMA:
+        schema_lookup[read_varint(cursor)].unpack_from(cursor)
+    elif etp is VALUE_TYPES.ARRAY:
+        typecode = cursor.read(1).decode()
+        if typecode not in ARRAY_TYPECODES:
+            raise ValueError("Wrong array typecode")
+        cursor.skip(read_varint(cursor) * array(typecode).itemsize)
+    return 0
+
+
+class _Cursor:
+    """ByteBuffer-like reader over a memoryview, which doesn't consume anything until told to"""
+    __slots__ = ("data", "pos")
+
+    def __init__(self):
+        self.data = None
+        self.pos = 0
+
+    def read(self, size):
+        end = self.pos + size
+        if end > len(self.data):
+            raise _Incomplete(end)
+        res = self.data[self.pos:end].tobytes()
+        self.pos = end
+        return res
+
+    def skip(self, size):
+        end = self.pos + size
+        if end > len(self.data):
+            raise _Incomplete(end)
+        self.pos = end
+
+    def has_values(self):
+        return self.pos < len(self.data)
+
+
+class StreamDecoder:
+    """
+      Decoder that can be fed arbitrary chunks of data, e.g. as they come from a socket.
+      Values are decoded as soon as they are complete; bytes of decoded values are dropped.
+      If a value is incomplete, its structure is scanned as far as it goes, and later chunks continue
+      the scan from there, so large values that come in small chunks are not parsed again from the start.
+    """
+    def __init__(self, data=b""):
+        self._buf = bytearray()
+        self._cursor = _Cursor()
+        self._decoder = Decoder(custom_byte_buffer=self._cursor)
+        self._values = deque()
+        self.needed = 0 #Decoding is not attempted until buffer has that many bytes
+        self._scanning = False #True while incomplete value at the start of buffer is being scanned
+        self._scan_pos = 0
+        self._scan_stack = [] #Amounts of values left in containers that are open at _scan_pos
+        if data:
+            self.feed(data)
+
+    def feed(self, data):
+        """Adds *data* to the stream, returns amount of values that were completed by it"""
+        self._buf += data
+        if len(self._buf) < self.needed:
+            return 0
+        return self._decode()
+
+    def _decode(self):
+        count = 0
+        cursor = self._cursor
+        consumed = 0
+        try:
+            with memoryview(self._buf) as view:
+                cursor.data = view
+                end = len(view)
+                while consumed < end:
+                    if self._scanning:
+                        if self._scan() is None:
+                            break
+                        cursor.pos = consumed
+                        value = self._decoder.get_value()
+                    else:
+                        cursor.pos = consumed
+                        try:
+                            value = self._decoder.get_value()
+                        except _Incomplete:
+                            self._scanning = True
+                            self._scan_pos = consumed
+                            self._scan_stack = []
+                            self._scan()
+                            break
+                    self._values.append(value)
+                    consumed = cursor.pos
+                    count += 1
+                else:
+                    self.needed = 0
+        finally:
+            cursor.data = None
+            del self._buf[:consumed]
+            self._scan_pos -= consumed
+            self.needed = max(0, self.needed - consumed)
+        return count
+
+    def _scan(self):
+        """
+          Continues scanning value that starts at the beginning of buffer.
+          Returns position of its end, or None if it is still incomplete.
+        """
+        cursor = self._cursor
+        stack = self._scan_stack
+        cursor.pos = self._scan_pos
+        while True:
+            start = cursor.pos
+            try:
+                nested = _skip_header(cursor)
+            except _Incomplete as e:
+                self._scan_pos = start
+                self.needed = e.args[0]
+                return None
+            if nested:
+                stack.append(nested)
+                continue
+            while stack:
+                stack[-1] -= 1
+                if stack[-1]:
+                    break
+                stack.pop()
+            if not stack:
+                self._scanning = False
+                self._scan_pos = cursor.pos
+                return cursor.pos
+
+    @property
+    def pending(self) -> bytes:
+        """Bytes of values that are not complete yet"""
+        return bytes(self._buf)
+
+    def has_values(self):
+        return len(self._values) > 0
+
+    def get_value(self):
+        """Returns next decoded value, raises ValueError if there are none"""
+        if not self._values:
+            raise ValueError("Not enought values in buffer")
+        return self._values.popleft()
+
+    def __iter__(self):
+        """Yields decoded values that are available"""
+        values = self._values
+        while values:
+            yield values.popleft()
+
+    def decode_into(self, target, start=0):
+        """
+        Puts available values to preallocated *target* (like list), starting at index *start*.
+        Returns amount of values written; stops when either *target* or values run out.
+        """
+        values = self._values
+        count = min(len(values), len(target) - start)
+        for i in range(start, start + count):
+            target[i] = values.popleft()
+        return count
@@ -0,0 +1,101 @@
+"""
+  Recording of multiplexer traffic.
+
+  Recording is an append-only file: header, then records of varint time since previous record
+  (in microseconds) followed by frame, exactly as made by **bytes_packet_sender**.
+  Servers record event stream that they send, clients record everything they recieve.
+  Use **MultiplexReplayer** from **qlibs.net.multiplexer** to feed recording back to an engine.
+
+```python
+client = MultiplexClient(engine, record="session.qmxr")
+...
+server.start_recording("server.qmxr") #Servers can start and stop recording at any time
+...
+replayer = MultiplexReplayer(Engine(), Engine.from_snapshot)
+replayer.replay("session.qmxr")
+```
+"""
+
+import logging
+import os
+import struct
+import time
+from threading import Lock
+
+from .qpacket import pack_varint, read_varint
+
+__all__ = ["MultiplexRecorder", "read_recording"]
+
+logger = logging.getLogger("qlibs.net.recording")
+
+MAGIC = b"QMXR"
+VERSION = 1
+header_struct = struct.Struct("!4sBd") #magic, version, wall clock time of start
+
+
+class MultiplexRecorder:
+    """
+    Appends timestamped frames to *file*, which is either a path or a binary file object.
+    Can be shared between threads.
+    """
+    def __init__(self, file):
+        if isinstance(file, (str, os.PathLike)):
+            self.file = open(file, "ab")
+            self.own_file = True
+        else:
+            self.file = file
+            self.own_file = False
+        self.lock = Lock()
+        self.last = time.monotonic()
+        if self.file.tell() == 0:
+            self.file.write(header_struct.pack(MAGIC, VERSION, time.time()))
+
+    def record(self, frame, now=None):
+        """Appends *frame* (bytes made by **bytes_packet_sender**)"""
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            delta = max(0, int((now - self.last) * 1000000))
+            self.last = now
+            self.file.write(pack_varint(delta))
+            self.file.write(frame)
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.own_file:
+                self.file.close()
+            else:
+                self.file.flush()
+
+
+def read_recording(file):
+    """
+    Yields (time, packet) pairs from recording, where time is seconds since the start of recording.
+    Recordings that were appended to several times continue from the previous part.
+    """
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, "rb") as f:
+            yield from read_recording(f)
+        return
+    magic, version, _ = header_struct.unpack(file.read(header_struct.size))
+    if magic != MAGIC:
+        raise ValueError("Not a multiplexer recording")
+    if version != VERSION:
+        raise ValueError("Unsupported recording version %s" % version)
+    now = 0
+    while True:
+        try:
+            delta = read_varint(file)
+            length = read_varint(file)
+        except IndexError:
+            return #End of file
+        data = file.read(length)
+        if len(data) < length:
+            logger.warning("Recording ends with incomplete frame")
+            return
+        now += delta / 1000000
+        yield now, data
@@ -0,0 +1,342 @@
+"""
+  Rooms for multiplexer.
+
+  Every room is a separate lockstep group, with its own ready set and event log, so slow player
+  only stalls own room. Clients choose room with *room* argument; the first packet they send
+  names it. Clients that don't send room name join room "".
+
+  **MultiplexRoomServer** keeps all rooms in one thread. **MultiplexAcceptor** accepts connections
+  and passes sockets (with `socket.send_fds`, so Unix only) to worker processes, each running
+  **MultiplexRoomServer** - every room lives in one worker, picked by room name.
+
+```python
+acceptor = MultiplexAcceptor(port=55126, workers=4)
+acceptor.serve_forever()
+#Clients:
+client = MultiplexClient(engine, port=55126, room="lobby")
+```
+"""
+
+import logging
+import multiprocessing
+import selectors
+import socket
+import time
+import zlib
+from threading import Thread
+
+from .asyncsocket import BytesPacketFramer, PacketSocket, ServerSelector, SelSockType
+from .multiplexer import MultiplexServerBase, MultiplexerException, base_struct
+
+__all__ = ["MultiplexRoom", "MultiplexRoomServer", "MultiplexAcceptor"]
+
+logger = logging.getLogger("qlibs.net.rooms")
+
+DEFAULT_ROOM = ""
+MAX_JOIN_PACKET = 1024 #Longest join packet (with length prefix) **MultiplexAcceptor** accepts
+JOIN_TIMEOUT = 5.0 #Seconds **MultiplexAcceptor** waits for the first packet
+
+
+def _room_of(packet):
+    """Returns room name if *packet* is a join packet, None otherwise. Raises MultiplexerException if name isn't utf-8"""
+    if len(packet) >= base_struct.size and base_struct.unpack(packet[:base_struct.size])[0] == 7:
+        try:
+            return bytes(packet[base_struct.size:]).decode()
+        except UnicodeDecodeError as e:
+            raise MultiplexerException("Malformed join packet") from e
+    return None
+
+
+def _first_room(data):
+    """
+    Looks at the start of a stream. Returns (done, room name or None); done is False if more bytes are needed.
+    Raises MultiplexerException if join packet is malformed or longer than MAX_JOIN_PACKET.
+    """
+    length = 0
+    pos = 0
+    while True:
+        if pos == len(data):
+            return False, None
+        if pos == 5:
+            raise MultiplexerException("Malformed packet length")
+        n = data[pos]
+        pos += 1
+        length |= (n & 0b1111111) << (7 * (pos - 1))
+        if n < 0b10000000:
+            break
+    if length < base_struct.size:
+        #Not a join packet, whatever it is
+        return pos + length <= len(data), None
+    if len(data) < pos + base_struct.size:
+        return False, None
+    if base_struct.unpack_from(data, pos)[0] != 7:
+        return True, None
+    if pos + length > MAX_JOIN_PACKET:
+        raise MultiplexerException("Join packet is too long")
+    if pos + length > len(data):
+        return False, None
+    return True, _room_of(data[pos:pos+length])
+
+
+class MultiplexRoom(MultiplexServerBase):
+    """
+    One lockstep group of **MultiplexRoomServer**
+    """
+    def __init__(self, name, engine_packer=None):
+        super().__init__(engine_packer)
+        self.name = name
+        self.conns = dict() #player id -> connection
+
+    def _connections(self):
+        return self.conns.values()
+
+    def add_connection(self, conn):
+        player_id = self._add_player(conn)
+        self.conns[player_id] = conn
+        return player_id
+
+    def remove_connection(self, player_id):
+        del self.conns[player_id]
+        self._remove_player(player_id)
+
+
+class MultiplexRoomServer:
+    """
+    Multiplexer server with many rooms. *engine_packer*, if given, is called with room name.
+    If *listen* is False, server doesn't accept connections itself, use **add_socket**.
+    """
+    def __init__(self, host="0.0.0.0", port=55126, engine_packer=None, listen=True):
+        if listen:
+            sock = socket.socket()
+            sock.bind((host, port))
+            sock.listen()
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        else:
+            sock = None
+        self.listener = sock
+        self.socket_selector = ServerSelector(sock, self._on_connect, self._on_read)
+        self.engine_packer = engine_packer
+        self.rooms = dict()
+        self.fd_to_player = dict() #fd -> (room, player id); None for sockets that didn't choose room yet
+        self.run_thread = True
+        self.select_timeout = 0.1 #How often run_thread is checked
+
+    @property
+    def port(self):
+        return self.listener.getsockname()[1]
+
+    def get_room(self, name):
+        room = self.rooms.get(name)
+        if room is None:
+            packer = None
+            if self.engine_packer is not None:
+                packer = lambda: self.engine_packer(name)
+            room = self.rooms[name] = MultiplexRoom(name, packer)
+            logger.info("Room %r created", name)
+        return room
+
+    def add_socket(self, sock, addr=None, data=b""):
+        """Adds already connected socket. *data* is what was already read from it"""
+        conn = self._on_connect(sock, addr)
+        self.socket_selector.register(conn)
+        if data:
+            self._on_packets(conn, conn.feed(data))
+
+    def _on_connect(self, sock, addr):
+        logger.info("Connection from %s", addr)
+        self.fd_to_player[sock.fileno()] = None
+        return PacketSocket(sock, BytesPacketFramer, copy=False)
+
+    def _on_read(self, sock):
+        self._on_packets(sock, sock.recv())
+
+    def _on_packets(self, sock, packets):
+        fileno = sock.fileno()
+        player = self.fd_to_player[fileno]
+        if player is None and packets:
+            try:
+                name = _room_of(packets[0])
+            except MultiplexerException as e:
+                logger.warning("Dropping connection: %s", e)
+                self.socket_selector.unregister(sock)
+                del self.fd_to_player[fileno]
+                sock.close()
+                return
+            if name is not None:
+                packets = packets[1:]
+            room = self.get_room(DEFAULT_ROOM if name is None else name)
+            player = self.fd_to_player[fileno] = (room, room.add_connection(sock))
+        if player is not None:
+            room, player_id = player
+            for packet in packets:
+                room._on_packet(player_id, packet)
+            room._flush()
+        if sock.closed:
+            self.socket_selector.unregister(sock)
+            del self.fd_to_player[fileno]
+            if player is not None:
+                room.remove_connection(player_id)
+                if not room.conns:
+                    del self.rooms[room.name]
+                    logger.info("Room %r removed", room.name)
+            sock.close()
+
+    def serve_forever(self):
+        while self.run_thread:
+            self.socket_selector.select(self.select_timeout)
+
+    def serve_in_thread(self):
+        self._thread = Thread(target=self.serve_forever, daemon=True, name="multiplexer room server")
+        self._thread.start()
+
+    def stop_thread(self):
+        self.run_thread = False
+
+
+def _room_worker(control, engine_packer):
+    """Entry point of **MultiplexAcceptor** worker process"""
+    server = MultiplexRoomServer(engine_packer=engine_packer, listen=False)
+    def on_control():
+        try:
+            msg, fds, _, _ = socket.recv_fds(control, MAX_JOIN_PACKET + 1, 1)
+        except OSError:
+            msg, fds = b"", []
+        if not msg:
+            server.run_thread = False
+        for fd in fds:
+            sock = socket.socket(fileno=fd)
+            try:
+                addr = sock.getpeername()
+            except OSError:
+                addr = None
+            server.add_socket(sock, addr, msg[1:])
+    server.socket_selector.add_reader(control, on_control)
+    server.serve_forever()
+
+
+class MultiplexAcceptor:
+    """
+    Accepts connections and passes them to *workers* processes running **MultiplexRoomServer**,
+    so that rooms are spread between cores. Worker is picked by room name, after first packet arrives.
+    *engine_packer* is called with room name in a worker process, so it should be picklable.
+    Connections that don't send first packet in *join_timeout* seconds are dropped.
+    """
+    def __init__(self, host="0.0.0.0", port=55126, workers=None, engine_packer=None, join_timeout=JOIN_TIMEOUT):
+        if not hasattr(socket, "send_fds"):
+            raise MultiplexerException("Passing sockets to processes is not supported on this platform")
+        sock = socket.socket()
+        sock.bind((host, port))
+        sock.listen()
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setblocking(False)
+        self.listener = sock
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(sock, selectors.EVENT_READ, SelSockType.ACCEPTER)
+        self.workers = []
+        self.controls = []
+        for i in range(workers or multiprocessing.cpu_count()):
+            control, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+            process = multiprocessing.Process(target=_room_worker, args=(child, engine_packer), daemon=True, name="multiplexer-worker-%d" % i)
+            process.start()
+            child.close()
+            self.workers.append(process)
+            self.controls.append(control)
+        self.join_timeout = join_timeout
+        self.pending = dict() #socket -> (deadline, bytes read so far)
+        self.run_thread = True
+
+    @property
+    def port(self):
+        return self.listener.getsockname()[1]
+
+    def worker_of(self, room):
+        return zlib.crc32(room.encode()) % len(self.workers)
+
+    def _accept(self):
+        try:
+            sock, addr = self.listener.accept()
+        except BlockingIOError:
+            return
+        sock.setblocking(False)
+        self.selector.register(sock, selectors.EVENT_READ, SelSockType.NORMAL)
+        self.pending[sock] = (time.monotonic() + self.join_timeout, bytearray())
+
+    def _drop(self, sock):
+        self.selector.unregister(sock)
+        del self.pending[sock]
+        sock.close()
+
+    def _route(self, sock):
+        #Bytes are consumed rather than peeked, so selector only wakes up on new data;
+        #worker gets them together with the socket
+        data = self.pending[sock][1]
+        try:
+            chunk = sock.recv(MAX_JOIN_PACKET - len(data))
+        except BlockingIOError:
+            return
+        except OSError:
+            chunk = b""
+        if not chunk:
+            self._drop(sock)
+            return
+        data += chunk
+        try:
+            done, name = _first_room(data)
+        except MultiplexerException as e:
+            logger.warning("Dropping connection: %s", e)
+            self._drop(sock)
+            return
+        if not done:
+            return
+        worker = self.worker_of(DEFAULT_ROOM if name is None else name)
+        self.selector.unregister(sock)
+        del self.pending[sock]
+        try:
+            socket.send_fds(self.controls[worker], [b"s" + data], [sock.fileno()])
+        finally:
+            sock.close()
+
+    def _drop_expired(self):
+        now = time.monotonic()
+        for sock in [sock for sock, (deadline, _) in self.pending.items() if deadline < now]:
+            logger.warning("Dropping connection: no first packet in %s seconds", self.join_timeout)
+            self._drop(sock)
+
+    def select(self, timeout=None):
+        for key, mask in self.selector.select(timeout):
+            if key.data is SelSockType.ACCEPTER:
+                self._accept()
+            else:
+                self._route(key.fileobj)
+        if self.pending:
+            self._drop_expired()
+
+    def serve_forever(self):
+        while self.run_thread:
+            self.select(0.1)
+
+    def serve_in_thread(self):
+        self._thread = Thread(target=self.serve_forever, daemon=True, name="multiplexer acceptor")
+        self._thread.start()
+
+    def close(self):
+        """Stops accepting and shuts down workers"""
+        self.run_thread = False
+        if hasattr(self, "_thread"):
+            self._thread.join()
+        for control in self.controls:
+            try:
+                control.send(b"")
+            except OSError:
+                pass
+        for process in self.workers:
+            process.join(1)
+            if process.is_alive():
+                process.terminate()
+        for control in self.controls:
+            control.close()
+        for sock in self.pending:
+            sock.close()
+        self.pending.clear()
+        self.selector.close()
+        self.listener.close()
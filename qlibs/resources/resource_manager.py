@@ -1,8 +1,18 @@
+import atexit
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
 from .resource_loader import get_res_data, get_res_path, get_image_data
 from ..models.modelloader import OBJLoader
 
+logger = logging.getLogger(__name__)
+
 pcs_storage = dict()
 modelloader = OBJLoader()
+model_pools = dict() #Workers -> process pool shared by **start_loading_models** calls
+#Resolved arrays workers send back, RenderableModel uploads indexed textured ones
+LOADED_FORMS = ("textured_indexed",)
 
 def get_storage_of_context(ctx):
     i = id(ctx)
@@ -17,6 +27,133 @@ def load_model(name):
     modelloader.load_path(get_res_path(name))
     return modelloader.get_obj()
 
+
+def _load_model_worker(path, cache_dir, forms):
+    """Runs in worker process, returns packed image of model at *path*"""
+    loader = OBJLoader(cache_dir=cache_dir)
+    loader.load_path(path)
+    return loader.pack(path, forms)
+
+
+def _unpack_model(data):
+    loader = OBJLoader()
+    loader.load_packed(data)
+    return loader.get_obj()
+
+
+class ModelLoadJob:
+    """
+      Models that are being loaded in worker processes, made by **start_loading_models**.
+      Models are parsed and resolved in workers, **poll** or **result** turn them into **OBJ** objects
+      with resolved arrays ready for upload, so only `ctx.buffer` calls are left for the context thread.
+    """
+    def __init__(self, names, executor, cache_dir=None, progress=None, forms=LOADED_FORMS):
+        self.names = list(names)
+        self.executor = executor
+        self.progress = progress
+        self.futures = [
+            executor.submit(_load_model_worker, get_res_path(name), cache_dir, forms) for name in self.names
+        ]
+        self.results = [None] * len(self.names)
+        self.errors = dict() #Name -> exception of models that could not be loaded
+        self.finished = 0
+        self._pending = set(range(len(self.futures)))
+
+    @property
+    def total(self):
+        return len(self.names)
+
+    @property
+    def done(self):
+        return self.finished == self.total
+
+    def poll(self):
+        """
+          Collects models loaded since last call without blocking, calls *progress*(finished, total, name) for each of them.
+          Returns True when all models are finished. Failed models count as finished,
+          first exception of models that failed since last call is reraised after the others are collected.
+        """
+        error = None
+        for i in sorted(self._pending):
+            if self.futures[i].done():
+                error = self._collect(i) or error
+        if error is not None:
+            raise error
+        return self.done
+
+    def result(self, timeout=None):
+        """Waits for all models, returns list of **OBJ** in order of names. Reraises exception of first failed model"""
+        indices = {self.futures[i]: i for i in self._pending}
+        for future in as_completed(indices, timeout):
+            self._collect(indices[future])
+        for name in self.names:
+            if name in self.errors:
+                raise self.errors[name]
+        return self.results
+
+    def cancel(self):
+        for future in self.futures:
+            future.cancel()
+
+    def _collect(self, i):
+        """Takes finished model *i*, returns its exception if it failed"""
+        self._pending.discard(i)
+        error = None
+        try:
+            self.results[i] = _unpack_model(self.futures[i].result())
+        except Exception as e:
+            logger.warning("Could not load model %s: %s", self.names[i], e)
+            self.errors[self.names[i]] = error = e
+        self.finished += 1
+        if self.progress is not None:
+            self.progress(self.finished, self.total, self.names[i])
+        return error
+
+
+def get_model_pool(workers=None):
+    """
+      Returns process pool with *workers* processes (cpu count by default) used for loading models.
+      Pool is made on first call and kept until **shutdown_model_pools**, so workers are started once
+    """
+    pool = model_pools.get(workers)
+    if pool is None:
+        pool = model_pools[workers] = ProcessPoolExecutor(workers)
+    return pool
+
+
+@atexit.register
+def shutdown_model_pools():
+    """Shuts down pools made by **get_model_pool**"""
+    for pool in model_pools.values():
+        pool.shutdown(wait=True, cancel_futures=True)
+    model_pools.clear()
+
+
+def start_loading_models(names, workers=None, progress=None, cache_dir=None, executor=None, forms=LOADED_FORMS):
+    """
+      Starts loading models *names* in process pool, returns **ModelLoadJob**.
+      Uses *executor* if given, otherwise shared pool from **get_model_pool** with *workers* processes.
+      If *cache_dir* is given, workers keep binary caches of parsed models there.
+      *forms* are keys of **CACHED_FORMS** that workers resolve, others are resolved on first use.
+    """
+    if executor is not None:
+        return ModelLoadJob(names, executor, cache_dir=cache_dir, progress=progress, forms=forms)
+    try:
+        return ModelLoadJob(names, get_model_pool(workers), cache_dir=cache_dir, progress=progress, forms=forms)
+    except BrokenProcessPool:
+        logger.warning("Model loading pool is broken, starting new one")
+        model_pools.pop(workers).shutdown(wait=False)
+        return ModelLoadJob(names, get_model_pool(workers), cache_dir=cache_dir, progress=progress, forms=forms)
+
+
+def load_models(names, workers=None, progress=None, cache_dir=None, executor=None, forms=LOADED_FORMS):
+    """
+      Loads models *names* in process pool, returns list of **OBJ** in the same order.
+      *progress*(finished, total, name) is called on the caller's thread as models arrive.
+    """
+    job = start_loading_models(names, workers, progress=progress, cache_dir=cache_dir, executor=executor, forms=forms)
+    return job.result()
+
 class PerContextStorage:
     """Storage for context-specific things"""
     def __init__(self, ctx):
@@ -1,23 +1,654 @@
+"""
+  Benchmark suite.
 
-from qlibs.math.matrix import PyMatrix4, Matrix4
+  Run with `python -m tests.performance`. Results can be saved as JSON with `--save`,
+  and compared against a saved baseline with `--baseline` (and `--threshold`).
+  Everything runs without a GPU: drawers get a stub moderngl context.
+"""
+
+import argparse
+import io
+import json
+import math
+import platform
+import sys
 import time
+import timeit
+
+from qlibs.math.matrix import PyMatrix4, Matrix4, Matrix4Array, IDENTITY
+from qlibs.math.vec import Vec, Vec2
+from qlibs.math.vecarray import Vec2Array
 
 ITERATIONS = 100000
 
-def matrix_perf():
-    for cls in [Matrix4, PyMatrix4]:
+benchmarks = dict()
+
+
+def benchmark(name, number=1000):
+    """
+    Registers benchmark. Decorated function does the setup and returns a callable,
+    which is timed *number* times per repeat.
+    """
+    def decorator(setup):
+        benchmarks[name] = (setup, number)
+        return setup
+    return decorator
+
+
+class StubBuffer:
+    def __init__(self, data=None, reserve=0, dynamic=False):
+        self.size = len(data) if data is not None else reserve
+
+    def write(self, data, offset=0):
+        pass
+
+    def orphan(self, size=-1):
+        if size >= 0:
+            self.size = size
+
+    def release(self):
+        pass
+
+
+class StubVertexArray:
+    def render(self, mode=None, vertices=-1, **kwargs):
+        pass
+
+    def release(self):
+        pass
+
+
+class StubProgram:
+    def get(self, name, default=None):
+        return default
+
+
+class StubTexture:
+    def use(self, location=0):
+        pass
+
+
+class StubContext:
+    """
+    Stands in for moderngl context, so that buffer building can be measured without a GPU
+    """
+    def buffer(self, data=None, reserve=0, dynamic=False):
+        return StubBuffer(data, reserve, dynamic)
+
+    def simple_vertex_array(self, program, buffer, *attributes, **kwargs):
+        return StubVertexArray()
+
+    def enable(self, flags):
+        pass
+
+    def enable_only(self, flags):
+        pass
+
+
+def make_obj_text(size=30):
+    """
+    Generates OBJ file contents with a *size* by *size* grid of quads
+    """
+    lines = ["o grid", "usemtl plain"]
+    for y in range(size + 1):
+        for x in range(size + 1):
+            lines.append(f"v {x} {y} {math.sin(x * 0.1) * math.cos(y * 0.1):.6f}")
+            lines.append(f"vt {x / size:.6f} {y / size:.6f}")
+            lines.append("vn 0 0.3 1")
+    for y in range(size):
+        for x in range(size):
+            i = y * (size + 1) + x + 1
+            j = i + size + 1
+            lines.append(f"f {i}/{i}/{i} {i+1}/{i+1}/{i+1} {j+1}/{j+1}/{j+1} {j}/{j}/{j}")
+    return "\n".join(lines) + "\n"
+
+
+@benchmark("vec2.add", number=100000)
+def _():
+    a, b = Vec2(1, 2), Vec2(3, 4)
+    return lambda: a + b
+
+
+@benchmark("vec2.iadd", number=100000)
+def _():
+    a, b = Vec2(1, 2), Vec2(3, 4)
+    def run():
+        nonlocal a
+        a += b
+    return run
+
+
+@benchmark("vec.add", number=100000)
+def _():
+    a, b = Vec(1, 2, 3), Vec(3, 4, 5)
+    return lambda: a + b
+
+
+@benchmark("vec.normalized", number=100000)
+def _():
+    a = Vec(1, 2, 3)
+    return a.normalized
+
+
+@benchmark("vec2array.add.10k", number=100)
+def _():
+    a = Vec2Array(range(20000))
+    b = Vec2Array(range(20000))
+    return lambda: a + b
+
+
+@benchmark("vec2array.rotate.10k", number=100)
+def _():
+    a = Vec2Array(range(20000))
+    return lambda: a.rotate(0.5)
+
+
+@benchmark("matrix.matmul", number=100000)
+def _():
+    m1 = Matrix4(IDENTITY)
+    m2 = Matrix4.rotation_euler(0.1, 0.2, 0.3)
+    return lambda: m1 @ m2
+
+
+@benchmark("matrix.matmul.py", number=100000)
+def _():
+    m1 = PyMatrix4(IDENTITY)
+    m2 = PyMatrix4.rotation_euler(0.1, 0.2, 0.3)
+    return lambda: m1 @ m2
+
+
+@benchmark("matrix.inverse.generic", number=10000)
+def _():
+    m = Matrix4(list(Matrix4.rotation_euler(0.1, 0.2, 0.3)._data))
+    return m._calc_inverse
+
+
+@benchmark("matrix.inverse.rigid", number=10000)
+def _():
+    m = Matrix4.translation_matrix(1, 2, 3) @ Matrix4.rotation_euler(0.1, 0.2, 0.3)
+    return m._calc_inverse
+
+
+@benchmark("matrix.batch_matmul.1k", number=100)
+def _():
+    m = Matrix4.rotation_euler(0.1, 0.2, 0.3)
+    stack = Matrix4Array.from_matrices([Matrix4.translation_matrix(i, i, i) for i in range(1000)])
+    return lambda: m.batch_matmul(stack)
+
+
+@benchmark("qpacket.convert", number=1000)
+def _():
+    from qlibs.net.qpacket import convert
+    value = [(i, i * 0.5, f"player{i}", b"\x00" * 16, None) for i in range(50)]
+    return lambda: convert(value)
+
+
+@benchmark("qpacket.decode", number=1000)
+def _():
+    from qlibs.net.qpacket import convert, decode
+    data = convert([(i, i * 0.5, f"player{i}", b"\x00" * 16, None) for i in range(50)])
+    return lambda: list(decode(data))
+
+
+@benchmark("qpacket.stream_decode", number=1000)
+def _():
+    from qlibs.net.qpacket import convert, StreamDecoder
+    data = b"".join(convert((i, i * 0.5, f"player{i}", b"\x00" * 16, None)) for i in range(50))
+    chunks = [data[i:i+256] for i in range(0, len(data), 256)]
+    def run():
+        dec = StreamDecoder()
+        for chunk in chunks:
+            dec.feed(chunk)
+        list(dec)
+    return run
+
+
+@benchmark("qpacket.schema.convert", number=1000)
+def _():
+    from qlibs.net.qpacket import Schema
+    schema = Schema(1, [("id", "i32"), ("x", "f64"), ("name", "str"), ("data", "bytes")])
+    value = [(i, i * 0.5, f"player{i}", b"\x00" * 16) for i in range(50)]
+    return lambda: [schema.convert(v) for v in value]
+
+
+@benchmark("qpacket.schema.decode", number=1000)
+def _():
+    from qlibs.net.qpacket import Schema, Decoder
+    schema = Schema(1, [("id", "i32"), ("x", "f64"), ("name", "str"), ("data", "bytes")])
+    data = b"".join(schema.pack((i, i * 0.5, f"player{i}", b"\x00" * 16)) for i in range(50))
+    def run():
+        io = Decoder(data).io
+        for _ in range(50):
+            schema.unpack_from(io)
+    return run
+
+
+@benchmark("bytebuffer.write_read", number=1000)
+def _():
+    from qlibs.collections import ByteBuffer
+    chunk = b"\x01" * 1024
+    def run():
+        buff = ByteBuffer(join_with=b"")
+        for _ in range(64):
+            buff.write(chunk)
+        left = 64 * 1024
+        while left > 0:
+            buff.peek(8192)
+            left -= len(buff.read(min(1500, left)))
+    return run
+
+
+@benchmark("asyncsocket.framing", number=100)
+def _():
+    from qlibs.net.asyncsocket import bytes_packet_sender, bytes_packet_reciever
+    data = b"".join(bytes_packet_sender(bytes(size)) for size in (20, 200, 2000) * 20)
+    class FakeSocket:
+        storage = []
+    def run():
+        sock = FakeSocket()
+        sock.storage = []
+        gen = bytes_packet_reciever(sock)
+        gen.send(None)
+        for b in data:
+            gen.send(b)
+    return run
+
+
+@benchmark("asyncsocket.framer", number=100)
+def _():
+    from qlibs.net.asyncsocket import bytes_packet_sender, BytesPacketFramer
+    data = b"".join(bytes_packet_sender(bytes(size)) for size in (20, 200, 2000) * 20)
+    chunks = [data[i:i+1500] for i in range(0, len(data), 1500)]
+    def run():
+        framer = BytesPacketFramer()
+        for chunk in chunks:
+            framer.feed(chunk)
+    return run
+
+
+def _packet_recv_benchmark(copy):
+    from socket import socketpair
+    from qlibs.net.asyncsocket import bytes_packet_sender, BytesPacketFramer, PacketSocket
+    data = b"".join(bytes_packet_sender(bytes(size)) for size in (20, 200, 2000) * 20)
+    a, b = socketpair()
+    sock = PacketSocket(b, BytesPacketFramer, copy=copy)
+    def run():
+        a.sendall(data)
+        left = 60
+        while left:
+            left -= len(sock.recv())
+    return run
+
+
+@benchmark("asyncsocket.packet_recv", number=100)
+def _():
+    return _packet_recv_benchmark(True)
+
+
+@benchmark("asyncsocket.packet_recv_views", number=100)
+def _():
+    return _packet_recv_benchmark(False)
+
+
+@benchmark("multiplexer.replay", number=10)
+def _():
+    from qlibs.net.recording import MultiplexRecorder
+    from qlibs.net.multiplexer import MultiplexReplayer, PayloadEvent, ReadyEvent, convert_event, bytes_packet_sender
+    recording = io.BytesIO()
+    recorder = MultiplexRecorder(recording)
+    for step in range(200):
+        for player in range(8):
+            recorder.record(bytes_packet_sender(convert_event(PayloadEvent(player, bytes(32)))), step * 0.05)
+        recorder.record(bytes_packet_sender(convert_event(ReadyEvent(0.05))), step * 0.05)
+    data = recording.getvalue()
+    class Engine:
+        def step(self, delta, events):
+            pass
+    def run():
+        MultiplexReplayer(Engine()).replay(io.BytesIO(data))
+    return run
+
+
+@benchmark("obj.load", number=10)
+def _():
+    from qlibs.models.modelloader import OBJLoader
+    text = make_obj_text()
+    def run():
+        loader = OBJLoader()
+        loader.load_file(io.StringIO(text))
+    return run
+
+
+@benchmark("obj.load_cached", number=10)
+def _():
+    import os
+    import tempfile
+    from qlibs.models.modelloader import OBJLoader
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "grid.obj")
+    with open(path, "w") as f:
+        f.write(make_obj_text())
+    OBJLoader(cache_dir=directory).load_path(path)
+    def run():
+        loader = OBJLoader(cache_dir=directory)
+        loader.load_path(path)
+    return run
+
+
+@benchmark("obj.resolve", number=10)
+def _():
+    from qlibs.models.modelloader import OBJLoader
+    loader = OBJLoader()
+    loader.load_file(io.StringIO(make_obj_text()))
+    obj = loader.get_obj()
+    def run():
+        obj.invalidate()
+        obj.resolve()
+    return run
+
+
+@benchmark("obj.resolve_python", number=10)
+def _():
+    from qlibs.models import modelloader
+    loader = modelloader.OBJLoader()
+    loader.load_file(io.StringIO(make_obj_text()))
+    obj = loader.get_obj()
+    def run():
+        numpy, modelloader.numpy = modelloader.numpy, None
+        try:
+            obj.invalidate()
+            obj.resolve()
+        finally:
+            modelloader.numpy = numpy
+    return run
+
+
+@benchmark("obj.resolve_indexed", number=10)
+def _():
+    from qlibs.models.modelloader import OBJLoader
+    loader = OBJLoader()
+    loader.load_file(io.StringIO(make_obj_text()))
+    obj = loader.get_obj()
+    def run():
+        obj.invalidate()
+        obj.resolve_indexed()
+    return run
+
+
+@benchmark("obj.load_models_serial", number=2)
+def _():
+    import os
+    import tempfile
+    from qlibs.models.modelloader import FORMAT_TEXTURES
+    from qlibs.resources import resource_manager
+    directory = tempfile.mkdtemp()
+    paths = [os.path.join(directory, f"grid{i}.obj") for i in range(16)]
+    for path in paths:
+        with open(path, "w") as f:
+            f.write(make_obj_text())
+    def run():
+        for path in paths:
+            loader = resource_manager.OBJLoader()
+            loader.load_path(path)
+            list(loader.get_obj().iter_materials_textured(*FORMAT_TEXTURES, indexed=True))
+    return run
+
+
+@benchmark("obj.load_models", number=2)
+def _():
+    import os
+    import tempfile
+    from qlibs.models.modelloader import FORMAT_TEXTURES
+    from qlibs.resources import resource_manager
+    directory = tempfile.mkdtemp()
+    paths = [os.path.join(directory, f"grid{i}.obj") for i in range(16)]
+    for path in paths:
+        with open(path, "w") as f:
+            f.write(make_obj_text())
+    resource_manager.load_models(paths[:1]) #Starts shared pool, so only loading is measured
+    def run():
+        for obj in resource_manager.load_models(paths):
+            list(obj.iter_materials_textured(*FORMAT_TEXTURES, indexed=True)) #What RenderableModel needs
+    return run
+
+
+@benchmark("lod.simplify", number=2)
+def _():
+    from qlibs.models.modelloader import OBJLoader
+    from qlibs.models.lod import simplify
+    loader = OBJLoader()
+    loader.load_file(io.StringIO(make_obj_text()))
+    obj = loader.get_obj()
+    def run():
+        simplify(obj, ratio=0.125)
+    return run
+
+
+@benchmark("shape_drawer.build", number=100)
+def _():
+    from qlibs.gui.basic_shapes import ShapeDrawer
+    drawer = ShapeDrawer(ctx=StubContext(), prog=StubProgram())
+    def run():
+        for i in range(100):
+            drawer.add_rectangle(i, i, 10, 10, color=(1, 0, 0))
+            drawer.add_line2d(Vec2(i, 0), Vec2(0, i + 1), width=2)
+            drawer.add_line((i, 0), (0, i))
+        drawer.render()
+    return run
+
+
+@benchmark("sprite_drawer.build", number=100)
+def _():
+    from qlibs.gui.sprite_drawer import SpriteDrawerBase
+    drawer = SpriteDrawerBase(StubTexture(), StubProgram(), StubContext())
+    def run():
+        for i in range(100):
+            drawer.add_sprite_rect(0, i, i, 10, 10)
+            drawer.add_sprite_rotated(0, i, i, 10, 10, i * 0.1)
+        drawer.render()
+    return run
+
+
+@benchmark("widgets.rcplacer.recalc_size", number=100)
+def _():
+    from qlibs.gui.widgets.behaviors import ColumnPlacerB, RowPlacerB, NodeB
+    root = ColumnPlacerB(spacing=2)
+    for _ in range(10):
+        row = RowPlacerB(spacing=1)
+        for _ in range(10):
+            row.add_child(NodeB())
+        root.add_child(row)
+    root.size = (800, 600)
+    return root.recalc_size
+
+
+def run_benchmarks(name_filter=None, repeat=5, scale=1.0):
+    """
+    Runs registered benchmarks which contain *name_filter* in their names.
+    Returns dict of name -> {"per_op": best seconds per call, "number": calls per repeat}
+    """
+    results = dict()
+    for name, (setup, number) in benchmarks.items():
+        if name_filter is not None and name_filter not in name:
+            continue
+        number = max(1, int(number * scale))
+        fun = setup()
+        best = min(timeit.Timer(fun).repeat(repeat=repeat, number=number)) / number
+        results[name] = {"per_op": best, "number": number}
+        print("%-32s %12.3f us" % (name, best * 1e6))
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Compares *results* with *baseline*, returns list of benchmark names that are
+    more than *threshold* (fraction) slower
+    """
+    regressions = []
+    print()
+    print("%-32s %12s %12s %8s" % ("benchmark", "baseline us", "current us", "ratio"))
+    for name, res in results.items():
+        if name not in baseline:
+            print("%-32s %12s %12.3f" % (name, "-", res["per_op"] * 1e6))
+            continue
+        base = baseline[name]["per_op"]
+        ratio = res["per_op"] / base if base > 0 else math.inf
+        mark = ""
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            mark = "  REGRESSION"
+        print("%-32s %12.3f %12.3f %8.2f%s" % (name, base * 1e6, res["per_op"] * 1e6, ratio, mark))
+    return regressions
+
+
+def _count_allocations(cls, fun):
+    """Runs *fun*, returning amount of *cls* instances created"""
+    counter = 0
+    original = cls.__init__
+    def counting_init(self, *args):
+        nonlocal counter
+        counter += 1
+        original(self, *args)
+    cls.__init__ = counting_init
+    try:
+        fun()
+    finally:
+        cls.__init__ = original
+    return counter
+
+
+def _measure(name, cls, fun):
+    start = time.perf_counter()
+    fun()
+    end = time.perf_counter()
+    allocations = _count_allocations(cls, fun)
+    print("%-26s %.2f s, %d %s allocations" % (name, end-start, allocations, cls.__name__))
+
+
+def vector_perf():
+    for cls in [Vec2, Vec]:
         print("Testing", cls.__name__)
-        m1 = cls()
-        m2 = cls()
-        start = time.perf_counter()
-        for _ in range(ITERATIONS):
-            m1 * m2
-        end = time.perf_counter()
-        print("%s took %.2f s" % (cls.__name__, end-start))
-    
+        def allocating():
+            pos, vel, acc = cls(0, 0), cls(1, 1), cls(0.5, 0.5)
+            for _ in range(ITERATIONS):
+                vel = vel + acc * 0.01
+                pos = pos + vel * 0.01
+        def inplace():
+            pos, vel, acc = cls(0, 0), cls(1, 1), cls(0.5, 0.5)
+            for _ in range(ITERATIONS):
+                vel.axpy(0.01, acc)
+                pos.axpy(0.01, vel)
+        def lerp():
+            a, b, out = cls(0, 0), cls(1, 1), cls(0, 0)
+            for _ in range(ITERATIONS):
+                a.lerp_into(b, 0.5, out)
+        _measure("pos = pos + vel * dt", cls, allocating)
+        _measure("pos.axpy(dt, vel)", cls, inplace)
+        _measure("a.lerp_into(b, t, out)", cls, lerp)
 
 
+def multiplexer_perf(clients=4, duration=2.0):
+    """
+    Runs asyncio multiplexer server with *clients* clients over localhost, which step as fast
+    as they can, and reports achievable steps per second
+    """
+    import asyncio
+    from qlibs.net.async_multiplexer import AsyncMultiplexServer, AsyncMultiplexClient
 
-if __name__ == "__main__":
-    matrix_perf()
+    class Engine:
+        def step(self, delta, events):
+            pass
+
+    async def run():
+        server = await AsyncMultiplexServer.start("127.0.0.1", 0)
+        connected = []
+        for _ in range(clients):
+            client = await AsyncMultiplexClient.connect(Engine(), host="127.0.0.1", port=server.port)
+            client.min_step_time = 0
+            connected.append(client)
+        await asyncio.sleep(duration)
+        for client in connected:
+            client.close()
+        server.close()
+        await server.wait_closed()
+        return [client.metrics.snapshot() for client in connected]
+
+    stats = asyncio.run(run())
+    print("%d clients, %.0f steps/s" % (clients, min(st["steps_per_second"] for st in stats)))
+    for i, st in enumerate(stats):
+        print("client %-3d p50 %8.3f ms  p95 %8.3f ms  stalled %6.3f s  in %8d B  out %8d B" % (
+            i, st["latency_p50"] * 1000, st["latency_p95"] * 1000, st["stalled_time"], st["bytes_in"], st["bytes_out"],
+        ))
+
+
+def idle_server_perf(clients=100, duration=2.0):
+    """
+    Runs **MultiplexServer** with *clients* connected clients that send nothing, 
+    and reports CPU time it uses
+    """
+    import socket
+    from qlibs.net.multiplexer import MultiplexServer
 
+    server = MultiplexServer("127.0.0.1", 0)
+    port = server.socket_selector.sock.socket.getsockname()[1]
+    server.serve_in_thread()
+    connected = []
+    for _ in range(clients):
+        connected.append(socket.create_connection(("127.0.0.1", port)))
+    time.sleep(0.5) #Let server accept everyone
+    start = time.process_time()
+    time.sleep(duration)
+    used = time.process_time() - start
+    server.stop_thread()
+    server._thread.join()
+    for sock in connected:
+        sock.close()
+    print("%d idle clients, server used %.1f%% of a core" % (clients, used / duration * 100))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="QLibs benchmarks")
+    parser.add_argument("-k", dest="name_filter", help="only run benchmarks containing this string")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplier for amount of calls per repeat")
+    parser.add_argument("--save", help="save results to this JSON file")
+    parser.add_argument("--baseline", help="compare results with this JSON file")
+    parser.add_argument("--threshold", type=float, default=0.1, help="allowed slowdown, as a fraction (default 0.1)")
+    parser.add_argument("--allocations", action="store_true", help="report vector allocations instead")
+    parser.add_argument("--multiplexer", type=int, metavar="N", help="report multiplexer steps per second with N clients instead")
+    parser.add_argument("--idle", type=int, metavar="N", help="report CPU usage of multiplexer server with N idle clients instead")
+    args = parser.parse_args(argv)
+
+    if args.allocations:
+        vector_perf()
+        return 0
+    if args.multiplexer:
+        multiplexer_perf(args.multiplexer)
+        return 0
+    if args.idle:
+        idle_server_perf(args.idle)
+        return 0
+
+    results = run_benchmarks(args.name_filter, args.repeat, args.scale)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({
+                "meta": {
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "time": time.time(),
+                },
+                "results": results,
+            }, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} benchmarks regressed by more than {args.threshold:.0%}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
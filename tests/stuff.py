@@ -1,12 +1,18 @@
+import time
 import unittest
 
 #from qlibs.net.qpacket import *
-from qlibs.math.vec import IVec, MVec
-from qlibs.math.matrix import Matrix4, IDENTITY, ZEROS_16
+from qlibs.math.vec import IVec, MVec, Vec2
+from qlibs.math.vecarray import VecArray, Vec2Array
+from qlibs.math import matrix
+from qlibs.math.matrix import Matrix4, Matrix4Array, MatrixKind, IDENTITY, ZEROS_16
 #from qlibs.net import connection as cn
 from qlibs.resources import resource_loader
 from socket import socketpair
 from qlibs.collections import ByteBuffer
+from qlibs.net.asyncsocket import BytesPacketFramer, PacketSocket, bytes_packet_sender
+from qlibs.net import qpacket
+from array import array
 
 import qlibs.gui.basic_shapes
 import qlibs.gui.sprite_drawer
@@ -39,6 +45,90 @@ class VecTestCase(unittest.TestCase):
         v.normalize()
         self.assertTrue(v.len() == 1)
 
+    def test_inplace(self):
+        for cls in (MVec, Vec2):
+            v = cls(1, 2)
+            ref = v
+            v += cls(1, 1)
+            v *= 2
+            v -= cls(1, 1)
+            v /= 2
+            self.assertIs(v, ref)
+            self.assertEqual(v, cls(1.5, 2.5))
+        with self.assertRaises(ValueError):
+            v = MVec(1, 2)
+            v += MVec(1, 2, 3)
+
+    def test_into(self):
+        for cls in (MVec, Vec2):
+            out = cls(0, 0)
+            self.assertIs(cls(1, 2).add_into(cls(3, 4), out), out)
+            self.assertEqual(out, cls(4, 6))
+            self.assertEqual(cls(1, 2).sub_into(cls(3, 4), out), cls(-2, -2))
+            self.assertEqual(cls(1, 2).mul_into(3, out), cls(3, 6))
+            self.assertEqual(cls(0, 2).lerp_into(cls(4, 4), 0.5, out), cls(2, 3))
+            v = cls(1, 1)
+            self.assertIs(v.axpy(2, cls(1, 2)), v)
+            self.assertEqual(v, cls(3, 5))
+
+
+class VecArrayTestCase(unittest.TestCase):
+    def test_shape(self):
+        arr = VecArray(3, range(9))
+        self.assertEqual(len(arr), 3)
+        self.assertEqual(arr[1], MVec(3, 4, 5))
+        self.assertEqual(arr[-1], MVec(6, 7, 8))
+        with self.assertRaises(ValueError):
+            VecArray(3, range(4))
+        with self.assertRaises(IndexError):
+            arr[3]
+
+    def test_row_view(self):
+        arr = Vec2Array([1, 2, 3, 4])
+        row = arr[1]
+        self.assertIsInstance(row, Vec2)
+        row.x = 10
+        self.assertEqual(arr.column(0).tolist(), [1, 10])
+        arr += Vec2(1, 1)
+        self.assertEqual(row, Vec2(11, 5))
+        self.assertIsInstance(row + Vec2(1, 1), Vec2)
+
+    def test_elementwise(self):
+        a = Vec2Array([1, 2, 3, 4])
+        b = Vec2Array([4, 3, 2, 1])
+        self.assertEqual(a + b, Vec2Array([5, 5, 5, 5]))
+        self.assertEqual(a - b, Vec2Array([-3, -1, 1, 3]))
+        self.assertEqual(a * 2, Vec2Array([2, 4, 6, 8]))
+        self.assertEqual(a / Vec2(1, 2), Vec2Array([1, 1, 3, 2]))
+        with self.assertRaises(ValueError):
+            a + VecArray(3, range(6))
+
+    def test_dot_len(self):
+        a = Vec2Array([3, 4, 0, 2])
+        self.assertEqual(a.len().tolist(), [5, 2])
+        self.assertEqual(a.dot(Vec2(1, 1)).tolist(), [7, 2])
+        self.assertEqual(a.dot(a).tolist(), [25, 4])
+        v = VecArray(3, [1, 2, 2, 0, 0, 0])
+        self.assertEqual(v.len().tolist(), [3, 0])
+        v.normalize()
+        self.assertAlmostEqual(v[0].len(), 1, places=5)
+        self.assertEqual(v[1], MVec(0, 0, 0))
+
+    def test_rotate_perpendicular(self):
+        import math
+        a = Vec2Array([1, 0, 0, 2])
+        rotated = a.rotate(math.pi / 2)
+        for row, expected in zip(rotated, (Vec2(0, 1), Vec2(-2, 0))):
+            self.assertAlmostEqual(row.x, expected.x, places=5)
+            self.assertAlmostEqual(row.y, expected.y, places=5)
+        self.assertEqual(a.perpendicular(), Vec2Array([0, 1, -2, 0]))
+        self.assertEqual(a.in_box((0, 0), (1, 1)), [True, False])
+
+    def test_bytes(self):
+        a = Vec2Array([1, 2, 3, 4])
+        self.assertEqual(len(a.bytes()), 16)
+        self.assertEqual(len(a.bytes("d")), 32)
+
 
 class MatrixTestCase(unittest.TestCase):
     def test_multiply_identity(self):
@@ -77,6 +167,8 @@ class MatrixTestCase(unittest.TestCase):
         b = mat.bytes()
         self.assertIsInstance(b, bytes)
         self.assertGreater(len(b), 15)
+        self.assertEqual(len(Matrix4Array(ZEROS_16 * 2).bytes()), 128)
+        self.assertEqual(Matrix4Array(IDENTITY).bytes("d"), array("d", IDENTITY).tobytes())
 
     def test_translation_matrix(self):
         m = Matrix4.translation_matrix(10, 5, 2)
@@ -116,6 +208,65 @@ class MatrixTestCase(unittest.TestCase):
         ])
         self.assertEqual(mat * mat.inverse(), Matrix4(IDENTITY))
 
+    def assertMatrixAlmostEqual(self, m1, m2, places=4):
+        for i in range(4):
+            for j in range(4):
+                self.assertAlmostEqual(m1[i, j], m2[i, j], places=places)
+
+    def test_inverse_kinds(self):
+        rotation = Matrix4.rotation_euler(0.3, 0.5, 0.7)
+        cases = [
+            (Matrix4.translation_matrix(1, 2, 3), MatrixKind.TRANSLATION),
+            (rotation, MatrixKind.ROTATION),
+            (Matrix4.scale_matrix(3), MatrixKind.SCALE),
+            (Matrix4.look_at(IVec(10, 3, 2), IVec(0, 0, 0), IVec(0, 0, 1)), MatrixKind.RIGID),
+            (Matrix4.translation_matrix(1, 2, 3) @ rotation, MatrixKind.RIGID),
+            (Matrix4.scale_matrix(2) @ rotation, MatrixKind.AFFINE),
+            (Matrix4.orthogonal_projection(0, 800, 0, 600), MatrixKind.AFFINE),
+            (Matrix4.perspective_projection(45, 1.3, 0.1, 100), MatrixKind.PERSPECTIVE),
+        ]
+        for mat, kind in cases:
+            self.assertEqual(mat.kind, kind)
+            generic = Matrix4(list(mat._data)).inverse()
+            self.assertMatrixAlmostEqual(mat.inverse(), generic)
+            self.assertMatrixAlmostEqual(mat @ mat.inverse(), Matrix4(IDENTITY))
+
+    def test_inverse_cache(self):
+        mat = Matrix4.translation_matrix(1, 2, 3)
+        inv = mat.inverse()
+        inv[0, 0] = 10
+        self.assertEqual(mat.inverse()[0, 0], 1)
+        mat[3, 0] = 5
+        self.assertEqual(mat.kind, MatrixKind.GENERIC)
+        self.assertAlmostEqual(mat.inverse()[3, 0], -5)
+
+    def test_batch_matmul(self):
+        single = Matrix4.rotation_euler(0.1, 0.2, 0.3) @ Matrix4.translation_matrix(1, 2, 3)
+        matrices = [Matrix4([(i * 7 + j) % 5 for j in range(16)]) for i in range(40)]
+        stack = Matrix4Array.from_matrices(matrices)
+        self.assertEqual(len(stack), 40)
+        saved_numpy = matrix.numpy
+        try:
+            for numpy_module in (saved_numpy, None):
+                matrix.numpy = numpy_module
+                left = single.batch_matmul(stack)
+                right = stack @ single
+                for i, m in enumerate(matrices):
+                    self.assertMatrixAlmostEqual(left[i], single @ m)
+                    self.assertMatrixAlmostEqual(right[i], m @ single)
+        finally:
+            matrix.numpy = saved_numpy
+
+    def test_batch_matmul_out(self):
+        stack = Matrix4Array.from_matrices([Matrix4(IDENTITY)] * 3)
+        out = Matrix4Array(ZEROS_16 * 3)
+        res = Matrix4.translation_matrix(1, 2, 3).batch_matmul(stack, out=out)
+        self.assertIs(res, out)
+        self.assertEqual(out[2], Matrix4.translation_matrix(1, 2, 3))
+        self.assertEqual(len(out.bytes()), 3 * 64)
+        with self.assertRaises(ValueError):
+            Matrix4(IDENTITY).batch_matmul(stack, out=Matrix4Array())
+
         
     
 
@@ -133,6 +284,353 @@ class LoaderTestCase(unittest.TestCase):
         self.assertEqual(res, None)
 
 
+OBJ_TEXT = """mtllib cube.mtl
+o quad
+v 0 0 0
+v 1 0 0
+v 1 1 0
+v 0 1 0
+vt 0 0
+vt 1 0
+vt 1 1
+vt 0 1
+vn 0 0 2
+usemtl red
+f 1/1/1 2/2/1 3/3/1 4/4/1
+usemtl blue
+f -4/-4/-1 -2/-2/-1 -1/-1/-1
+"""
+
+
+class OBJLoaderTestCase(unittest.TestCase):
+    def write_files(self, directory, mtl="newmtl red\nKd 1 0 0\nnewmtl blue\nKd 0 0 1\n"):
+        import os
+        with open(os.path.join(directory, "cube.obj"), "w") as f:
+            f.write(OBJ_TEXT)
+        with open(os.path.join(directory, "cube.mtl"), "w") as f:
+            f.write(mtl)
+        return os.path.join(directory, "cube.obj")
+
+    def test_parse(self):
+        import tempfile
+        from qlibs.models.modelloader import OBJLoader
+        with tempfile.TemporaryDirectory() as directory:
+            loader = OBJLoader()
+            loader.load_path(self.write_files(directory))
+        obj = loader.get_obj("quad")
+        self.assertEqual(obj.vn, [(0, 0, 1)])
+        self.assertEqual(obj.sub_obj["red"].f, [[0, 0, 0, 1, 1, 0, 2, 2, 0], [0, 0, 0, 2, 2, 0, 3, 3, 0]])
+        self.assertEqual(obj.sub_obj["blue"].f, [[0, 0, 0, 2, 2, 0, 3, 3, 0]])
+        self.assertEqual(loader.materials["red"].raw_params["Kd"], "1 0 0")
+        self.assertEqual(list(obj.resolve(material="blue")[:8]), [0, 0, 0, 0, 0, 1, 0, 0])
+
+    def test_resolve_indexed(self):
+        import tempfile
+        from qlibs.models.modelloader import OBJLoader, OBJIndex, FORMAT_NO_TEXTURES
+        with tempfile.TemporaryDirectory() as directory:
+            loader = OBJLoader()
+            loader.load_path(self.write_files(directory))
+        obj = loader.get_obj("quad")
+        vertices, indices = obj.resolve_indexed(material="red")
+        self.assertEqual(list(indices), [0, 1, 2, 0, 2, 3])
+        self.assertEqual(len(vertices), 4 * 8)
+        expanded = [x for i in indices for x in vertices[i * 8:(i + 1) * 8]]
+        self.assertEqual(expanded, list(obj.resolve(material="red")))
+        vertices, indices = obj.resolve_indexed(*FORMAT_NO_TEXTURES, material="blue")
+        self.assertEqual((len(vertices), list(indices)), (3 * 6, [0, 1, 2]))
+        with self.assertRaises(ValueError):
+            obj.resolve_indexed(OBJIndex.VX, OBJIndex.VY, OBJIndex.VNZ, material="red")
+
+    def test_resolve_memoized(self):
+        import io
+        from qlibs.models import modelloader
+        lines = ["usemtl grid"]
+        size = 20
+        for y in range(size + 1):
+            for x in range(size + 1):
+                lines.append("v %d %d %d" % (x, y, x * y))
+                lines.append("vt %f %f" % (x / size, y / size))
+                lines.append("vn 0 1 %d" % x)
+        for y in range(size):
+            for x in range(size):
+                i = y * (size + 1) + x + 1
+                j = i + size + 1
+                if x == 0:
+                    lines.append("f %d//%d %d//%d %d//%d" % (i, i, i + 1, i + 1, j, j)) #No textures
+                else:
+                    lines.append("f %d/%d/%d %d/%d/%d %d/%d/%d" % (i, i, i, i + 1, i + 1, i + 1, j, j, j))
+        loader = modelloader.OBJLoader()
+        loader.load_file(io.StringIO("\n".join(lines)))
+        obj = loader.get_obj()
+        self.assertGreater(len(obj.sub_obj["grid"].f), modelloader.NUMPY_RESOLVE_THRESHOLD)
+
+        calls = [
+            (modelloader.FORMAT_TEXTURES, modelloader.check_has_textures),
+            (modelloader.FORMAT_NO_TEXTURES, modelloader.check_has_no_textures),
+            (modelloader.FORMAT_NO_TEXTURES, modelloader.accept_all),
+            (modelloader.FORMAT_NO_TEXTURES, lambda face: face[0] % 2 == 0),
+        ]
+        results = [obj.resolve(*form, filter_by=filter_by) for form, filter_by in calls]
+        self.assertIs(obj.resolve(*calls[0][0], filter_by=calls[0][1]), results[0])
+        numpy, modelloader.numpy = modelloader.numpy, None
+        try:
+            obj.invalidate()
+            for (form, filter_by), res in zip(calls, results):
+                self.assertEqual(obj.resolve(*form, filter_by=filter_by), res)
+        finally:
+            modelloader.numpy = numpy
+        self.assertEqual(len(results[0]) + len(results[1]) * 8 // 6, len(results[2]) * 8 // 6)
+
+        obj.v.append((0, 0, 0))
+        self.assertIsNot(obj.resolve(*calls[0][0], filter_by=calls[0][1]), results[0]) #Model changed
+
+        #Items replaced in place are noticed too, by both numpy sources and memoized results
+        indexed = obj.resolve_indexed(*modelloader.FORMAT_TEXTURES, filter_by=modelloader.check_has_textures)
+        resolved = obj.resolve(*calls[2][0], filter_by=calls[2][1])
+        obj.v[0] = (100, 100, 100)
+        self.assertEqual(obj.resolve(*calls[2][0], filter_by=calls[2][1])[:3].tolist(), [100, 100, 100])
+        self.assertNotEqual(obj.resolve(*calls[2][0], filter_by=calls[2][1]), resolved)
+        obj.vt[1] = (5, 5)
+        self.assertIsNot(obj.resolve_indexed(*modelloader.FORMAT_TEXTURES, filter_by=modelloader.check_has_textures), indexed)
+        faces = obj.sub_obj["grid"].f
+        faces[0], faces[1] = faces[1], faces[0]
+        self.assertNotEqual(obj.resolve(*calls[2][0], filter_by=calls[2][1])[:3].tolist(), [100, 100, 100])
+
+        #Results for ad hoc filters aren't kept
+        obj.resolve(*calls[3][0], filter_by=calls[3][1])
+        self.assertFalse(any(key[2] is calls[3][1] for key in obj.resolved))
+
+    def test_cache(self):
+        import os
+        import tempfile
+        from qlibs.models.modelloader import OBJLoader
+        with tempfile.TemporaryDirectory() as directory:
+            path = self.write_files(directory)
+            cache_dir = os.path.join(directory, "cache")
+            parsed = OBJLoader(cache_dir=cache_dir)
+            parsed.load_path(path)
+            self.assertTrue(os.path.exists(parsed.cache_path(path)))
+
+            cached = OBJLoader(cache_dir=cache_dir)
+            cached.load_file = None #Would fail if file was parsed
+            cached.load_path(path)
+            a, b = parsed.get_obj("quad"), cached.get_obj("quad")
+            self.assertEqual(cached.current_material, "blue")
+            for material in ("red", "blue"):
+                self.assertEqual(list(b.resolve(material=material)), list(a.resolve(material=material)))
+            self.assertEqual(b.v, a.v)
+            self.assertEqual(b.sub_obj["red"].f, a.sub_obj["red"].f)
+            self.assertEqual(cached.materials["blue"].raw_params, {"Kd": "0 0 1"})
+
+            self.write_files(directory, mtl="newmtl red\nKd 0.5 0 0\nnewmtl blue\nKd 0 0 1\n")
+            reloaded = OBJLoader(cache_dir=cache_dir)
+            reloaded.load_path(path)
+            self.assertEqual(reloaded.materials["red"].raw_params["Kd"], "0.5 0 0")
+            del a, b, cached #Views of old cache file
+
+    def test_cache_mapping(self):
+        import os
+        import tempfile
+        from unittest import mock
+        from qlibs.models import modelloader
+        with tempfile.TemporaryDirectory() as directory:
+            path = self.write_files(directory)
+            cache_dir = os.path.join(directory, "cache")
+            parsed = modelloader.OBJLoader(cache_dir=cache_dir)
+            parsed.load_path(path)
+            expected = list(parsed.get_obj("quad").resolve(material="red"))
+
+            small = modelloader.OBJLoader(cache_dir=cache_dir)
+            small.load_path(path)
+            self.assertIsNone(small.get_obj("quad")._mapping) #Read to memory
+
+            with mock.patch.object(modelloader, "CACHE_MMAP_THRESHOLD", 0):
+                mapped = modelloader.OBJLoader(cache_dir=cache_dir)
+                mapped.load_path(path)
+            obj = mapped.get_obj("quad")
+            mapping = obj._mapping
+            self.assertFalse(mapping.closed)
+            self.assertEqual(list(obj.resolve(material="red")), expected)
+            obj.invalidate()
+            self.assertTrue(mapping.closed)
+            self.assertEqual(list(obj.resolve(material="red")), expected)
+            self.assertEqual(obj.sub_obj["blue"].f, [[0, 0, 0, 2, 2, 0, 3, 3, 0]])
+
+            parsed.materials["red"].loaded_from = None
+            loader = modelloader.OBJLoader()
+            loader.load_packed(parsed.pack(path))
+            self.assertIsNone(loader.materials["red"].loaded_from)
+            self.assertEqual(loader.materials["blue"].loaded_from, str(parsed.materials["blue"].loaded_from))
+
+    def test_corrupt_cache(self):
+        import os
+        import tempfile
+        from qlibs.models.modelloader import OBJLoader
+        with tempfile.TemporaryDirectory() as directory:
+            path = self.write_files(directory)
+            cache_dir = os.path.join(directory, "cache")
+            OBJLoader(cache_dir=cache_dir).load_path(path)
+            cache_path = OBJLoader(cache_dir=cache_dir).cache_path(path)
+            with open(cache_path, "rb") as f:
+                image = f.read()
+            for corrupt in (image[:3], image[:20] + b"{" * (len(image) - 20), image[:-16]):
+                with open(cache_path, "wb") as f:
+                    f.write(corrupt)
+                loader = OBJLoader(cache_dir=cache_dir)
+                loader.load_path(path) #Parsed again
+                self.assertEqual(loader.get_obj("quad").sub_obj["blue"].f, [[0, 0, 0, 2, 2, 0, 3, 3, 0]])
+
+    def test_load_models(self):
+        import os
+        import tempfile
+        from qlibs.models.modelloader import OBJLoader, FORMAT_TEXTURES, check_has_textures
+        from qlibs.resources.resource_manager import load_models
+        with tempfile.TemporaryDirectory() as directory:
+            paths = []
+            for name in ("a", "b"):
+                os.mkdir(os.path.join(directory, name))
+                paths.append(self.write_files(os.path.join(directory, name)))
+            progress = []
+            models = load_models(paths, workers=2, progress=lambda *args: progress.append(args))
+            parsed = OBJLoader()
+            parsed.load_path(paths[0])
+        expected = parsed.get_obj()
+        self.assertEqual([done for done, _, _ in progress], [1, 2])
+        self.assertEqual(sorted(name for _, _, name in progress), sorted(paths))
+        for model in models:
+            self.assertEqual(model.name, "quad")
+            self.assertEqual({key[1:] for key in model.resolved}, {(FORMAT_TEXTURES, check_has_textures, "indexed")}) #Only what renderer uploads
+            self.assertEqual(list(model.resolve(material="red")), list(expected.resolve(material="red")))
+            vertices, indices = model.resolve_indexed(*FORMAT_TEXTURES, filter_by=check_has_textures, material="blue")
+            self.assertIsInstance(vertices, memoryview) #Came from packed image, not resolved again
+            self.assertEqual(list(indices), [0, 1, 2])
+
+    def test_load_models_missing(self):
+        import os
+        import tempfile
+        from qlibs.resources.resource_manager import start_loading_models
+        with tempfile.TemporaryDirectory() as directory:
+            paths = [self.write_files(directory), os.path.join(directory, "missing.obj")]
+            progress = []
+            job = start_loading_models(paths, workers=1, progress=lambda *args: progress.append(args))
+            raised = []
+            while True:
+                try:
+                    if job.poll():
+                        break
+                except FileNotFoundError as e:
+                    raised.append(e)
+                time.sleep(0.01)
+        self.assertEqual(len(raised), 1)
+        self.assertEqual(list(job.errors), [paths[1]])
+        self.assertEqual(sorted(done for done, _, _ in progress), [1, 2])
+        self.assertEqual(job.results[0].name, "quad")
+        self.assertIsNone(job.results[1])
+        self.assertIs(start_loading_models([], workers=1).executor, job.executor) #Pool is reused
+        with self.assertRaises(FileNotFoundError):
+            job.result()
+
+
+def make_grid_text(size, bump=0.0):
+    """OBJ text of *size* by *size* grid of quads, with vertex and texture coordinate indices equal"""
+    import math
+    lines = ["o grid", "usemtl plain"]
+    for y in range(size + 1):
+        for x in range(size + 1):
+            lines.append(f"v {x} {y} {bump * math.sin(x * 0.5) * math.cos(y * 0.5)}")
+            lines.append(f"vt {x / size} {y / size}")
+    lines.append("vn 0 0 1")
+    for y in range(size):
+        for x in range(size):
+            i = y * (size + 1) + x + 1
+            lines.append(f"f {i}/{i}/1 {i + 1}/{i + 1}/1 {i + size + 2}/{i + size + 2}/1 {i + size + 1}/{i + size + 1}/1")
+    return "\n".join(lines) + "\n"
+
+
+class LODTestCase(unittest.TestCase):
+    def load_grid(self, size, bump=0.0):
+        import io
+        from qlibs.models.modelloader import OBJLoader
+        loader = OBJLoader()
+        loader.load_file(io.StringIO(make_grid_text(size, bump)))
+        return loader.get_obj()
+
+    def projected_area(self, obj, faces):
+        area = 0
+        for face in faces:
+            (x0, y0, _), (x1, y1, _), (x2, y2, _) = (obj.v[face[k]] for k in (0, 3, 6))
+            area += ((x1 - x0) * (y2 - y0) - (y1 - y0) * (x2 - x0)) / 2
+        return area
+
+    def test_simplify_plane(self):
+        from qlibs.models.lod import simplify
+        obj = self.load_grid(12)
+        faces, error = simplify(obj, ratio=0.1)
+        faces = faces["plain"]
+        self.assertLessEqual(len(faces), 28)
+        self.assertAlmostEqual(error, 0)
+        self.assertAlmostEqual(self.projected_area(obj, faces), 144) #Borders stay, nothing is turned over
+        for face in faces:
+            self.assertEqual([face[k] for k in (0, 3, 6)], [face[k] for k in (1, 4, 7)])
+
+    def test_simplify_error(self):
+        from qlibs.models.lod import simplify
+        obj = self.load_grid(12, bump=1)
+        results = [simplify(obj, ratio=ratio) for ratio in (0.5, 0.25, 0.05)]
+        self.assertEqual([len(faces["plain"]) for faces, _ in results], [144, 72, 14])
+        errors = [error for _, error in results]
+        self.assertEqual(errors, sorted(errors))
+        self.assertGreater(errors[-1], 0)
+        limited, error = simplify(obj, ratio=0, max_error=errors[0])
+        self.assertLessEqual(error, errors[0])
+        self.assertGreater(len(limited["plain"]), 14)
+
+    def test_make_lods_cache(self):
+        import os
+        import tempfile
+        from unittest import mock
+        from qlibs.models.modelloader import OBJLoader
+        from qlibs.models import lod
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "grid.obj")
+            with open(path, "w") as f:
+                f.write(make_grid_text(8, bump=0.5))
+            loader = OBJLoader()
+            loader.load_path(path)
+            obj = loader.get_obj()
+            levels = lod.make_lods(obj, ratios=(0.5, 0.25), path=path)
+            self.assertEqual([len(level.sub_obj["plain"].f) for level in levels], [64, 32])
+            self.assertTrue(os.path.exists(lod.lod_cache_path(path, "grid")))
+            self.assertIs(levels[0].v, obj.v)
+            with mock.patch.object(lod, "simplify", side_effect=AssertionError("Not cached")):
+                cached = lod.make_lods(obj, ratios=(0.5, 0.25), path=path)
+            self.assertEqual([level.sub_obj["plain"].f for level in cached], [level.sub_obj["plain"].f for level in levels])
+            self.assertEqual(len(lod.make_lods(obj, ratios=(0.5,), path=path)), 1) #Other ratios are made again
+
+            with open(lod.lod_cache_path(path, "grid"), "wb") as f:
+                f.write(b"QL")
+            self.assertEqual(len(lod.make_lods(obj, ratios=(0.5,), path=path)), 1) #Corrupt cache is made again
+
+    def test_lod_cache_path(self):
+        from qlibs.models.lod import lod_cache_path
+        self.assertEqual(lod_cache_path("m.obj", "tree_1"), "m.obj.tree_1.lod")
+        self.assertEqual(lod_cache_path("m.obj", None), "m.obj.lod")
+        name = lod_cache_path("m.obj", "../a/b c")[len("m.obj."):-len(".lod")]
+        self.assertRegex(name, "^[0-9a-f]+$")
+
+    def test_select_lod(self):
+        from qlibs.models.lod import projected_size, select_lod, bounding_sphere
+        center, radius = bounding_sphere(self.load_grid(2))
+        self.assertEqual(center, (1, 1, 0))
+        self.assertAlmostEqual(radius, 2 ** 0.5)
+        p = Matrix4.perspective_projection(90, 1, 0.1, 100)
+        v = Matrix4.look_at(IVec(0, 0, 10), IVec(0, 0, 0), IVec(0, 1, 0))
+        self.assertAlmostEqual(projected_size((0, 0, 0), 1, Matrix4(IDENTITY), v, p), 0.1)
+        self.assertAlmostEqual(projected_size((0, 0, 0), 1, Matrix4.scale_matrix(2), v, p), 0.2)
+        self.assertEqual(projected_size((0, 0, 20), 1, Matrix4(IDENTITY), v, p), float("inf"))
+        self.assertEqual([select_lod(size, (0.5, 0.25, 0.1)) for size in (1, 0.5, 0.3, 0.2, 0.01)], [0, 0, 1, 2, 3])
+
+
 class ByteBufferTestCase(unittest.TestCase):
     def test_init_none(self):
         bb = ByteBuffer()
@@ -156,8 +654,939 @@ class ByteBufferTestCase(unittest.TestCase):
         self.assertTrue(bb.has_values())
         self.assertEqual("c", bb.read(1))
         self.assertFalse(bb.has_values())
+
+    def test_bytes(self):
+        bb = ByteBuffer(join_with=b"")
+        bb.write(b"hello")
+        bb.write(b" world")
+        self.assertEqual(len(bb), 11)
+        self.assertEqual(bb.peek(5), b"hello")
+        self.assertEqual(bb.read(6), b"hello ")
+        bb.skip(1)
+        target = bytearray(8)
+        self.assertEqual(bb.readinto(target), 4)
+        self.assertEqual(target[:4], b"orld")
+        self.assertFalse(bb.has_values())
+        with self.assertRaises(ValueError):
+            bb.read(1)
+
+    def test_bytes_peek_survives_write(self):
+        bb = ByteBuffer(b"abc", join_with=b"")
+        view = bb.peek(3)
+        bb.read(2)
+        bb.write(b"d" * 100)
+        self.assertEqual(view, b"abc")
+        view.release()
+        self.assertEqual(bb.read(3), b"cdd")
+        self.assertEqual(len(bb), 98)
         
 
+class FramingTestCase(unittest.TestCase):
+    def test_framer_split(self):
+        packets = [b"", b"a", bytes(range(127)), bytes(128), bytes(20000)]
+        data = b"".join(bytes_packet_sender(p) for p in packets)
+        for step in (1, 2, 7, 129, len(data)):
+            framer = BytesPacketFramer()
+            res = []
+            for i in range(0, len(data), step):
+                res.extend(framer.feed(data[i:i+step]))
+            self.assertEqual(res, packets)
+            self.assertEqual(len(framer.buff), 0)
+
+    def test_packet_socket(self):
+        a, b = socketpair()
+        try:
+            sock = PacketSocket(b, BytesPacketFramer)
+            a.sendall(bytes_packet_sender(b"hello") + bytes_packet_sender(b"world")[:3])
+            self.assertEqual(sock.recv(), [b"hello"])
+            a.sendall(bytes_packet_sender(b"world")[3:])
+            self.assertEqual(sock.recv(), [b"world"])
+        finally:
+            a.close()
+            b.close()
+
+
+    def test_packet_views(self):
+        a, b = socketpair()
+        try:
+            sock = PacketSocket(b, BytesPacketFramer, copy=False)
+            a.sendall(bytes_packet_sender(b"hello") + bytes_packet_sender(b"world")[:3])
+            packets = sock.recv()
+            self.assertIsInstance(packets[0], memoryview)
+            self.assertEqual(bytes(packets[0]), b"hello")
+            a.sendall(bytes_packet_sender(b"world")[3:] + bytes_packet_sender(b"!"))
+            self.assertEqual([bytes(p) for p in sock.recv()], [b"world", b"!"])
+            self.assertIsNot(sock.recv(), sock.recv()) #Lists aren't reused
+            a.sendall(bytes_packet_sender(b"copied"))
+            self.assertEqual(sock.recv(copy=True), [b"copied"])
+        finally:
+            a.close()
+            b.close()
+
+    def test_udp_recv_many(self):
+        import socket
+        from qlibs.net.asyncsocket import AsyncUDPSocket
+        a = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        b = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            b.bind(("127.0.0.1", 0))
+            sock = AsyncUDPSocket(b)
+            self.assertEqual(sock.recv_many(), [])
+            for i in range(5):
+                a.sendto(bytes([i]) * (i + 1), b.getsockname())
+            received = []
+            for _ in range(100):
+                received.extend(bytes(data) for data, _ in sock.recv_many(max_packets=2))
+                if len(received) == 5:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(received, [bytes([i]) * (i + 1) for i in range(5)])
+        finally:
+            a.close()
+            b.close()
+
+
+    def test_write_interest(self):
+        from qlibs.net.asyncsocket import ServerSelector
+        a, b = socketpair()
+        try:
+            selector = ServerSelector(None, None, lambda sock: sock.recv())
+            sock = PacketSocket(b, BytesPacketFramer)
+            selector.register(sock)
+            self.assertEqual(selector.writing, set())
+            start = time.monotonic()
+            selector.select(0.05)
+            self.assertGreater(time.monotonic() - start, 0.04) #Writable socket doesn't wake it up
+            sock.send(bytes(4 * 1024 * 1024)) #More than socket buffer
+            self.assertEqual(selector.writing, {b.fileno()})
+            a.setblocking(False)
+            while selector.writing:
+                try:
+                    while a.recv(65536):
+                        pass
+                except BlockingIOError:
+                    pass
+                selector.select(0.1)
+            self.assertTrue(sock.empty())
+            selector.unregister(sock)
+        finally:
+            a.close()
+            b.close()
+
+
+class ReliableUDPTestCase(unittest.TestCase):
+    def make_pair(self, drop=None):
+        import socket
+        from qlibs.net.asyncsocket import AsyncUDPSocket, ReliableUDPSocket
+        class LossySocket(AsyncUDPSocket):
+            sent = 0
+            def sendto_buff(self, data, adress):
+                self.sent += 1
+                if drop is not None and drop(self.sent):
+                    return 0
+                return super().sendto_buff(data, adress)
+        socks = []
+        for _ in range(2):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(("127.0.0.1", 0))
+            self.addCleanup(sock.close)
+            socks.append(ReliableUDPSocket(LossySocket(sock)))
+        return socks[0], socks[1], socks[1].socket.socket.getsockname(), socks[0].socket.socket.getsockname()
+
+    def exchange(self, a, b, until, rounds=200):
+        got = []
+        for _ in range(rounds):
+            got.extend(data for data, _ in b.recv())
+            a.recv()
+            a.update()
+            b.update()
+            if until(got):
+                break
+            time.sleep(0.005)
+        return got
+
+    def test_resend_window(self):
+        a, b, b_adress, _ = self.make_pair(drop=lambda n: True)
+        a.min_resend_delay = a.max_resend_delay = 0
+        a.send_reliable(b"lost", b_adress)
+        for _ in range(100):
+            a.update()
+        peer = a.peers[b_adress]
+        message, = peer.unacked.values()
+        self.assertEqual(len(message[3]), a.ACK_WINDOW)
+        self.assertEqual(sorted(peer.in_flight), sorted(message[3]))
+
+    def test_udp_sendto_buff(self):
+        import socket
+        from qlibs.net.asyncsocket import AsyncUDPSocket
+        a, b = AsyncUDPSocket(socket.socket(socket.AF_INET, socket.SOCK_DGRAM)), socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            b.bind(("127.0.0.1", 0))
+            self.assertEqual(a.sendto_buff(b"data", b.getsockname()), 1)
+            self.assertTrue(a.empty())
+            self.assertEqual(b.recv(16), b"data")
+        finally:
+            a.close()
+            b.close()
+
+    def test_ordered_with_loss(self):
+        a, b, to_b, _ = self.make_pair(drop=lambda n: n % 3 == 0)
+        a.min_resend_delay = 0.01
+        a.max_resend_delay = 0.04
+        messages = [b"%d" % i for i in range(30)]
+        for message in messages:
+            a.send_reliable(message, to_b)
+        got = self.exchange(a, b, lambda got: len(got) >= len(messages))
+        self.assertEqual(got, messages)
+        self.exchange(a, b, lambda got: not a.peers[to_b].unacked)
+        self.assertEqual(a.peers[to_b].unacked, dict())
+        self.assertEqual(a.next_timeout(), None)
+
+    def test_unordered_and_unreliable(self):
+        a, b, to_b, to_a = self.make_pair()
+        a.send_reliable(b"r", to_b, ordered=False)
+        a.send_unreliable(b"u", to_b)
+        got = self.exchange(a, b, lambda got: len(got) >= 2)
+        self.assertEqual(sorted(got), [b"r", b"u"])
+        self.exchange(a, b, lambda got: not a.peers[to_b].unacked)
+        self.assertEqual(a.peers[to_b].unacked, dict())
+        b.send_unreliable(b"back", to_a)
+        self.assertEqual(self.exchange(b, a, lambda got: got), [b"back"])
+
+    def test_selector(self):
+        from qlibs.net.asyncsocket import ServerSelector
+        a, b, to_b, _ = self.make_pair()
+        got = []
+        selector = ServerSelector(None, None, lambda sock: got.extend(sock.recv()))
+        selector.register(b)
+        a.send_reliable(b"hello", to_b)
+        selector.select(1)
+        self.assertEqual(got, [(b"hello", a.socket.socket.getsockname())])
+        selector.unregister(b)
+
+    def test_selector_timers(self):
+        from qlibs.net.asyncsocket import ServerSelector
+        a, b, to_b, _ = self.make_pair(drop=lambda n: n == 1)
+        a.min_resend_delay = a.max_resend_delay = 0.02
+        got = []
+        selector = ServerSelector(None, lambda sock: self.fail("Not a reader"), None)
+        selector.register(a, on_read=lambda sock: sock.recv())
+        selector.register(b, on_read=lambda sock: got.extend(sock.recv()))
+        a.send_reliable(b"lost once", to_b)
+        start = time.monotonic()
+        while not got and time.monotonic() - start < 2:
+            selector.select(1) #Returns when resend is due, then resends
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertEqual([data for data, _ in got], [b"lost once"])
+        for _ in range(10):
+            if not a.peers[to_b].unacked:
+                break
+            selector.select(0.05)
+        self.assertEqual(a.peers[to_b].unacked, dict())
+        selector.unregister(a)
+        selector.unregister(b)
+        self.assertEqual((selector.timers, selector.readers), (set(), dict()))
+
+    def test_multiplexer_udp(self):
+        import socket
+        from qlibs.net.asyncsocket import ReliableUDPSocket
+        from qlibs.net.multiplexer import MultiplexServer, base_struct
+        server = MultiplexServer("127.0.0.1", 0)
+        udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp_sock.bind(("127.0.0.1", 0))
+        udp = ReliableUDPSocket(udp_sock)
+        got = []
+        server.socket_selector.register(udp, on_read=lambda sock: got.extend(sock.recv()))
+        client = socket.create_connection(server.socket_selector.sock.socket.getsockname())
+        sender_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sender_sock.bind(("127.0.0.1", 0))
+        sender = ReliableUDPSocket(sender_sock)
+        try:
+            client.send(bytes_packet_sender(base_struct.pack(2, 0, 0, 0) + b"tcp"))
+            sender.send_unreliable(b"position", udp_sock.getsockname())
+            for _ in range(20):
+                server.socket_selector.select(0.05)
+                if got and len(server.passed_frames) >= 2: #Joined and payload
+                    break
+            self.assertEqual([data for data, _ in got], [b"position"])
+            self.assertEqual(server.players, 1) #UDP socket isn't a player
+            self.assertEqual([type(conn) for conn in server._connections()], [PacketSocket])
+        finally:
+            client.close()
+            sender.close()
+            udp.close()
+            server.socket_selector.sock.close()
+
+
+class QPacketTestCase(unittest.TestCase):
+    def test_tagged(self):
+        values = [1, -300, 0.5, "abc", b"def", None, [1, (2, 3)], array("f", [1.5, 2.5]), array("l", [-1, 2**40])]
+        data = b"".join(qpacket.convert(v) for v in values)
+        self.assertEqual(list(qpacket.decode(data)), values)
+
+    def test_schema_fixed(self):
+        schema = qpacket.Schema(1, [("x", "f32"), ("y", "f32"), ("id", "i32")])
+        data = schema.pack((1.5, -2.0, 7))
+        self.assertEqual(len(data), 12)
+        self.assertEqual(schema.unpack(data), (1.5, -2.0, 7))
+        with self.assertRaises(ValueError):
+            schema.pack((1.5, 2))
+
+    def test_schema_mixed(self):
+        schema = qpacket.Schema(2, [("n", "varint"), ("name", "str"), ("pos", "f64[]"), ("a", "u8"), ("b", "u16"), ("raw", "bytes")])
+        record = (-12345, "player", [1.0, 2.0, 3.0], 5, 600, b"\x00\x01")
+        res = schema.unpack(schema.pack(record))
+        self.assertEqual(res[:2], record[:2])
+        self.assertEqual(list(res[2]), record[2])
+        self.assertEqual(res[3:], record[3:])
+
+    def test_register_schema(self):
+        class Point:
+            def __init__(self, x, y):
+                self.x = x
+                self.y = y
+        qpacket.register_schema(900, [("x", "i16"), ("y", "i16")], Point)
+        with self.assertRaises(ValueError):
+            qpacket.register_schema(900, [("x", "i16")])
+        data = qpacket.convert([Point(1, -2), "tagged", Point(3, 4)])
+        decoded = next(qpacket.decode(data))
+        self.assertEqual([(p.x, p.y) for p in decoded[::2]], [(1, -2), (3, 4)])
+        self.assertEqual(decoded[1], "tagged")
+
+
+class StreamDecoderTestCase(unittest.TestCase):
+    def test_partial(self):
+        values = [1, "abc", [1.5, (2, None)], array("i", range(100)), b"x" * 300]
+        data = b"".join(qpacket.convert(v) for v in values)
+        for step in (1, 3, 64, len(data)):
+            dec = qpacket.StreamDecoder()
+            res = []
+            for i in range(0, len(data), step):
+                dec.feed(data[i:i+step])
+                res.extend(dec)
+            self.assertEqual(res, values)
+            self.assertEqual(dec.pending, b"")
+
+    def test_needed(self):
+        data = qpacket.convert(b"x" * 100)
+        dec = qpacket.StreamDecoder(data[:10])
+        self.assertFalse(dec.has_values())
+        self.assertEqual(dec.needed, len(data))
+        self.assertEqual(dec.feed(data[10:]), 1)
+        self.assertEqual(dec.get_value(), b"x" * 100)
+        with self.assertRaises(ValueError):
+            dec.get_value()
+
+    def test_large_value_chunks(self):
+        from unittest import mock
+        value = [list(range(50)), "x" * 3000, array("d", range(500))] * 100 + list(range(20000))
+        data = qpacket.convert(value)
+        chunks = range(0, len(data), 512)
+        scanned = mock.Mock(wraps=qpacket._skip_header)
+        dec = qpacket.StreamDecoder()
+        with mock.patch.object(qpacket, "_skip_header", scanned):
+            for i in chunks:
+                dec.feed(data[i:i + 512])
+        self.assertEqual(dec.get_value(), value)
+        #Every nested value is scanned once, plus one retry per chunk
+        self.assertLessEqual(scanned.call_count, 1 + 300 + 100 * 50 + 20000 + len(chunks))
+
+    def test_decode_into(self):
+        dec = qpacket.StreamDecoder(b"".join(qpacket.convert(i) for i in range(5)))
+        target = [None] * 4
+        self.assertEqual(dec.decode_into(target, 1), 3)
+        self.assertEqual(target, [None, 0, 1, 2])
+        self.assertEqual(dec.decode_into(target), 2)
+        self.assertEqual(target[:2], [3, 4])
+
+    def test_rw_convertable(self):
+        from qlibs.net.connection import RWConvertable
+        a, b = socketpair()
+        try:
+            rw = RWConvertable(b)
+            a.setblocking(True)
+            writer = RWConvertable(a)
+            writer.write(["hello", 1])
+            writer.write("world")
+            data = b"".join(writer.packets)
+            a.sendall(data[:7])
+            rw.recv_data()
+            self.assertIsNone(rw.read())
+            a.sendall(data[7:])
+            rw.recv_data()
+            self.assertEqual(rw.read(), (True, ["hello", 1]))
+            self.assertEqual(rw.read(), (True, "world"))
+        finally:
+            a.close()
+            b.close()
+
+
+class ConnectionPoolTestCase(unittest.TestCase):
+    def start_echo_server(self):
+        import socket
+        import threading
+        from qlibs.net.connection import AdvRW
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen()
+        self.addCleanup(listener.close)
+        def serve(conn):
+            rw = AdvRW(conn)
+            try:
+                while True:
+                    rw.write(rw.read())
+                    rw.send_rep()
+            except (ConnectionError, OSError):
+                conn.close()
+        def accept():
+            while True:
+                try:
+                    conn, _ = listener.accept()
+                except OSError:
+                    return
+                threading.Thread(target=serve, args=(conn,), daemon=True).start()
+        threading.Thread(target=accept, daemon=True).start()
+        return listener.getsockname()
+
+    def test_adv_rw_long_packets(self):
+        import threading
+        from qlibs.net.connection import AdvRW
+        a, b = socketpair()
+        try:
+            writer, reader = AdvRW(a), AdvRW(b)
+            big = bytes(range(256)) * 4000
+            writer.write(b"x")
+            writer.write(big)
+            thread = threading.Thread(target=writer.send_rep, kwargs={"attemps": 1000})
+            thread.start()
+            self.assertEqual(reader.read(), b"x")
+            self.assertEqual(reader.read(), big)
+            thread.join()
+        finally:
+            a.close()
+            b.close()
+
+    def test_out_of_order(self):
+        from qlibs.net.connection import AdvRW, PipelinedConnection
+        a, b = socketpair()
+        try:
+            conn = PipelinedConnection(a, convert=True)
+            first = conn.request(["first", 1])
+            second = conn.request("second")
+            conn.flush()
+            server = AdvRW(b)
+            packets = [server.read(), server.read()]
+            server.write(packets[1])
+            server.write(packets[0])
+            server.send_rep()
+            self.assertEqual(conn.get(second), "second")
+            self.assertEqual(conn.get(first), ["first", 1])
+            self.assertEqual(conn.outstanding, set())
+        finally:
+            a.close()
+            b.close()
+
+    def test_pool(self):
+        from qlibs.net.connection import ConnectionPool
+        endpoint = self.start_echo_server()
+        pool = ConnectionPool(size=3)
+        try:
+            requests = [b"%d" % i * (i + 1) for i in range(50)]
+            self.assertEqual(pool.request_many(endpoint, requests), requests)
+            self.assertEqual(len(pool.connections[endpoint]), 3)
+            self.assertEqual(pool.request(endpoint, b"one").result(), b"one")
+        finally:
+            pool.close()
+
+    def test_async_pool(self):
+        import asyncio
+        from qlibs.net.connection import AsyncConnectionPool, AsyncAdvRW
+        async def echo(reader, writer):
+            rw = AsyncAdvRW(None)
+            rw.reader, rw.writer = reader, writer
+            try:
+                while True:
+                    rw.write(await rw.read())
+            except asyncio.IncompleteReadError:
+                writer.close()
+        async def run():
+            server = await asyncio.start_server(echo, "127.0.0.1", 0)
+            endpoint = server.sockets[0].getsockname()
+            pool = AsyncConnectionPool(size=2, convert=True)
+            requests = [["request", i] for i in range(20)]
+            self.assertEqual(await pool.request_many(endpoint, requests), requests)
+            self.assertEqual(len(pool.connections[endpoint]), 2)
+            await pool.close()
+            server.close()
+            await server.wait_closed()
+        asyncio.run(run())
+
+
+class MultiplexServerTestCase(unittest.TestCase):
+    class Conn:
+        def __init__(self):
+            self.framer = BytesPacketFramer()
+            self.packets = []
+
+        def send(self, data):
+            self.packets.extend(self.framer.feed(data))
+
+        def send_many(self, buffers):
+            for data in buffers:
+                self.send(data)
+
+        def types(self):
+            from qlibs.net.multiplexer import base_struct
+            return [base_struct.unpack(p[:base_struct.size])[0] for p in self.packets]
+
+    def make_server(self, engine_packer=None):
+        from qlibs.net.multiplexer import MultiplexServerBase
+        class Server(MultiplexServerBase):
+            conns = []
+            def _connections(self):
+                return self.conns
+        return Server(engine_packer)
+
+    def add(self, server):
+        conn = self.Conn()
+        player_id = server._add_player(conn)
+        server.conns.append(conn)
+        return player_id, conn
+
+    def test_streaming(self):
+        from qlibs.net.multiplexer import base_struct
+        server = self.make_server()
+        id_a, a = self.add(server)
+        self.assertEqual(a.types(), [0]) #Catch-up is sent after first packet
+        server._on_packet(id_a, base_struct.pack(2, 0, 0, 0) + b"data")
+        server._flush()
+        self.assertEqual(a.types(), [0, 3, 2]) #Sent before step is done
+        server._on_packet(id_a, base_struct.pack(1, 0, 0, 0))
+        self.assertEqual(a.types(), [0, 3, 2, 1])
+        id_b, b = self.add(server)
+        server._on_packet(id_b, base_struct.pack(2, 0, 0, 0) + b"data")
+        self.assertEqual(b.types(), [0, 3, 2, 1, 3])
+        server._flush()
+        self.assertEqual(a.types(), [0, 3, 2, 1, 3, 2])
+        self.assertEqual(b.types(), [0, 3, 2, 1, 3, 2])
+
+    def test_passed_frames_bounded(self):
+        from qlibs.net.multiplexer import base_struct
+        server = self.make_server(lambda: b"state")
+        server.max_passed_frames = 8
+        id_a, a = self.add(server)
+        for _ in range(20):
+            server._on_packet(id_a, base_struct.pack(2, 0, 0, 0) + b"data")
+            server._on_packet(id_a, base_struct.pack(1, 0, 0, 0))
+            self.assertLessEqual(len(server.passed_frames), 8)
+        id_b, b = self.add(server)
+        server._on_packet(id_b, base_struct.pack(2, 0, 0, 0) + b"data")
+        self.assertEqual(b.types()[:2], [0, 5])
+        self.assertLessEqual(len(b.packets), 10)
+
+    def test_passed_frames_overflow(self):
+        from qlibs.net.multiplexer import base_struct
+        #Frames after the latest keyframe aren't dropped, even within one long step
+        server = self.make_server(lambda: b"state")
+        server.max_passed_frames = 4
+        server.pack_delay = -1
+        id_a, a = self.add(server)
+        server._on_packet(id_a, base_struct.pack(1, 0, 0, 0))
+        for i in range(10):
+            server._on_packet(id_a, base_struct.pack(2, 0, 0, 0) + b"%d" % i)
+        id_b, b = self.add(server)
+        server._on_packet(id_b, base_struct.pack(2, 0, 0, 0) + b"late")
+        self.assertEqual(b.types()[:2], [0, 5])
+        payloads = [p[base_struct.size:] for p in b.packets[2:] if base_struct.unpack_from(p)[0] == 2]
+        self.assertEqual(payloads[:10], [b"%d" % i for i in range(10)])
+        server._on_packet(id_a, base_struct.pack(1, 0, 0, 0))
+        server._on_packet(id_b, base_struct.pack(1, 0, 0, 0))
+        self.assertEqual(len(server.passed_frames), 0) #New keyframe
+        #Without engine_packer every dropped frame is reported
+        server = self.make_server()
+        server.max_passed_frames = 4
+        id_a, a = self.add(server)
+        with self.assertLogs("qlibs.net.multiplexer", "WARNING") as logs:
+            for i in range(10):
+                server._on_packet(id_a, base_struct.pack(2, 0, 0, 0) + b"%d" % i)
+        self.assertEqual(len(logs.output), 7)
+        self.assertEqual(len(server.passed_frames), 4)
+
+    def test_snapshot_diff(self):
+        from qlibs.net.multiplexer import snapshot_diff, apply_snapshot_diff
+        old = bytes(range(256)) * 10
+        for new in (old, old[:1000], old + b"tail", old[:300] + b"x" + old[301:], b""):
+            diff = snapshot_diff(old, new, block=16)
+            self.assertEqual(apply_snapshot_diff(old, diff), new)
+        self.assertLess(len(snapshot_diff(old, old[:300] + b"x" + old[301:], block=16)), 40)
+
+    def test_keyframes_resume(self):
+        from qlibs.net.multiplexer import base_struct, MultiplexClientBase
+        state = [b"a" * 1000]
+        server = self.make_server(lambda: state[0])
+        server.pack_delay = -1
+        id_a, a = self.add(server)
+        server._on_packet(id_a, base_struct.pack(1, 0, 0, 0))
+        self.assertEqual((server.step, server.state_step), (1, 1))
+
+        class Engine:
+            def step(self, delta, events):
+                pass
+        client = MultiplexClientBase(Engine(), lambda data: Engine())
+        id_b, b = self.add(server)
+        server._on_packet(id_b, base_struct.pack(1, 0, 0, 0)) #Not a resume, gets full keyframe
+        for packet in b.packets:
+            client._on_packet(packet)
+        self.assertEqual((client.snapshot_step, client.snapshot), (1, b"a" * 1000))
+
+        state[0] = b"a" * 999 + b"b"
+        server._on_packet(id_a, base_struct.pack(1, 0, 0, 0))
+        self.assertEqual(server.state_step, 2)
+        resumed = MultiplexClientBase(Engine(), lambda data: Engine(), resume=(client.snapshot_step, client.snapshot))
+        resumed.compact_events = False
+        id_c, c = self.add(server)
+        for packet in BytesPacketFramer().feed(resumed._initial_packets()):
+            server._on_packet(id_c, packet)
+        for packet in c.packets:
+            resumed._on_packet(packet)
+        self.assertEqual(c.types()[:2], [0, 6])
+        self.assertLess(len(c.packets[1]), 200)
+        self.assertEqual((resumed.snapshot_step, resumed.snapshot), (2, state[0]))
+        self.assertEqual(resumed.step_number, server.step)
+
+    def test_compact_events(self):
+        from qlibs.net.multiplexer import base_struct, MultiplexClientBase, COMPACT_BATCH, COMPACT_BATCH_ZLIB
+        server = self.make_server(lambda: b"s" * 4000)
+        server.pack_delay = -1
+        id_a, a = self.add(server)
+        server._on_packet(id_a, base_struct.pack(1, 0, 0, 0))
+
+        class Engine:
+            def __init__(self):
+                self.steps = []
+            def step(self, delta, events):
+                self.steps.append([event.name for event in events])
+        client = MultiplexClientBase(Engine(), lambda data: Engine())
+        id_b, b = self.add(server)
+        for packet in BytesPacketFramer().feed(client._initial_packets()):
+            server._on_packet(id_b, packet)
+        self.assertEqual(b.types(), [0]) #Options alone don't trigger catch-up
+        server._on_packet(id_b, base_struct.pack(2, 0, 0, 0) + b"x" * 100)
+        server._on_packet(id_a, base_struct.pack(2, 0, 0, 0) + b"y")
+        server._flush()
+        self.assertEqual(len(b.packets), 3) #Hello, switch to compact and catch-up batch
+        self.assertEqual(b.packets[2][0], COMPACT_BATCH_ZLIB) #Keyframe compresses well
+        server._on_packet(id_a, base_struct.pack(1, 0, 0, 0))
+        server._on_packet(id_b, base_struct.pack(1, 0, 0, 0))
+        self.assertEqual(len(b.packets), 4)
+        self.assertEqual(b.packets[3][0], COMPACT_BATCH)
+        for packet in b.packets:
+            client._on_packet(packet)
+        self.assertTrue(client.compact)
+        self.assertEqual(client.snapshot, b"s" * 4000)
+        self.assertEqual(client.engine.steps, [["playerjoined", "payload", "payload"]])
+        self.assertEqual(client.step_number, server.step)
+        self.assertEqual(a.types()[-4:], [3, 2, 2, 1]) #Legacy player got the same events
+        self.assertLess(len(b.packets[3]), sum(map(len, a.packets[-4:])))
+
+    def test_compact_timedelta(self):
+        from qlibs.net.multiplexer import ReadyEvent, convert_event_compact, iter_compact_events
+        events = list(iter_compact_events(convert_event_compact(ReadyEvent(0.1))))
+        self.assertEqual(events, [(1, 0, 0, 0.1, b"")]) #Not narrowed, legacy frames carry doubles too
+
+    def test_recording(self):
+        import io
+        from qlibs.net.multiplexer import base_struct, MultiplexClientBase, MultiplexReplayer
+        from qlibs.net.recording import read_recording
+
+        class Engine:
+            def __init__(self, data=None):
+                self.data = data
+                self.steps = []
+            def step(self, delta, events):
+                self.steps.append([event.name for event in events])
+        server = self.make_server(lambda: b"state")
+        server.pack_delay = -1
+        id_a, a = self.add(server)
+        server._on_packet(id_a, base_struct.pack(1, 0, 0, 0))
+        server_file = io.BytesIO()
+        server.start_recording(server_file)
+        client_file = io.BytesIO()
+        client = MultiplexClientBase(Engine(), Engine, record=client_file)
+        id_b, b = self.add(server)
+        for packet in BytesPacketFramer().feed(client._initial_packets()):
+            server._on_packet(id_b, packet)
+        for _ in range(3):
+            server._on_packet(id_a, base_struct.pack(2, 0, 0, 0) + b"data")
+            server._on_packet(id_b, base_struct.pack(1, 0, 0, 0))
+            server._on_packet(id_a, base_struct.pack(1, 0, 0, 0))
+        for packet in b.packets:
+            client._on_packet(packet)
+
+        times = [at for at, _ in read_recording(io.BytesIO(client_file.getvalue()))]
+        self.assertEqual(len(times), len(b.packets))
+        self.assertEqual(times, sorted(times))
+        for recording in (server_file, client_file):
+            replayer = MultiplexReplayer(Engine(), Engine)
+            steps, _ = replayer.replay(io.BytesIO(recording.getvalue()))
+            self.assertEqual(steps, 3)
+            self.assertEqual(replayer.engine.data, b"state")
+            self.assertEqual(replayer.engine.steps, client.engine.steps)
+
+    def test_pack_in_thread(self):
+        from qlibs.net.multiplexer import base_struct
+        server = self.make_server(lambda: b"state")
+        server.pack_delay = -1
+        server.pack_in_thread = True
+        id_a, a = self.add(server)
+        server._on_packet(id_a, base_struct.pack(1, 0, 0, 0))
+        if server._pack_future is not None:
+            server._pack_future.result()
+        server._flush()
+        self.assertEqual((server.state, server.state_step), (b"state", 1))
+
+    def test_client_pacing(self):
+        from qlibs.net.multiplexer import base_struct, MultiplexClientBase
+        class Engine:
+            def step(self, delta, events):
+                pass
+        client = MultiplexClientBase(Engine())
+        client.min_step_time = 0.01
+        client.max_step_time = 0.1
+        client._on_packet(base_struct.pack(0, 0, 0, 0))
+        self.assertEqual(client.step_interval, 0.01)
+        for latency in (0.05, 1.0):
+            for _ in range(50):
+                client._ready_packet()
+                client.last_step -= latency
+                client._on_packet(base_struct.pack(1, 0, 0, 0))
+            self.assertAlmostEqual(client.step_interval, min(latency, 0.1), places=2)
+        metrics = client.metrics.snapshot()
+        self.assertEqual(metrics["steps"], 100)
+        self.assertAlmostEqual(metrics["latency_p50"], 1.0, places=2)
+        self.assertAlmostEqual(metrics["latency_p95"], 1.0, places=2)
+        self.assertEqual(metrics["bytes_out"], 100 * (base_struct.size + 1))
+        self.assertEqual(metrics["bytes_in"], 101 * base_struct.size)
+        self.assertGreater(metrics["stalled_time"], 0)
+
+    def test_client_pacing_backs_off(self):
+        from qlibs.net.multiplexer import base_struct, MultiplexClientBase
+        class Engine:
+            def step(self, delta, events):
+                pass
+        client = MultiplexClientBase(Engine())
+        client._on_packet(base_struct.pack(0, 0, 0, 0))
+        def run(latencies):
+            for latency in latencies:
+                client._ready_packet()
+                client.last_step -= latency
+                client._on_packet(base_struct.pack(1, 0, 0, 0))
+            return client.step_interval
+        #Default floor doesn't hide fast round trips
+        self.assertAlmostEqual(run([0.02] * 40), 0.02, places=3)
+        #Every fourth confirmation is held back by a slow player
+        gated = run([0.02, 0.02, 0.02, 0.3] * 10)
+        self.assertGreater(gated, client._smoothed_rtt + 0.05)
+        self.assertGreater(client.metrics.snapshot()["stall_p95"], 0)
+        #Back off is dropped once stalls leave the window
+        self.assertAlmostEqual(run([0.02] * 60), 0.02, places=2)
+
+    def test_client_catch_up_steps(self):
+        from qlibs.net.multiplexer import base_struct, MultiplexClientBase
+        class Engine:
+            steps = 0
+            def step(self, delta, events):
+                self.steps += 1
+        client = MultiplexClientBase(Engine(), lambda data: Engine())
+        client._on_packet(base_struct.pack(0, 0, 3, 0))
+        client._ready_packet()
+        client._on_packet(base_struct.pack(5, 0, 0, 0) + b"state") #Keyframe from step 0
+        for _ in range(3):
+            client._on_packet(base_struct.pack(1, 0, 0, 0))
+        self.assertEqual(client.engine.steps, 3)
+        self.assertFalse(client.ready_to_step) #Own ready is not answered yet
+        self.assertEqual(client.metrics.snapshot()["steps"], 0)
+        client.last_step -= 0.2
+        client._on_packet(base_struct.pack(1, 0, 0, 0))
+        self.assertTrue(client.ready_to_step)
+        self.assertEqual(client.metrics.snapshot()["steps"], 1)
+        self.assertAlmostEqual(client.metrics.percentile(0.5), 0.2, places=2)
+
+    def test_send_many(self):
+        from qlibs.net.asyncsocket import AsyncSocket
+        a, b = socketpair()
+        try:
+            sock = AsyncSocket(a)
+            sock.send_many([b"abc", bytearray(b"def"), b"g" * 10])
+            while not sock.empty():
+                sock.send()
+            self.assertEqual(b.recv(100), b"abcdef" + b"g" * 10)
+        finally:
+            a.close()
+            b.close()
+
+
+class AsyncMultiplexerTestCase(unittest.TestCase):
+    class Engine:
+        def __init__(self):
+            self.events = []
+            self.steps = 0
+
+        def step(self, delta, events):
+            self.steps += 1
+            self.events.extend(events)
+
+    def test_payload(self):
+        import asyncio
+        from qlibs.net.async_multiplexer import AsyncMultiplexServer, AsyncMultiplexClient
+        from qlibs.net.multiplexer import PayloadEvent
+
+        async def run():
+            server = await AsyncMultiplexServer.start("127.0.0.1", 0)
+            engines = [self.Engine(), self.Engine()]
+            clients = []
+            for engine in engines:
+                client = await AsyncMultiplexClient.connect(engine, host="127.0.0.1", port=server.port)
+                client.min_step_time = 0.001
+                clients.append(client)
+            self.assertEqual([c.player_id for c in clients], [0, 1])
+            clients[0].send_payload(b"hello")
+            for _ in range(500):
+                if all(any(isinstance(e, PayloadEvent) for e in en.events) for en in engines):
+                    break
+                await asyncio.sleep(0.01)
+            for client in clients:
+                client.close()
+            server.close()
+            await server.wait_closed()
+            return engines
+
+        for engine in asyncio.run(run()):
+            payloads = [(e.player_id, e.data) for e in engine.events if isinstance(e, PayloadEvent)]
+            self.assertEqual(payloads, [(0, b"hello")])
+            self.assertGreater(engine.steps, 0)
+
+
+class RoomsTestCase(unittest.TestCase):
+    class Engine:
+        def __init__(self):
+            self.events = []
+            self.steps = 0
+
+        def step(self, delta, events):
+            self.steps += 1
+            self.events.extend(events)
+
+    def run_rooms(self, port):
+        import asyncio
+        from qlibs.net.async_multiplexer import AsyncMultiplexClient
+        from qlibs.net.multiplexer import base_struct
+
+        async def run():
+            #Join packet with room name that isn't utf-8 only drops its own connection
+            bad_reader, bad_writer = await asyncio.open_connection("127.0.0.1", port)
+            bad_writer.write(bytes_packet_sender(base_struct.pack(7, 0, 0, 0) + b"\xff\xfe"))
+            try:
+                self.assertEqual(await asyncio.wait_for(bad_reader.read(), 5), b"")
+            except ConnectionResetError:
+                pass #Closed with unread data
+            bad_writer.close()
+            clients = dict()
+            for name, room in (("a1", "a"), ("a2", "a"), ("b1", "d")):
+                client = await AsyncMultiplexClient.connect(self.Engine(), host="127.0.0.1", port=port, room=room)
+                client.min_step_time = 0.001
+                clients[name] = client
+            clients["a1"].send_payload(b"for a")
+            #Player of room "c" that never gets ready doesn't stall other rooms
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(bytes_packet_sender(base_struct.pack(7, 0, 0, 0) + b"c"))
+            for _ in range(500):
+                if clients["b1"].engine.steps > 5 and all(c.engine.events for c in clients.values()):
+                    break
+                await asyncio.sleep(0.01)
+            for client in clients.values():
+                client.close()
+            writer.close()
+            return clients
+
+        clients = asyncio.run(run())
+        self.assertEqual(clients["a1"].player_id, 0)
+        self.assertEqual(clients["a2"].player_id, 1)
+        self.assertEqual(clients["b1"].player_id, 0)
+        self.assertGreater(clients["b1"].engine.steps, 5)
+        payloads = lambda c: [e.data for e in c.engine.events if e.name == "payload"]
+        self.assertEqual(payloads(clients["a2"]), [b"for a"])
+        self.assertEqual(payloads(clients["b1"]), [])
+
+    def test_room_server(self):
+        from qlibs.net.rooms import MultiplexRoomServer
+        server = MultiplexRoomServer("127.0.0.1", 0)
+        server.serve_in_thread()
+        try:
+            self.run_rooms(server.port)
+        finally:
+            server.stop_thread()
+
+    def test_acceptor(self):
+        import socket
+        if not hasattr(socket, "send_fds"):
+            self.skipTest("No socket passing")
+        from qlibs.net.rooms import MultiplexAcceptor
+        acceptor = MultiplexAcceptor("127.0.0.1", 0, workers=2)
+        self.assertNotEqual(acceptor.worker_of("a"), acceptor.worker_of("d"))
+        acceptor.serve_in_thread()
+        try:
+            self.run_rooms(acceptor.port)
+        finally:
+            acceptor.close()
+
+    def test_first_room(self):
+        from qlibs.net.multiplexer import MultiplexerException, base_struct
+        from qlibs.net.rooms import MAX_JOIN_PACKET, _first_room
+        join = bytes_packet_sender(base_struct.pack(7, 0, 0, 0) + b"lobby")
+        self.assertEqual(_first_room(join), (True, "lobby"))
+        self.assertEqual(_first_room(join[:-1]), (False, None))
+        self.assertEqual(_first_room(b"\x80"), (False, None))
+        #Other packets only need their kind to be known, whatever their length
+        payload = bytes_packet_sender(base_struct.pack(2, 0, 0, 0) + bytes(5000))
+        self.assertEqual(_first_room(payload[:30]), (True, None))
+        with self.assertRaises(MultiplexerException):
+            _first_room(bytes_packet_sender(base_struct.pack(7, 0, 0, 0) + bytes(MAX_JOIN_PACKET))[:30])
+        with self.assertRaises(MultiplexerException):
+            _first_room(b"\x80" * 6)
+
+    def test_acceptor_drops_stalled_joins(self):
+        import socket
+        import time
+        if not hasattr(socket, "send_fds"):
+            self.skipTest("No socket passing")
+        from qlibs.net.multiplexer import base_struct
+        from qlibs.net.rooms import MultiplexAcceptor, MAX_JOIN_PACKET
+        acceptor = MultiplexAcceptor("127.0.0.1", 0, workers=1, join_timeout=0.3)
+        routes = []
+        route = acceptor._route
+        acceptor._route = lambda sock: routes.append(route(sock))
+        acceptor.serve_in_thread()
+        try:
+            stalled = socket.create_connection(("127.0.0.1", acceptor.port))
+            long_join = socket.create_connection(("127.0.0.1", acceptor.port))
+            stalled.settimeout(5)
+            long_join.settimeout(5)
+            stalled.send(b"\x80")
+            long_join.send(bytes_packet_sender(base_struct.pack(7, 0, 0, 0) + bytes(MAX_JOIN_PACKET))[:100])
+            start = time.monotonic()
+            self.assertEqual(long_join.recv(1), b"")
+            self.assertLess(time.monotonic() - start, 0.3)
+            self.assertEqual(stalled.recv(1), b"")
+            self.assertGreaterEqual(time.monotonic() - start, 0.2)
+            #Incomplete packet isn't looked at again until more bytes arrive
+            self.assertLessEqual(len(routes), 2)
+            stalled.close()
+            long_join.close()
+        finally:
+            acceptor.close()
+
+
 class FontLoaderTestCase(unittest.TestCase):
     #Test if it does not crash
     def test_win(self):